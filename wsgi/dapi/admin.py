@@ -11,6 +11,7 @@ class MetaDapAdmin(admin.ModelAdmin):
         ('Tags', {'fields': ['tags']}),
     ]
     filter_horizontal = ['comaintainers']
+    list_display = ['package_name', 'user', 'active', 'downloads']
 
 
 admin.site.register(MetaDap, MetaDapAdmin)
@@ -27,6 +28,7 @@ class DapAdmin(admin.ModelAdmin):
         ('Optional', {'fields': ['homepage', 'bugreports', 'description'], 'classes': ['collapse']}),
     ]
     inlines = [AuthorInline]
+    list_display = ['__unicode__', 'downloads']
 
 
 admin.site.register(Dap, DapAdmin)
@@ -0,0 +1,69 @@
+import bisect
+import re
+
+from django.core.urlresolvers import reverse
+
+from dapi import caching
+from dapi.models import MetaDap
+
+SEPARATOR_RE = re.compile(r'[-_ ]+')
+
+# (version counter, index of dap names, index of tag names) loaded by this process
+_indexes = (None, None, None)
+
+
+class PrefixIndex(object):
+    '''Sorted list of (key, name, url) entries, looked up by a prefix of the key by bisection.
+    Every name has an entry for itself and one for each of its parts after a separator,
+    so "dj" finds both django and python-django.'''
+
+    def __init__(self, items):
+        entries = set()
+        for name, url in items:
+            key = name.lower()
+            entries.add((key, name, url))
+            for match in SEPARATOR_RE.finditer(key):
+                entries.add((key[match.end():], name, url))
+        self.entries = sorted(entries)
+
+    def lookup(self, prefix, limit=10):
+        '''Returns up to limit (name, url) pairs of names having a part starting with the prefix'''
+        prefix = prefix.lower()
+        found = []
+        i = bisect.bisect_left(self.entries, (prefix,))
+        while i < len(self.entries) and len(found) < limit and self.entries[i][0].startswith(prefix):
+            if self.entries[i][1:] not in found:
+                found.append(self.entries[i][1:])
+            i += 1
+        return found
+
+
+def build_indexes():
+    '''Loads the names of active daps and the names of their tags to prefix indexes'''
+    active = MetaDap.objects.filter(active=True)
+    daps = PrefixIndex((name, reverse('dapi.views.dap', args=(name,))) for name in active.values_list('package_name', flat=True))
+    tags = active.filter(tags__isnull=False).values_list('tags__name', 'tags__slug').distinct()
+    tags = PrefixIndex((name, reverse('dapi.views.tag', args=(slug,))) for name, slug in tags)
+    return daps, tags
+
+
+def get_indexes():
+    '''Returns the prefix indexes of dap and tag names.
+    They are loaded once per process and again only when the version counter was bumped.'''
+    global _indexes
+    version = caching.get_version('autocomplete', '')
+    if _indexes[0] != version:
+        _indexes = (version,) + build_indexes()
+    return _indexes[1:]
+
+
+def suggest(prefix, limit=10):
+    '''Returns daps and tags with names starting (or having a part starting) with the prefix'''
+    prefix = prefix.strip()
+    if not prefix:
+        return {'daps': [], 'tags': []}
+    daps, tags = get_indexes()
+    return {
+        'daps': [{'name': name, 'url': url} for name, url in daps.lookup(prefix, limit)],
+        'tags': [{'name': name, 'url': url} for name, url in tags.lookup(prefix, limit)],
+    }
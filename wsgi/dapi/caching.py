@@ -0,0 +1,121 @@
+import hashlib
+import json
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.shortcuts import render
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+
+def _digest(*parts):
+    '''Returns a hash of the given parts (e.g. from URLs), so cache keys are short and contain no spaces
+    or control characters memcached refuses'''
+    return hashlib.sha1(u'\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _version_key(kind, ident):
+    '''Returns the cache key of the version counter of given object'''
+    return 'dapi:version:{kind}:{ident}'.format(kind=kind, ident=_digest(ident))
+
+
+def _new_version():
+    '''Returns a fresh counter value, that is higher than any counter value used before it got lost'''
+    return int(time.time() * 1000)
+
+
+def get_version(kind, ident):
+    '''Returns the current version counter of given object (creates it when missing)'''
+    key = _version_key(kind, ident)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+# Bumps waiting for the transaction that made them to be committed
+_deferred = threading.local()
+
+
+def _deferred_bumps():
+    '''Returns the set of (kind, ident) bumps deferred in this thread'''
+    if not hasattr(_deferred, 'bumps'):
+        _deferred.bumps = set()
+    return _deferred.bumps
+
+
+def bump(kind, *idents):
+    '''Increments the version counters of given objects, so everything cached for them is thrown away.
+    Inside a transaction they are bumped by flush_bumps after the commit, a request reading the old rows
+    before it would cache them under the new version otherwise, with nothing to throw them away.'''
+    _deferred_bumps().update((kind, ident) for ident in idents)
+    if not transaction.get_connection().in_atomic_block:
+        flush_bumps()
+
+
+def flush_bumps():
+    '''Increments the version counters deferred by transactions, called when they are committed (see BumpMiddleware)'''
+    bumps = _deferred_bumps()
+    while bumps:
+        kind, ident = bumps.pop()
+        try:
+            cache.incr(_version_key(kind, ident))
+        except ValueError:
+            cache.add(_version_key(kind, ident), _new_version(), None)
+
+
+class BumpMiddleware(object):
+    '''Flushes the bumps deferred by the transactions of a view after they are committed, before the response
+    is sent, so the next request of the client sees the change. Leftovers (e.g. of a command) are flushed first.'''
+
+    def process_request(self, request):
+        flush_bumps()
+
+    def process_response(self, request, response):
+        flush_bumps()
+        return response
+
+
+def cached_content(kind, ident, variant, render_content):
+    '''Returns a piece of HTML for given object and variant from the cache.
+    If it's not there (or the object's version changed), it's rendered by render_content() and cached.'''
+    key = 'dapi:{kind}:{content}:{version}'.format(kind=kind, content=_digest(ident, variant), version=get_version(kind, ident))
+    content = cache.get(key)
+    if content is None:
+        content = render_content()
+        cache.set(key, content)
+    return content
+
+
+def render_cached(request, content, fragment=None, context=None):
+    '''Renders a page of cached content with an optional uncached per-user fragment'''
+    page = {'content': content, 'fragment': fragment}
+    page.update(context or {})
+    return render(request, 'dapi/public.html', page)
+
+
+def cached_json(request, kind, ident, variant, build):
+    '''Returns a JSON response of build() cached like cached_content, with a strong ETag (hash of the content)
+    and Last-Modified (time of rendering). Conditional requests of up to date clients are answered with 304.'''
+    def content():
+        body = json.dumps(build(), sort_keys=True)
+        return {'body': body, 'etag': quote_etag(hashlib.sha1(body).hexdigest()), 'last_modified': http_date()}
+    content = cached_content(kind, ident, variant, content)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        # GZipMiddleware appends ;gzip to the ETag of compressed responses
+        etags = [quote_etag(etag.replace(';gzip', '')) for etag in parse_etags(if_none_match)]
+        fresh = if_none_match.strip() == '*' or content['etag'] in etags
+    else:
+        since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        fresh = since is not None and since >= parse_http_date_safe(content['last_modified'])
+    if fresh:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content['body'], content_type='application/json')
+    response['ETag'] = content['etag']
+    response['Last-Modified'] = content['last_modified']
+    return response
@@ -0,0 +1,228 @@
+import errno
+import glob
+import mimetypes
+import os
+import re
+import time
+from collections import Counter
+from datetime import timedelta
+from wsgiref.util import FileWrapper
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import http_date, parse_etags, quote_etag, urlquote
+from django.views.static import was_modified_since
+
+from dapi.models import Dap, MetaDap, DownloadBatch
+
+CHUNK_SIZE = 64 * 2 ** 10
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+SPOOL = 'downloads.log'
+# How long counted batches are remembered, much longer than any flush takes
+BATCH_MARK_AGE = timedelta(days=1)
+
+
+class UnsatisfiableRange(Exception):
+    '''Raised when the requested range lies beyond the end of the file'''
+    pass
+
+
+def parse_range(header, size):
+    '''Returns (start, end) of a single byte range (both inclusive).
+    Returns None if the whole file should be sent (no header, multiple ranges or a malformed one).'''
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range, the last N bytes
+        if not int(last) or not size:
+            raise UnsatisfiableRange()
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise UnsatisfiableRange()
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def file_range(f, start, length):
+    '''Yields length bytes of the file from start by chunks and closes it'''
+    try:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def not_modified(request, etag, mtime, size):
+    '''Returns True if the client's copy is up to date (If-None-Match wins over If-Modified-Since)'''
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return etag is not None and (if_none_match.strip() == '*' or etag in map(quote_etag, parse_etags(if_none_match)))
+    return not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), mtime, size)
+
+
+def serve_dap(request, dap):
+    '''Returns a response with the file of the dap, answering conditional requests with 304.
+    If settings.DOWNLOAD_SENDFILE_HEADER is set, the front-end server sends the bytes (and handles ranges),
+    otherwise the file is streamed, a single byte range is supported.'''
+    path = dap.file.path
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise Http404
+    mtime, size = int(stat.st_mtime), stat.st_size
+    etag = quote_etag(dap.sha256sum) if dap.sha256sum else None
+    last_modified = http_date(mtime)
+
+    if not_modified(request, etag, mtime, size):
+        response = HttpResponseNotModified()
+    else:
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        header = getattr(settings, 'DOWNLOAD_SENDFILE_HEADER', None)
+        if header:
+            response = HttpResponse(content_type=content_type)
+            if header.lower() == 'x-accel-redirect':
+                response[header] = settings.DOWNLOAD_ACCEL_REDIRECT_PREFIX + urlquote(dap.file.name)
+            else:
+                response[header] = path
+        else:
+            response = stream_file(request, path, content_type, size, etag, last_modified)
+    if etag:
+        response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    return response
+
+
+def stream_file(request, path, content_type, size, etag, last_modified):
+    '''Returns a streaming response with the file or with the requested byte range of it'''
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE', '').strip()
+    # Send a range only if the client's copy is the one it has a part of
+    if not if_range or if_range in (etag, last_modified):
+        try:
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+        except UnsatisfiableRange:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{size}'.format(size=size)
+            return response
+    f = open(path, 'rb')
+    if byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(file_range(f, start, end - start + 1), status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes {start}-{end}/{size}'.format(start=start, end=end, size=size)
+        response['Content-Length'] = end - start + 1
+    else:
+        response = StreamingHttpResponse(FileWrapper(f, CHUNK_SIZE), content_type=content_type)
+        response['Content-Length'] = size
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def record_download(dap):
+    '''Appends the download of the dap to the spool, the counters are updated by flush_downloads.
+    A single short write to a file opened for appending is atomic, so processes can share the spool.'''
+    path = os.path.join(settings.DOWNLOAD_SPOOL_ROOT, SPOOL)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        try:
+            os.makedirs(settings.DOWNLOAD_SPOOL_ROOT)
+        except OSError as e:
+            # Created by a concurrent download meanwhile
+            if e.errno != errno.EEXIST:
+                raise
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, '{pk}\n'.format(pk=dap.pk))
+    finally:
+        os.close(fd)
+
+
+def rotate_spool():
+    '''Renames the spool to a new batch file, new downloads go to a fresh spool.
+    Returns False if there was no spool.'''
+    batch = 'batch-{time:.6f}-{pid}.log'.format(time=time.time(), pid=os.getpid())
+    try:
+        os.rename(os.path.join(settings.DOWNLOAD_SPOOL_ROOT, SPOOL), os.path.join(settings.DOWNLOAD_SPOOL_ROOT, batch))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+def read_batch(path):
+    '''Returns a Counter of downloads per dap id in the batch file, a torn last line is skipped'''
+    counts = Counter()
+    with open(path) as f:
+        for line in f:
+            if line.endswith('\n') and line.strip().isdigit():
+                counts[int(line)] += 1
+    return counts
+
+
+def apply_batch(path):
+    '''Adds the downloads in the batch file to the counters, with one UPDATE per dap version and package,
+    and removes the file. The batch is marked as counted in the same transaction and the mark is kept,
+    so neither a flush interrupted before removing the file, nor a flush running at the same time counts it again.
+    Returns the number of downloads counted.'''
+    name = os.path.basename(path)
+    try:
+        counts = read_batch(path)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        # Counted and removed by another flush
+        return 0
+    per_metadap = Counter()
+    try:
+        with transaction.atomic():
+            # The unique name makes a flush counting the batch at the same time fail
+            DownloadBatch.objects.create(name=name)
+            for pk, metadap_id in Dap.objects.filter(pk__in=counts.keys()).values_list('pk', 'metadap_id'):
+                Dap.objects.filter(pk=pk).update(downloads=F('downloads') + counts[pk])
+                per_metadap[metadap_id] += counts[pk]
+            for pk, count in per_metadap.items():
+                MetaDap.objects.filter(pk=pk).update(downloads=F('downloads') + count)
+    except IntegrityError:
+        # Counted before, but the file was not removed yet
+        per_metadap = Counter()
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return sum(per_metadap.values())
+
+
+def prune_batches(max_age=BATCH_MARK_AGE):
+    '''Forgets batches counted more than max_age ago, unless their files are still there'''
+    old = DownloadBatch.objects.filter(counted__lt=timezone.now() - max_age).values_list('pk', 'name')
+    gone = [pk for pk, name in old if not os.path.exists(os.path.join(settings.DOWNLOAD_SPOOL_ROOT, name))]
+    DownloadBatch.objects.filter(pk__in=gone).delete()
+
+
+def flush_downloads(settle=1):
+    '''Rotates the spool and adds all the batches to the counters, including ones left by an interrupted flush.
+    Waits settle seconds after rotating, so downloads that opened the spool before it was renamed get written.
+    Returns the number of downloads counted.'''
+    if rotate_spool() and settle:
+        time.sleep(settle)
+    count = 0
+    for path in sorted(glob.glob(os.path.join(settings.DOWNLOAD_SPOOL_ROOT, 'batch-*.log'))):
+        count += apply_batch(path)
+    prune_batches()
+    return count
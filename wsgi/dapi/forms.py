@@ -1,7 +1,10 @@
 from django.forms import *
 from dapi.models import MetaDap, Dap, Report, Profile
+from dapi.search import FACETS, faceted, narrow_facet
 from django.contrib.auth.models import User
 from captcha.fields import CaptchaField
+from haystack.forms import SearchForm
+from haystack.query import EmptySearchQuerySet
 from social.apps.django_app.default import models as social_models
 
 
@@ -10,6 +13,8 @@ VERIFY_HELP_TEXT = 'Enter the {what} of this dap to verify the {why}.'
 
 class UploadDapForm(Form):
     file = FileField()
+    background = BooleanField(required=False, label='Validate in the background',
+                              help_text='Return at once and check the result later, useful for big daps.')
 
 
 class UserForm(ModelForm):
@@ -118,3 +123,27 @@ class ReportAnonymousForm(ReportForm):
         fields = ReportForm.Meta.fields + ('email',)
         help_texts = ReportForm.Meta.help_texts
         help_texts['email'] = 'Optional. So we can inform you about the solution. We don\'t send spam or sell e-mail addresses.'
+
+
+class DapSearchForm(SearchForm):
+    '''Searches daps and counts their facets, narrowed by the selected facets (given as name:value)'''
+
+    def __init__(self, *args, **kwargs):
+        self.selected_facets = []
+        for facet in kwargs.pop('selected_facets', []):
+            name, colon, value = facet.partition(':')
+            if name in FACETS and value and (name, value) not in self.selected_facets:
+                self.selected_facets.append((name, value))
+        super(DapSearchForm, self).__init__(*args, **kwargs)
+
+    def no_query_found(self):
+        '''Without a query, all daps with the selected facets are found'''
+        if self.selected_facets:
+            return self.searchqueryset.all()
+        return EmptySearchQuerySet()
+
+    def search(self):
+        sqs = super(DapSearchForm, self).search()
+        for name, value in self.selected_facets:
+            sqs = narrow_facet(sqs, name, value)
+        return faceted(sqs)
@@ -0,0 +1,89 @@
+import errno
+import os
+import time
+
+from dapi.models import Dap, FileTombstone
+
+# Suffix of files being deleted, they are moved aside first
+DELETING = '.deleting'
+
+
+def dap_storage():
+    '''Returns the storage of the dap files'''
+    return Dap._meta.get_field('file').storage
+
+
+def delete_unused(name, oldest):
+    '''Deletes the stored file, unless it was modified after oldest (storing a file of the same content touches it)
+    or a dap uses it. The file is moved aside before it's checked, so an upload storing the same content meanwhile
+    doesn't find it and stores it again. Returns True if the file was deleted.'''
+    path = dap_storage().path(name)
+    moved = path + DELETING
+    try:
+        os.rename(path, moved)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    if os.path.getmtime(moved) >= oldest or Dap.objects.filter(file=name).exists():
+        # Same content, even if it was stored again meanwhile
+        os.rename(moved, path)
+        return False
+    os.remove(moved)
+    return True
+
+
+def collect_files(batch_size=100, min_age=10 * 60):
+    '''Deletes the files of deleted daps left as tombstones, unless a dap still (or again) uses them,
+    batch_size tombstones at once. Files modified in the last min_age seconds may belong to a dap being saved,
+    their tombstones are kept for the next run. Returns the number of files deleted.'''
+    storage = dap_storage()
+    oldest = time.time() - min_age
+    count, last = 0, 0
+    while True:
+        tombstones = list(FileTombstone.objects.filter(pk__gt=last).order_by('pk').values_list('pk', 'name')[:batch_size])
+        if not tombstones:
+            return count
+        last = tombstones[-1][0]
+        names = set(name for pk, name in tombstones)
+        used = set(Dap.objects.filter(file__in=names).values_list('file', flat=True))
+        kept = set()
+        for name in names - used:
+            if delete_unused(name, oldest):
+                count += 1
+            elif storage.exists(name):
+                kept.add(name)
+        FileTombstone.objects.filter(pk__in=[pk for pk, name in tombstones if name not in kept]).delete()
+
+
+def stored_files():
+    '''Yields names (relative to the storage) of all the files in the dap storage'''
+    location = dap_storage().location
+    for directory, dirnames, filenames in os.walk(location):
+        for filename in filenames:
+            yield os.path.relpath(os.path.join(directory, filename), location)
+
+
+def sweep_orphans(min_age=24 * 60 * 60, delete=True, batch_size=500):
+    '''Finds files in the dap storage no dap uses, not changed for min_age seconds (newer ones may belong
+    to an upload being saved right now, linking a file changes it as well), and deletes them if delete is True.
+    Returns the names of the orphans.'''
+    storage = dap_storage()
+    oldest = time.time() - min_age
+    orphans = []
+
+    def check(names):
+        used = set(Dap.objects.filter(file__in=names).values_list('file', flat=True))
+        for name in names:
+            if name not in used and os.path.getctime(storage.path(name)) < oldest and (not delete or delete_unused(name, oldest)):
+                orphans.append(name)
+
+    names = []
+    for name in stored_files():
+        names.append(name)
+        if len(names) == batch_size:
+            check(names)
+            names = []
+    if names:
+        check(names)
+    return orphans
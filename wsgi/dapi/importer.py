@@ -0,0 +1,110 @@
+import os
+from itertools import groupby
+
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.db import transaction
+
+from daploader import dapver
+
+from dapi import caching
+from dapi.logic import check_dap, upload_errors
+from dapi.models import MetaDap, Dap, Author, SearchQueueEntry, refresh_simple_index, version_key
+from dapi.storage import content_addressed_name, file_sha256
+
+META_FIELDS = ['version', 'license', 'homepage', 'bugreports', 'summary', 'description']
+
+
+def validate_dap(path):
+    '''Pool task, checks the dap file and hashes it.
+    Returns the path, the errors, the metadata and the checksum (the last two are None if the dap is not valid).'''
+    errors, dap = check_dap(path, os.path.basename(path))
+    if errors:
+        return path, errors, None, None
+    with open(path, 'rb') as f:
+        return path, [], dap.meta, file_sha256(f)
+
+
+def store_dap_file(path, sha256sum):
+    '''Stores a copy of the dap file at its content addressed location, returns its name.
+    It's not linked, the source belongs to the operator and may be changed after it's published.'''
+    with File(open(path, 'rb')) as f:
+        return Dap._meta.get_field('file').storage.save(content_addressed_name(sha256sum, path), f)
+
+
+def import_package(package_name, files, user):
+    '''Saves valid dap files (a list of (path, metadata, checksum)) of one package in version order,
+    the daps and their authors are inserted at once and latest versions are set once.
+    Versions not higher than the versions already there are rejected, like uploads.
+    Returns the metadap (None if nothing was imported) and the errors by path.'''
+    files = sorted(files, key=lambda f: version_key(f[1]['version']))
+    m = MetaDap.objects.filter(package_name=package_name).select_related('latest').prefetch_related('comaintainers').first()
+    owned = not m or m.user_id == user.pk or user in m.comaintainers.all()
+    errors, accepted = {}, []
+    latest = m.latest.version if m and m.latest else None
+    for path, meta, sha256sum in files:
+        if not owned:
+            errors[path] = upload_errors(m, owned, meta['version'])
+        elif latest and dapver.compare(latest, meta['version']) >= 0:
+            errors[path] = ['{dap} is already there in the same or higher version ({latest}).'.format(dap=package_name, latest=latest)]
+        else:
+            accepted.append((path, meta, sha256sum))
+            latest = meta['version']
+    if not accepted:
+        return None, errors
+    # Files are stored first, if saving the rows fails, sweep_orphans removes them
+    daps = []
+    for path, meta, sha256sum in accepted:
+        d = Dap(file=store_dap_file(path, sha256sum), sha256sum=sha256sum, **dict((attr, meta[attr]) for attr in META_FIELDS))
+        # bulk_create skips dap_pre_save_handler
+        d.version_key = version_key(d.version)
+        d.prerelease = d.is_pre()
+        daps.append(d)
+    with transaction.atomic():
+        if not m:
+            m = MetaDap.objects.create(package_name=package_name, user=user)
+        for d in daps:
+            d.metadap = m
+        Dap.objects.bulk_create(daps)
+        # bulk_create doesn't fill in the primary keys
+        pks = dict(m.dap_set.filter(version__in=[d.version for d in daps]).values_list('version', 'pk'))
+        Author.objects.bulk_create([Author(dap_id=pks[meta['version']], author=author)
+                                    for path, meta, sha256sum in accepted for author in meta['authors']])
+        fields = {'latest': pks[daps[-1].version]}
+        stable = [d for d in daps if not d.prerelease]
+        if stable:
+            fields['latest_stable'] = pks[stable[-1].version]
+        MetaDap.objects.filter(pk=m.pk).update(**fields)
+    return m, errors
+
+
+def import_daps(validated, user):
+    '''Saves validated dap files (results of validate_dap) owned by user, package by package.
+    Afterwards queues the packages for the search index, rewrites them in the simple index
+    and invalidates the cached pages showing them.
+    Returns the number of daps imported and the errors by path.'''
+    errors, files = {}, []
+    for path, file_errors, meta, sha256sum in validated:
+        if file_errors:
+            errors[path] = file_errors
+        else:
+            files.append((path, meta, sha256sum))
+    count, metadaps = 0, []
+    package_name = lambda f: f[1]['package_name']
+    for name, package_files in groupby(sorted(files, key=package_name), key=package_name):
+        package_files = list(package_files)
+        m, package_errors = import_package(name, package_files, user)
+        errors.update(package_errors)
+        if m:
+            metadaps.append(m)
+            count += len(package_files) - len(package_errors)
+    if metadaps:
+        # The signals of the daps were skipped by bulk_create, so do what their handlers do, once
+        ids = [m.pk for m in metadaps]
+        names = [m.package_name for m in metadaps]
+        SearchQueueEntry.objects.bulk_create([SearchQueueEntry(metadap_id=pk) for pk in ids])
+        refresh_simple_index(*names)
+        caching.bump('dap', *names)
+        caching.bump('index', '')
+        caching.bump('user', *User.objects.filter(metadap__pk__in=ids).values_list('username', flat=True).distinct())
+    return count, errors
@@ -1,38 +1,141 @@
 from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.shortcuts import get_object_or_404
+from django.db import connection, transaction
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.http import urlencode
 
 import daploader
 from daploader import dapver
 import logging
 import os
+import tarfile
+import yaml
+import zlib
+from contextlib import closing
 from cStringIO import StringIO
 from dapi.models import *
+from dapi import caching
+from dapi.storage import LocalFile
+from dapi.search import FACETS
 
 
-def handle_uploaded_dap(f, user):
-    '''Check uploaded file for validity and save it to the DB if it's OK.
-    Report errors if not.'''
+def check_dap(path, filename):
+    '''Check the dap file for validity.
+    Returns the errors and the loaded dap.'''
     errors = []
+    dap = None
     try:
-        dap = daploader.Dap(f.temporary_file_path(), mimic_filename=f.name)
+        dap = daploader.Dap(path, mimic_filename=filename)
         out = StringIO()
         if not dap.check(output=out, network=False, level=logging.ERROR):
             errors = out.getvalue().rstrip().split('\n')
     except (daploader.DapFileError, daploader.DapMetaError) as e:
         errors = [str(e)]
+    return errors, dap
+
+
+def read_meta(path):
+    '''Reads only meta.yaml of the dap, the archive is read just up to it.
+    Returns None if it cannot be found or read, check_dap reports why.'''
+    try:
+        with closing(tarfile.open(path, mode='r|gz')) as tar:
+            for member in tar:
+                if os.path.basename(member.name) == 'meta.yaml' and os.path.dirname(member.name).count('/') == 0:
+                    meta = yaml.safe_load(tar.extractfile(member)) if member.isfile() else None
+                    return meta if isinstance(meta, dict) else None
+    except (tarfile.TarError, IOError, EOFError, zlib.error, yaml.YAMLError):
+        pass
+    return None
+
+
+def upload_errors(metadap, owned, version):
+    '''Returns errors if given version of the existing metadap cannot be uploaded (by an owner or not)'''
+    if not owned:
+        return ['We have {dap} already here, but you don\'t own it.'.format(dap=metadap.package_name)]
+    if metadap.latest and dapver.compare(metadap.latest.version, version) >= 0:
+        return ['We have {dap} already in the same or higher version ({version}). If you want to update it, bump the version.'.format(dap=metadap.package_name, version=metadap.latest.version)]
+    return []
+
+
+def precheck_dap(path, user):
+    '''Cheap check before check_dap: reads only meta.yaml and checks the ownership and the version order
+    in one query. Returns the errors, none if the dap can be accepted or its metadata is not valid (check_dap reports that).'''
+    meta = read_meta(path)
+    if not meta:
+        return []
+    name, version = meta.get('package_name'), meta.get('version')
+    if not isinstance(name, basestring) or not isinstance(version, basestring) or \
+       not daploader.Dap._meta_valid['package_name'].match(name) or not daploader.Dap._meta_valid['version'].match(version):
+        return []
+    through = MetaDap.comaintainers.through._meta.db_table
+    comaintainer = 'EXISTS (SELECT 1 FROM {through} WHERE {through}.metadap_id = {table}.id AND {through}.user_id = %s)'.format(
+        through=connection.ops.quote_name(through), table=connection.ops.quote_name(MetaDap._meta.db_table))
+    m = MetaDap.objects.filter(package_name=name).select_related('latest').extra(
+        select={'is_comaintainer': comaintainer}, select_params=[user.pk]).first()
+    if not m:
+        return []
+    return upload_errors(m, m.user_id == user.pk or m.is_comaintainer, version)
+
+
+def handle_uploaded_dap(f, user):
+    '''Check uploaded file for validity and save it to the DB if it's OK.
+    Report errors if not.'''
+    errors = precheck_dap(f.temporary_file_path(), user)
+    if errors:
+        return errors, None
+    errors, dap = check_dap(f.temporary_file_path(), f.name)
     dname = None
     if not errors:
         errors, dname = save_dap_to_db(f, dap, user)
     return errors, dname
 
 
+def queue_uploaded_dap(f, user):
+    '''Store the uploaded file and queue it for validation by the process_uploads worker'''
+    upload = PendingUpload(file=f, filename=f.name, user=user)
+    upload.save()
+    return upload
+
+
+def claim_pending_upload():
+    '''Take the oldest queued upload and mark it as processing, so no other worker takes it.
+    Returns None if the queue is empty.'''
+    while True:
+        queued = PendingUpload.objects.filter(status=PendingUpload.QUEUED).order_by('pk').values_list('pk', flat=True)[:10]
+        if not queued:
+            return None
+        for pk in queued:
+            claimed = PendingUpload.objects.filter(pk=pk, status=PendingUpload.QUEUED)
+            if claimed.update(status=PendingUpload.PROCESSING, updated=timezone.now()):
+                return PendingUpload.objects.select_related('user').get(pk=pk)
+
+
+def process_pending_upload(upload):
+    '''Check a queued upload for validity and save it to the DB if it's OK.
+    The result is stored in the upload, the file is removed from the queue.'''
+    errors = precheck_dap(upload.file.path, upload.user)
+    if not errors:
+        errors, dap = check_dap(upload.file.path, upload.filename)
+    dname = None
+    if not errors:
+        with LocalFile(open(upload.file.path, 'rb'), name=upload.filename) as f:
+            errors, dname = save_dap_to_db(f, dap, upload.user)
+    upload.file.delete(save=False)
+    upload.errors = '\n'.join(errors)
+    upload.package_name = dname or ''
+    upload.status = PendingUpload.FAILED if errors else PendingUpload.DONE
+    upload.save()
+
+
 def save_dap_to_db(f, dap, user):
     '''Save the dap and it's metadata to the database'''
     try:
         m = MetaDap.objects.get(package_name=dap.meta['package_name'])
-        if m.user != user and user not in m.comaintainers.all():
-            return ['We have {dap} already here, but you don\'t own it.'.format(dap=m.package_name)], None
-        if m.latest and dapver.compare(m.latest.version, dap.meta['version']) >= 0:
-            return ['We have {dap} already in the same or higher version ({version}). If you want to update it, bump the version.'.format(dap=m.package_name, version=m.latest.version)], None
+        errors = upload_errors(m, m.user == user or user in m.comaintainers.all(), dap.meta['version'])
+        if errors:
+            return errors, None
     except MetaDap.DoesNotExist:
         m = MetaDap()
         m.package_name = dap.meta['package_name']
@@ -50,12 +153,154 @@ def save_dap_to_db(f, dap, user):
     if not d.is_pre():
         m.latest_stable = d
     m.save()
+    refresh_simple_index(m.package_name)
     return [], m.package_name
 
 
 def get_rank(metadap, user):
     '''Gets the rank of given metadap and user (if available)'''
-    try:
-        return metadap.rank_set.get(user=user).rank
-    except:
+    if not user.is_authenticated():
         return None
+    return metadap.rank_set.filter(user=user).values_list('rank', flat=True).first()
+
+
+def get_metadap_for_page(package_name):
+    '''Gets the metadap with everything the dap page needs in a fixed number of queries or raises Http404'''
+    metadaps = MetaDap.objects.select_related('user', 'latest', 'latest_stable').prefetch_related('comaintainers', 'tags')
+    return get_object_or_404(metadaps, package_name=package_name)
+
+
+def dap_page_context(metadap, dap):
+    '''Prepares the context for the public part of the dap page, so the template doesn't need to touch the DB'''
+    if dap:
+        dap.metadap = metadap
+        authors = list(dap.author_set.all())
+    else:
+        authors = []
+    return {
+        'metadap': metadap,
+        'dap': dap,
+        'comaintainers': list(metadap.comaintainers.all()),
+        'tags': sorted(metadap.tags.all(), key=lambda tag: tag.name),
+        'authors': authors,
+        'versions': metadap.sorted_versions(),
+        'similar': metadap.similar_active_daps()[:SimilarDap.TOP],
+        'reports': metadap.report_set.filter(solved=False).count(),
+    }
+
+
+def dap_user_context(package_name, user):
+    '''Prepares the context for the per-user part of the dap page'''
+    metadap = get_object_or_404(MetaDap.objects.select_related('user').prefetch_related('comaintainers'), package_name=package_name)
+    is_owner = user == metadap.user or user.is_superuser
+    is_comaintainer = user in metadap.comaintainers.all()
+    return {
+        'metadap': metadap,
+        'versions': metadap.sorted_versions() if is_owner or is_comaintainer else [],
+        'rank': get_rank(metadap, user),
+        'is_owner': is_owner,
+        'is_comaintainer': is_comaintainer,
+        'can_manage': is_owner or is_comaintainer,
+    }
+
+
+def refresh_similar_daps(metadap_ids):
+    '''Recalculates the precomputed similar daps of given metadaps by the count of shared tags'''
+    metadap_ids = list(metadap_ids)
+    similars = []
+    for metadap in MetaDap.objects.filter(pk__in=metadap_ids).prefetch_related('tags'):
+        tags = [tag.pk for tag in metadap.tags.all()]
+        if not tags:
+            continue
+        top = MetaDap.objects.filter(tags__in=tags, active=True).exclude(pk=metadap.pk)
+        top = top.annotate(score=Count('pk')).order_by('-score', 'package_name')[:SimilarDap.TOP]
+        for similar in top:
+            similars.append(SimilarDap(metadap=metadap, similar=similar, score=similar.score))
+    with transaction.atomic():
+        SimilarDap.objects.filter(metadap__in=metadap_ids).delete()
+        SimilarDap.objects.bulk_create(similars)
+    caching.bump('dap', *MetaDap.objects.filter(pk__in=metadap_ids).values_list('package_name', flat=True))
+
+
+def search_result_daps(results):
+    '''Returns active metadaps of given search results in their ranking order,
+    loaded with their latest versions and owners in one query. Hidden metadaps are not in the index
+    (see QueuedSignalProcessor), only one hidden by a concurrent request may be left out here.'''
+    pks = [int(result.pk) for result in results]
+    if not pks:
+        return []
+    metadaps = MetaDap.objects.filter(pk__in=pks, active=True).select_related('latest', 'latest_stable', 'user')
+    metadaps = dict((metadap.pk, metadap) for metadap in metadaps)
+    return [metadaps[pk] for pk in pks if pk in metadaps]
+
+
+def search_url(query, facets):
+    '''Returns URL of the search for query narrowed by given facets (a list of (name, value))'''
+    params = [('q', query)] if query else []
+    params += [('selected_facets', u'{name}:{value}'.format(name=name, value=value)) for name, value in facets]
+    return reverse('dapi.views.search') + '?' + urlencode(params)
+
+
+def facet_links(counts, query, selected):
+    '''Returns [(facet name, [(value, count, URL of the search narrowed by it)])] of given facet counts,
+    the already selected facets (a list of (name, value)) are left out'''
+    return [(name, [(value, count, search_url(query, selected + [(name, value)]))
+                    for value, count in counts.get(name, []) if (name, value) not in selected])
+            for name in FACETS]
+
+
+def selected_facet_links(query, selected):
+    '''Returns [(facet name, value, URL of the search without it)] of the selected facets'''
+    return [(name, value, search_url(query, [facet for facet in selected if facet != (name, value)]))
+            for name, value in selected]
+
+
+def _api_version_data(dap, package_name):
+    '''Returns the API representation of a dap version (authors have to be prefetched)'''
+    return {
+        'version': dap.version,
+        'license': dap.license,
+        'summary': dap.summary,
+        'description': dap.description,
+        'homepage': dap.homepage or None,
+        'bugreports': dap.bugreports or None,
+        'authors': [a.author for a in dap.author_set.all()],
+        'sha256sum': dap.sha256sum or None,
+        'download': dap.file.url,
+        'api': reverse('dapi.views.api_dap_version', args=(package_name, dap.version)),
+    }
+
+
+def api_list_data():
+    '''Returns the API list of active daps, in one query'''
+    daps = MetaDap.objects.filter(active=True).order_by('package_name')
+    return {'daps': [{
+        'package_name': name,
+        'latest': latest,
+        'latest_stable': latest_stable,
+        'api': reverse('dapi.views.api_dap', args=(name,)),
+    } for name, latest, latest_stable in daps.values_list('package_name', 'latest__version', 'latest_stable__version')]}
+
+
+def api_dap_data(package_name):
+    '''Returns the API metadata of a dap with all its versions, in a fixed number of queries, or raises Http404'''
+    metadap = get_metadap_for_page(package_name)
+    daps = metadap.dap_set.order_by('-version_key').prefetch_related('author_set')
+    return {
+        'package_name': metadap.package_name,
+        'active': metadap.active,
+        'user': metadap.user.username,
+        'comaintainers': sorted(u.username for u in metadap.comaintainers.all()),
+        'tags': sorted(t.name for t in metadap.tags.all()),
+        'average_rank': metadap.average_rank,
+        'rank_count': metadap.rank_count,
+        'latest': metadap.latest.version if metadap.latest else None,
+        'latest_stable': metadap.latest_stable.version if metadap.latest_stable else None,
+        'versions': [_api_version_data(dap, metadap.package_name) for dap in daps],
+    }
+
+
+def api_version_data(package_name, version):
+    '''Returns the API detail of one version of a dap or raises Http404'''
+    daps = Dap.objects.prefetch_related('author_set')
+    return _api_version_data(get_object_or_404(daps, metadap__package_name=package_name, version=version), package_name)
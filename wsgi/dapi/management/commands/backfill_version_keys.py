@@ -0,0 +1,16 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from dapi.models import Dap, version_key
+
+
+class Command(NoArgsCommand):
+    help = 'Fills in version sort keys and pre-release flags of daps saved before they existed.'
+
+    def handle_noargs(self, **options):
+        count = 0
+        with transaction.atomic():
+            for pk, version in Dap.objects.filter(version_key='').values_list('pk', 'version').iterator():
+                Dap.objects.filter(pk=pk).update(version_key=version_key(version), prerelease=not version[-1].isdigit())
+                count += 1
+        self.stdout.write('Filled in {count} version key(s).'.format(count=count))
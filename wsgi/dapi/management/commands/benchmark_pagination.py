@@ -0,0 +1,98 @@
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from taggit.models import Tag, TaggedItem
+
+from dapi.management.commands.create_partial_indexes import INDEXES
+from dapi.models import MetaDap
+from dapi.pagination import KeysetPaginator
+
+
+class Rollback(Exception):
+    '''Raised to throw away the seeded daps'''
+    pass
+
+
+class Command(BaseCommand):
+    args = '<tag>'
+    help = 'Compares the latency of a deep page of a tag listing paginated with OFFSET and with keyset pagination.'
+    option_list = BaseCommand.option_list + (
+        make_option('--page', type='int', default=100, help='The deep page to measure'),
+        make_option('--per-page', type='int', default=25, help='How many daps are on one page'),
+        make_option('--repeat', type='int', default=20, help='How many times to load the page'),
+        make_option('--seed', type='int', default=0, help='Create this many tagged daps first, they are rolled back afterwards'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Exactly one tag has to be given.')
+        try:
+            with transaction.atomic():
+                if options['seed']:
+                    self.seed(args[0], options['seed'])
+                self.benchmark(args[0], options['page'], options['per_page'], options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def seed(self, tag, count):
+        '''Creates given number of daps with given tag and random looking ranks.
+        Bulk inserts are used, so no signals (search index, caches) are triggered.'''
+        user, created = User.objects.get_or_create(username='benchmark')
+        t, created = Tag.objects.get_or_create(slug=tag, defaults={'name': tag})
+        MetaDap.objects.bulk_create([MetaDap(package_name='benchmark{i}'.format(i=i), user=user,
+                                             rank_count=i % 97, average_rank=(i % 41) / 10.0 or None)
+                                     for i in range(count)])
+        content_type = ContentType.objects.get_for_model(MetaDap)
+        ids = MetaDap.objects.filter(package_name__startswith='benchmark').values_list('pk', flat=True)
+        TaggedItem.objects.bulk_create([TaggedItem(tag=t, content_type=content_type, object_id=pk) for pk in ids])
+
+    def measure(self, load, repeat):
+        '''Returns the average time in milliseconds of calling load'''
+        start = time.time()
+        for i in range(repeat):
+            load()
+        return (time.time() - start) * 1000 / repeat
+
+    def benchmark(self, tag, page, per_page, repeat):
+        '''Measures the given page loaded by Paginator and by KeysetPaginator'''
+        daps = MetaDap.objects.filter(tags__slug__in=[tag], active=True)
+        paginator = Paginator(daps.order_by('-average_rank', '-rank_count', '-pk'), per_page)
+        if page > paginator.num_pages:
+            raise CommandError('There are only {pages} pages of daps tagged with {tag}.'.format(pages=paginator.num_pages, tag=tag))
+        keyset = KeysetPaginator(daps, ['-average_rank', '-rank_count', '-pk'], per_page)
+        # Walk to the deep page once, to get the token of it
+        token = None
+        for i in range(page - 1):
+            token = keyset.page(token).next_token
+
+        def offset():
+            # A fresh Paginator, so the COUNT is run like on every request
+            list(Paginator(daps.order_by('-average_rank', '-rank_count', '-pk'), per_page).page(page))
+
+        offset_ms = self.measure(offset, repeat)
+        keyset_ms = self.measure(lambda: list(keyset.page(token)), repeat)
+        first_ms = self.measure(lambda: list(keyset.page()), repeat)
+        self.stdout.write('Page {page} of {pages} ({per_page} daps per page, average of {repeat} loads):'.format(
+            page=page, pages=paginator.num_pages, per_page=per_page, repeat=repeat))
+        self.stdout.write('  OFFSET + COUNT: {ms:.2f} ms'.format(ms=offset_ms))
+        self.stdout.write('  keyset:         {ms:.2f} ms'.format(ms=keyset_ms))
+        self.stdout.write('  keyset page 1:  {ms:.2f} ms'.format(ms=first_ms))
+        self.explain(keyset.page_queryset(token))
+
+    def explain(self, queryset):
+        '''Writes the plan of the query of a keyset page, with a warning if no partial index serves it'''
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute(('EXPLAIN ' if connection.vendor == 'postgresql' else 'EXPLAIN QUERY PLAN ') + sql, params)
+        plan = [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+        self.stdout.write('Plan of the keyset page:')
+        for line in plan:
+            self.stdout.write('  ' + line)
+        if not any(name in line for line in plan for name, columns in INDEXES):
+            self.stdout.write('WARNING: No partial index serves the page, run create_partial_indexes (SQLite cannot match them to bound parameters).')
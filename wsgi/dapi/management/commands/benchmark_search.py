@@ -0,0 +1,117 @@
+import random
+import re
+import shutil
+import tempfile
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, transaction
+from haystack import connections
+from haystack.backends.whoosh_backend import WhooshSearchBackend
+
+from dapi.models import MetaDap, Dap
+from dapi.search import PreparedIndex, prepare_documents
+from dapi.search_backend import create_schema
+
+WORDS = ('assistant project python ruby perl java django flask rails web cli gui test docs package build deploy '
+         'container docker vagrant openshift fedora library framework template generator lint check server client '
+         'database postgres sqlite api rest json yaml xml parser compiler editor vim emacs git github tool kit').split()
+
+
+class Rollback(Exception):
+    '''Raised to throw away the seeded daps and the indexed documents'''
+    pass
+
+
+class Command(NoArgsCommand):
+    help = 'Compares relevance (MRR@10) and latency of the database search backend and Whoosh on the same documents.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--seed', type='int', default=0, help='Create this many daps with generated summaries first, they are rolled back afterwards'),
+        make_option('--queries', type='int', default=100, help='How many daps to look for'),
+        make_option('--batch-size', type='int', default=1000, help='How many documents are written to the indexes at once'),
+    )
+
+    def handle_noargs(self, **options):
+        self.whoosh_path = tempfile.mkdtemp()
+        try:
+            with transaction.atomic():
+                if options['seed']:
+                    self.seed(options['seed'])
+                self.benchmark(options['queries'], options['batch_size'])
+                raise Rollback()
+        except Rollback:
+            pass
+        finally:
+            shutil.rmtree(self.whoosh_path)
+
+    def seed(self, count):
+        '''Creates given number of daps with summaries of random words.
+        Bulk inserts are used, so no signals (search queue, caches) are triggered.'''
+        rand = random.Random(0)
+        user, created = User.objects.get_or_create(username='benchmark')
+        MetaDap.objects.bulk_create([MetaDap(package_name='benchmark-{w}-{i}'.format(w=rand.choice(WORDS), i=i), user=user)
+                                     for i in range(count)])
+        Dap.objects.bulk_create([Dap(metadap_id=pk, version='1.0', file='benchmark.dap', license='GPLv2+',
+                                     summary=' '.join(rand.sample(WORDS, 4)).capitalize(),
+                                     description=' '.join(rand.choice(WORDS) for i in range(30)))
+                                 for pk in MetaDap.objects.filter(package_name__startswith='benchmark-').values_list('pk', flat=True)])
+
+    def backends(self):
+        '''Returns the database backend and a Whoosh backend writing to a temporary directory.
+        Whoosh is not a configured connection, it shares the search indexes of the default one.'''
+        return [('database', connections['default'].get_backend()), ('whoosh', WhooshSearchBackend('default', PATH=self.whoosh_path))]
+
+    def index(self, backends, batch_size):
+        '''Writes the documents of all active daps to all the backends, returns their count'''
+        create_schema(connection.cursor())
+        pks = list(MetaDap.objects.filter(active=True).values_list('pk', flat=True))
+        for name, backend in backends:
+            backend.clear(models=[MetaDap])
+        for start in range(0, len(pks), batch_size):
+            documents = prepare_documents('default', pks[start:start + batch_size])
+            for name, backend in backends:
+                backend.update(PreparedIndex(), documents)
+        return len(pks)
+
+    def queries(self, count):
+        '''Returns (kind, query, expected pk) triples: names of random daps and two words of their summaries'''
+        rand = random.Random(1)
+        daps = Dap.objects.filter(metadap__active=True).order_by('version_key')
+        summaries = dict((pk, (package_name, summary)) for pk, package_name, summary in
+                         daps.values_list('metadap_id', 'metadap__package_name', 'summary'))
+        sample = [(pk, package_name, summary) for pk, (package_name, summary) in sorted(summaries.items())]
+        sample = rand.sample(sample, min(count, len(sample)))
+        queries = []
+        for pk, package_name, summary in sample:
+            queries.append(('names', ' '.join(re.findall(r'\w+', package_name)), str(pk)))
+            words = re.findall(r'\w+', summary)
+            if len(words) >= 2:
+                queries.append(('summaries', ' '.join(rand.sample(words, 2)), str(pk)))
+        return queries
+
+    def benchmark(self, count, batch_size):
+        backends = self.backends()
+        documents = self.index(backends, batch_size)
+        queries = self.queries(count)
+        if not queries:
+            raise CommandError('There are no active daps to look for, use --seed.')
+        self.stdout.write('{documents} documents, {queries} queries'.format(documents=documents, queries=len(queries)))
+        self.stdout.write('{0:<10}{1:>14}{2:>18}{3:>10}{4:>10}'.format('backend', 'MRR@10 names', 'MRR@10 summaries', 'mean ms', 'p95 ms'))
+        for name, backend in backends:
+            reciprocal = {'names': [], 'summaries': []}
+            latencies = []
+            for kind, query, expected in queries:
+                start = time.time()
+                results = backend.search(query, start_offset=0, end_offset=10)['results']
+                latencies.append((time.time() - start) * 1000)
+                pks = [str(result.pk) for result in results]
+                reciprocal[kind].append(1.0 / (pks.index(expected) + 1) if expected in pks else 0)
+            latencies.sort()
+            self.stdout.write('{0:<10}{1:>14.3f}{2:>18.3f}{3:>10.2f}{4:>10.2f}'.format(
+                name,
+                sum(reciprocal['names']) / max(len(reciprocal['names']), 1),
+                sum(reciprocal['summaries']) / max(len(reciprocal['summaries']), 1),
+                sum(latencies) / len(latencies),
+                latencies[int(len(latencies) * 0.95)]))
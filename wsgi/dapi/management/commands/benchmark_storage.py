@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.management.base import NoArgsCommand
+
+from dapi.storage import ContentAddressedStorage
+
+
+class Command(NoArgsCommand):
+    help = 'Compares the time of storing an uploaded dap by copying it and by linking the uploaded temporary file.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--size', type='int', default=50, help='Size of the dap in MB'),
+        make_option('--repeat', type='int', default=5, help='How many daps to store'),
+    )
+
+    def handle_noargs(self, **options):
+        # Next to MEDIA_ROOT, so it's on the same file system
+        parent = os.path.dirname(os.path.abspath(settings.MEDIA_ROOT))
+        location = tempfile.mkdtemp(dir=parent if os.path.isdir(parent) else None)
+        try:
+            storage = ContentAddressedStorage(location=location)
+            copy_ms = self.measure(lambda upload, i: storage.save('copy/{i}.dap'.format(i=i), File(open(upload.temporary_file_path(), 'rb'))),
+                                   options['size'], options['repeat'])
+            link_ms = self.measure(lambda upload, i: storage.save('link/{i}.dap'.format(i=i), File(upload)),
+                                   options['size'], options['repeat'])
+        finally:
+            shutil.rmtree(location)
+        self.stdout.write('Storing a {size} MB dap (average of {repeat}):'.format(size=options['size'], repeat=options['repeat']))
+        self.stdout.write('  copy: {ms:.2f} ms'.format(ms=copy_ms))
+        self.stdout.write('  link: {ms:.2f} ms'.format(ms=link_ms))
+
+    def upload(self, size):
+        '''Returns an uploaded temporary file of given size in MB, as the upload handler writes it'''
+        upload = TemporaryUploadedFile('benchmark.dap', 'application/octet-stream', size * 2 ** 20, None)
+        chunk = os.urandom(2 ** 20)
+        for i in range(size):
+            upload.write(chunk)
+        upload.flush()
+        upload.seek(0)
+        return upload
+
+    def measure(self, store, size, repeat):
+        '''Returns the average time in milliseconds of storing an uploaded file by store(upload, i)'''
+        total = 0
+        for i in range(repeat):
+            upload = self.upload(size)
+            try:
+                start = time.time()
+                store(upload, i)
+                total += time.time() - start
+            finally:
+                upload.close()
+        return total * 1000 / repeat
@@ -0,0 +1,74 @@
+import os
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from dapi.logic import check_dap, precheck_dap, read_meta, save_dap_to_db
+from dapi.models import MetaDap, Dap
+
+
+class Rollback(Exception):
+    '''Raised to throw away the seeded dap'''
+    pass
+
+
+class Command(BaseCommand):
+    args = '<dap file>'
+    help = 'Compares the latency of rejecting a re-upload of the same version by the full check and by the meta.yaml pre-check.'
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', default=20, help='How many times to reject the upload'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Exactly one dap file has to be given.')
+        path = args[0]
+        meta = read_meta(path)
+        if not meta:
+            raise CommandError('Could not read meta.yaml of {path}.'.format(path=path))
+        try:
+            with transaction.atomic():
+                user = self.seed(meta)
+                # Checked before the full check runs, an accepted upload would be saved (with its side effects)
+                if not precheck_dap(path, user):
+                    raise CommandError('The upload would not be rejected (the benchmark user may own {name}).'.format(name=meta['package_name']))
+                self.benchmark(path, user, options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def seed(self, meta):
+        '''Returns the benchmark user, the upload gets rejected, because the user doesn't own the existing package.
+        If there is no such package, it's created in the same version, owned by the user.
+        Nothing existing is changed and bulk inserts are used, so no signals rewrite the simple index or caches.'''
+        user, created = User.objects.get_or_create(username='benchmark')
+        if not MetaDap.objects.filter(package_name=meta['package_name']).exists():
+            MetaDap.objects.bulk_create([MetaDap(package_name=meta['package_name'], user=user)])
+            m = MetaDap.objects.get(package_name=meta['package_name'])
+            Dap.objects.bulk_create([Dap(metadap=m, version=meta['version'], file='benchmark.dap')])
+            MetaDap.objects.filter(pk=m.pk).update(latest=m.dap_set.get())
+        return user
+
+    def measure(self, reject, repeat):
+        '''Returns the average time in milliseconds of calling reject, checks that it rejects'''
+        start = time.time()
+        for i in range(repeat):
+            if not reject():
+                raise CommandError('The upload was not rejected.')
+        return (time.time() - start) * 1000 / repeat
+
+    def benchmark(self, path, user, repeat):
+        def full():
+            # What handle_uploaded_dap did before the pre-check
+            errors, dap = check_dap(path, os.path.basename(path))
+            return errors or save_dap_to_db(None, dap, user)[0]
+
+        full_ms = self.measure(full, repeat)
+        precheck_ms = self.measure(lambda: precheck_dap(path, user), repeat)
+        self.stdout.write('Rejecting {name} ({size} kB, average of {repeat} uploads):'.format(
+            name=os.path.basename(path), size=os.path.getsize(path) // 1024, repeat=repeat))
+        self.stdout.write('  full check: {ms:.2f} ms'.format(ms=full_ms))
+        self.stdout.write('  pre-check:  {ms:.2f} ms'.format(ms=precheck_ms))
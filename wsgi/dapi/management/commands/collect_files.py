@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from dapi.garbage import collect_files, sweep_orphans
+
+
+class Command(NoArgsCommand):
+    help = 'Deletes the files of deleted daps. With --sweep-orphans, also looks for files in MEDIA_ROOT no dap uses.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=100, help='How many deleted files are processed at once'),
+        make_option('--grace', type='float', default=10, help='Keep files of deleted daps modified in this many minutes (uploaded again)'),
+        make_option('--sweep-orphans', action='store_true', default=False, help='Walk MEDIA_ROOT and delete files no dap uses'),
+        make_option('--min-age', type='float', default=24, help='Only sweep orphans not changed for this many hours'),
+        make_option('--dry-run', action='store_true', default=False, help='Only list the orphans, do not delete them'),
+    )
+
+    def handle_noargs(self, **options):
+        count = collect_files(options['batch_size'], options['grace'] * 60)
+        self.stdout.write('Deleted {count} file(s) of deleted daps.'.format(count=count))
+        if options['sweep_orphans']:
+            orphans = sweep_orphans(options['min_age'] * 60 * 60, delete=not options['dry_run'])
+            for name in orphans:
+                self.stdout.write(name)
+            self.stdout.write('{what} {count} orphaned file(s).'.format(what='Found' if options['dry_run'] else 'Deleted',
+                                                                          count=len(orphans)))
@@ -0,0 +1,48 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from dapi.models import MetaDap
+
+# Names and columns of indexes over active daps only, backing the leaderboards and tag listings
+# (a changed definition gets a new name, the old index is dropped). The columns match dapi.pagination.nulls_last,
+# the flag puts NULLs last on any DB, so the index serves both the ordering and the keyset range.
+INDEXES = (
+    ('dapi_metadap_active_top_rated_nulls_last',
+     '(average_rank IS NOT NULL) DESC, average_rank DESC, rank_count DESC, id DESC'),
+    ('dapi_metadap_active_most_rated_nulls_last',
+     'rank_count DESC, (average_rank IS NOT NULL) DESC, average_rank DESC, id DESC'),
+)
+# Indexes replaced by the ones above, they didn't match the ordering (id ascending, NULLs first on PostgreSQL)
+OBSOLETE = (
+    'dapi_metadap_active_top_rated',
+    'dapi_metadap_active_most_rated',
+    'dapi_metadap_active_top_rated_id_desc',
+    'dapi_metadap_active_most_rated_id_desc',
+)
+
+
+class Command(NoArgsCommand):
+    help = 'Creates partial indexes that Django (and South) cannot describe. Can be run repeatedly.'
+
+    def exists(self, cursor, name):
+        '''Checks if the index of given name exists (PostgreSQL 9.2 doesn't know CREATE INDEX IF NOT EXISTS)'''
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', [name])
+        else:
+            cursor.execute('SELECT 1 FROM sqlite_master WHERE type = %s AND name = %s', ['index', name])
+        return bool(cursor.fetchone())
+
+    def handle_noargs(self, **options):
+        cursor = connection.cursor()
+        table = connection.ops.quote_name(MetaDap._meta.db_table)
+        active = connection.ops.quote_name('active')
+        for name in OBSOLETE:
+            if self.exists(cursor, name):
+                cursor.execute('DROP INDEX {name}'.format(name=name))
+                self.stdout.write('Dropped obsolete index {name}.'.format(name=name))
+        for name, columns in INDEXES:
+            if self.exists(cursor, name):
+                continue
+            cursor.execute('CREATE INDEX {name} ON {table} ({columns}) WHERE {active}'.format(
+                name=name, table=table, columns=columns, active=active))
+            self.stdout.write('Created index {name}.'.format(name=name))
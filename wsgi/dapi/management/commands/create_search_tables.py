@@ -0,0 +1,14 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from dapi.search_backend import create_schema
+
+
+class Command(NoArgsCommand):
+    help = 'Creates the full text search structures of the database search backend, that Django (and South) cannot describe. Can be run repeatedly.'
+
+    def handle_noargs(self, **options):
+        with transaction.atomic():
+            created = create_schema(connection.cursor())
+        if created:
+            self.stdout.write('Created the full text search structures.')
@@ -0,0 +1,16 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from dapi.downloads import flush_downloads
+
+
+class Command(NoArgsCommand):
+    help = 'Adds the spooled downloads to the download counters. Batches left by an interrupted flush are counted as well, but only once.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--settle', type='float', default=1, help='Seconds to wait for downloads being written to the rotated spool'),
+    )
+
+    def handle_noargs(self, **options):
+        count = flush_downloads(options['settle'])
+        self.stdout.write('Counted {count} download(s).'.format(count=count))
@@ -0,0 +1,53 @@
+import glob
+import multiprocessing
+import os
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from dapi.importer import import_daps, validate_dap
+from dapi.management.commands.rebuild_search_index import close_connections
+
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = ('Imports all the dap files of a directory (e.g. to seed a mirror), they are validated by a pool of processes '
+            'and saved package by package in version order. Versions already there are reported as errors.')
+    option_list = BaseCommand.option_list + (
+        make_option('--user', help='Username of the owner of the new daps (required)'),
+        make_option('--workers', type='int', default=multiprocessing.cpu_count(), help='Processes validating the daps (1 validates them in this process)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or not os.path.isdir(args[0]):
+            raise CommandError('Exactly one directory has to be given.')
+        if not options['user']:
+            raise CommandError('The owner has to be given by --user.')
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError('User {user} does not exist.'.format(user=options['user']))
+        paths = sorted(glob.glob(os.path.join(args[0], '*.dap')))
+        size = sum(os.path.getsize(path) for path in paths)
+        start = time.time()
+        if options['workers'] > 1 and len(paths) > 1:
+            close_connections()
+            pool = multiprocessing.Pool(options['workers'], initializer=close_connections)
+            try:
+                validated = pool.map(validate_dap, paths, chunksize=max(1, len(paths) // (options['workers'] * 4)))
+            finally:
+                pool.terminate()
+        else:
+            validated = [validate_dap(path) for path in paths]
+        validated_in = time.time() - start
+        count, errors = import_daps(validated, user)
+        elapsed = time.time() - start
+        for path in sorted(errors):
+            for error in errors[path]:
+                self.stdout.write('{name}: {error}'.format(name=os.path.basename(path), error=error))
+        self.stdout.write('Imported {count} of {total} dap(s) ({size:.1f} MB) in {elapsed:.1f} s (validated in {validated:.1f} s), '
+                          '{rate:.1f} daps/s, {mb_rate:.1f} MB/s.'.format(
+                              count=count, total=len(paths), size=size / 2.0 ** 20, elapsed=elapsed, validated=validated_in,
+                              rate=len(paths) / elapsed if elapsed else 0, mb_rate=size / 2.0 ** 20 / elapsed if elapsed else 0))
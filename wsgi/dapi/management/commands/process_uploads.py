@@ -0,0 +1,48 @@
+import logging
+import time
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.utils import timezone
+
+from dapi import caching
+from dapi.logic import claim_pending_upload, process_pending_upload
+from dapi.models import PendingUpload
+
+logger = logging.getLogger(__name__)
+
+
+class Command(NoArgsCommand):
+    help = 'Validates queued uploads and saves the valid ones to the DB. Runs forever unless --once is given.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', default=False, help='Exit when the queue is empty'),
+        make_option('--sleep', type='float', default=2, help='Seconds to wait before looking at an empty queue again'),
+        make_option('--stale', type='int', default=30, help='Requeue uploads processing for more than this many minutes (crashed workers)'),
+    )
+
+    def requeue_stale(self, minutes):
+        '''Puts uploads abandoned by crashed workers back to the queue'''
+        limit = timezone.now() - timedelta(minutes=minutes)
+        PendingUpload.objects.filter(status=PendingUpload.PROCESSING, updated__lt=limit).update(status=PendingUpload.QUEUED)
+
+    def handle_noargs(self, **options):
+        self.requeue_stale(options['stale'])
+        while True:
+            upload = claim_pending_upload()
+            if upload is None:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                self.requeue_stale(options['stale'])
+                continue
+            try:
+                process_pending_upload(upload)
+            except Exception:
+                logger.exception('Processing of upload %s failed', upload.pk)
+                PendingUpload.objects.filter(pk=upload.pk).update(status=PendingUpload.FAILED, errors='Internal error, please try again later.')
+                continue
+            finally:
+                # Pages showing the dap are thrown away once it's committed
+                caching.flush_bumps()
+            self.stdout.write('{upload}'.format(upload=upload))
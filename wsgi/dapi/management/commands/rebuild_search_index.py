@@ -0,0 +1,92 @@
+import multiprocessing
+import time
+from optparse import make_option
+
+from django import db
+from django.core.management.base import NoArgsCommand
+from haystack import connections
+from taggit.models import TaggedItem
+
+from dapi.models import MetaDap, SearchDocument, SearchFacetValue
+from dapi.search import PreparedIndex, document_id, prepare_documents
+
+
+def close_connections():
+    '''Forked workers must not share the DB connections of the parent'''
+    for connection in db.connections.all():
+        connection.close()
+
+
+def prepare_chunk(args):
+    '''Pool task, returns the prepared documents of a chunk of metadaps'''
+    return prepare_documents(*args)
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the search index of all active daps, documents are rendered by a pool of processes and written in large batches.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--using', default='default', help='The search connection to rebuild'),
+        make_option('--workers', type='int', default=multiprocessing.cpu_count(), help='Processes rendering the documents (1 renders them in this process)'),
+        make_option('--chunk-size', type='int', default=100, help='How many metadaps a worker renders at once'),
+        make_option('--batch-size', type='int', default=2000, help='How many documents are written to the index in one commit'),
+        make_option('--clear', action='store_true', default=False, help='Empty the index first, instead of overwriting the documents and removing inactive daps'),
+        make_option('--if-empty', action='store_true', default=False, help='Do nothing if the index was built already (used by the deploy hook)'),
+    )
+
+    def built(self):
+        '''Returns True if the database search index has documents, including the facet values of tagged daps'''
+        return SearchDocument.objects.exists() and (SearchFacetValue.objects.exists() or not TaggedItem.objects.exists())
+
+    def chunks(self, chunk_size):
+        '''Yields lists of primary keys of active metadaps, streamed from the DB'''
+        index = connections[self.using].get_unified_index().get_index(MetaDap)
+        chunk = []
+        for pk in index.index_queryset(using=self.using).order_by('pk').values_list('pk', flat=True).iterator():
+            chunk.append(pk)
+            if len(chunk) == chunk_size:
+                yield (self.using, chunk)
+                chunk = []
+        if chunk:
+            yield (self.using, chunk)
+
+    def write(self, backend, documents):
+        '''Writes a batch of documents and reports the throughput so far'''
+        if documents:
+            backend.update(PreparedIndex(), documents)
+        self.written += len(documents)
+        elapsed = time.time() - self.start
+        self.stdout.write('Indexed {count} dap(s) in {elapsed:.1f} s ({rate:.0f} daps/s).'.format(
+            count=self.written, elapsed=elapsed, rate=self.written / elapsed if elapsed else 0))
+
+    def handle_noargs(self, **options):
+        if options['if_empty'] and self.built():
+            self.stdout.write('The search index is built already.')
+            return
+        self.using = options['using']
+        backend = connections[self.using].get_backend()
+        if options['clear']:
+            backend.clear(models=[MetaDap])
+        else:
+            for pk in MetaDap.objects.filter(active=False).values_list('pk', flat=True):
+                backend.remove(document_id(pk))
+        self.start, self.written = time.time(), 0
+        chunks = self.chunks(options['chunk_size'])
+        if options['workers'] > 1:
+            close_connections()
+            pool = multiprocessing.Pool(options['workers'], initializer=close_connections)
+            prepared = pool.imap(prepare_chunk, chunks)
+        else:
+            pool = None
+            prepared = (prepare_chunk(chunk) for chunk in chunks)
+        try:
+            batch = []
+            for documents in prepared:
+                batch.extend(documents)
+                if len(batch) >= options['batch_size']:
+                    self.write(backend, batch)
+                    batch = []
+            if batch or not self.written:
+                self.write(backend, batch)
+        finally:
+            if pool:
+                pool.terminate()
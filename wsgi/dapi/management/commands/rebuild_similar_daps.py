@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from dapi.logic import refresh_similar_daps
+from dapi.models import MetaDap, SimilarDap
+
+
+class Command(NoArgsCommand):
+    help = 'Recalculates the precomputed similar daps of all daps.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk', type='int', default=500, help='How many daps to recalculate in one transaction'),
+        make_option('--if-empty', action='store_true', default=False, help='Do nothing if similar daps were calculated already (used by the deploy hook)'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['if_empty'] and SimilarDap.objects.exists():
+            self.stdout.write('Similar daps are calculated already.')
+            return
+        ids = list(MetaDap.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(ids), options['chunk']):
+            refresh_similar_daps(ids[start:start + options['chunk']])
+        self.stdout.write('Recalculated similar daps of {count} dap(s).'.format(count=len(ids)))
@@ -0,0 +1,35 @@
+import os
+from itertools import groupby
+from operator import itemgetter
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from dapi import simpleindex
+from dapi.models import Dap
+
+
+class Command(NoArgsCommand):
+    help = 'Writes the whole static simple index, it is kept up to date incrementally afterwards.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--if-empty', action='store_true', default=False, help='Do nothing if the index was written already (used by the deploy hook)'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['if_empty'] and os.path.exists(os.path.join(settings.SIMPLE_INDEX_ROOT, 'index.html')):
+            self.stdout.write('The simple index is written already.')
+            return
+        storage = Dap._meta.get_field('file').storage
+        daps = Dap.objects.filter(metadap__active=True).order_by('metadap__package_name', '-version_key')
+        daps = daps.values_list('metadap__package_name', 'version', 'file', 'sha256sum').iterator()
+        written = []
+        for package_name, rows in groupby(daps, key=itemgetter(0)):
+            simpleindex.write_package(package_name, [(version, storage.url(name), sha256sum) for p, version, name, sha256sum in rows])
+            written.append(package_name)
+        simpleindex.write_root(written)
+        stale = set(simpleindex.package_names()) - set(written)
+        for package_name in stale:
+            simpleindex.remove_package(package_name)
+        self.stdout.write('Wrote {count} package(s) to {root}, removed {stale} stale one(s).'.format(
+            count=len(written), root=settings.SIMPLE_INDEX_ROOT, stale=len(stale)))
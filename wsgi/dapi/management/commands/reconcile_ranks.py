@@ -0,0 +1,46 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from dapi.models import MetaDap, Rank
+
+
+class Command(NoArgsCommand):
+    help = 'Recalculates rank sums, rank counts and average ranks of all daps from the stored ranks.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--if-empty', action='store_true', default=False,
+                    help='Do nothing unless a ranked dap has no rank counted (the aggregates were never filled, used by the deploy hook)'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['if_empty'] and not Rank.objects.filter(metadap__rank_count=0).exists():
+            self.stdout.write('The rank aggregates are filled already.')
+            return
+        qn = connection.ops.quote_name
+        params = {
+            'metadap': qn(MetaDap._meta.db_table),
+            'rank': qn(Rank._meta.db_table),
+            'id': qn(MetaDap._meta.pk.column),
+            'metadap_id': qn(Rank._meta.get_field('metadap').column),
+            'value': qn(Rank._meta.get_field('rank').column),
+        }
+        with transaction.atomic():
+            cursor = connection.cursor()
+            # Daps without any rank are not in the GROUP BY result, so reset them first
+            cursor.execute('''UPDATE {metadap} SET rank_sum = 0, rank_count = 0, average_rank = NULL
+                              WHERE {id} NOT IN (SELECT {metadap_id} FROM {rank})'''.format(**params))
+            if connection.vendor == 'postgresql':
+                cursor.execute('''UPDATE {metadap} SET rank_sum = r.total, rank_count = r.count, average_rank = r.total * 1.0 / r.count
+                                  FROM (SELECT {metadap_id} AS metadap_id, SUM({value}) AS total, COUNT(*) AS count
+                                        FROM {rank} GROUP BY {metadap_id}) AS r
+                                  WHERE {metadap}.{id} = r.metadap_id'''.format(**params))
+            else:
+                # SQLite has no UPDATE ... FROM, use correlated subqueries instead
+                cursor.execute('''UPDATE {metadap} SET
+                                  rank_sum = (SELECT SUM({value}) FROM {rank} WHERE {rank}.{metadap_id} = {metadap}.{id}),
+                                  rank_count = (SELECT COUNT(*) FROM {rank} WHERE {rank}.{metadap_id} = {metadap}.{id}),
+                                  average_rank = (SELECT AVG({value} * 1.0) FROM {rank} WHERE {rank}.{metadap_id} = {metadap}.{id})
+                                  WHERE {id} IN (SELECT {metadap_id} FROM {rank})'''.format(**params))
+            updated = cursor.rowcount
+        self.stdout.write('Recalculated ranks of {count} ranked dap(s).'.format(count=updated))
@@ -0,0 +1,21 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from dapi import caching
+from dapi.models import LeaderboardEntry, refresh_leaderboards
+
+
+class Command(NoArgsCommand):
+    help = 'Refreshes the leaderboards snapshot shown on the homepage.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--if-empty', action='store_true', default=False, help='Do nothing if there is a snapshot already (used by the deploy hook)'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['if_empty'] and LeaderboardEntry.objects.exists():
+            self.stdout.write('The leaderboards are there already.')
+            return
+        refresh_leaderboards()
+        caching.bump('index', '')
+        self.stdout.write('Leaderboards refreshed.')
@@ -0,0 +1,71 @@
+import os
+import shutil
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import transaction
+from django.db.models import Q
+
+from dapi.models import Dap
+from dapi.storage import content_addressed_name, file_sha256
+
+
+class Command(NoArgsCommand):
+    help = ('Hashes dap files stored before content addressing and moves them into the content addressed tree '
+            '(sha256/ab/<digest>/), in batches. Can be interrupted and run again, it continues where it stopped. '
+            'Daps whose files cannot be read are reported and skipped, the command fails after relocating the rest.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=100, help='How many daps are moved in one transaction'),
+    )
+
+    def place(self, dap):
+        '''Hashes the file of the dap and links (or copies) it to its content addressed location.
+        Returns the new name and the checksum.'''
+        storage, name = dap.file.storage, dap.file.name
+        with storage.open(name) as f:
+            sha256sum = file_sha256(f)
+        new_name = content_addressed_name(sha256sum, name)
+        if not storage.exists(new_name):
+            directory = os.path.dirname(storage.path(new_name))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            try:
+                os.link(storage.path(name), storage.path(new_name))
+            except OSError:
+                shutil.copyfile(storage.path(name), storage.path(new_name))
+        return new_name, sha256sum
+
+    def relocate(self, daps):
+        '''Moves the files of given daps, the rows are updated in one transaction.
+        The old files are removed after that, so a dap never points to a missing file, even if this is interrupted.
+        Daps whose files cannot be read or copied are reported and left as they are, returns their number.'''
+        moves = []
+        for dap in daps:
+            try:
+                moves.append((dap, ) + self.place(dap))
+            except (IOError, OSError) as e:
+                self.stderr.write('Dap {pk} ({name}) skipped: {error}'.format(pk=dap.pk, name=dap.file.name, error=e))
+        with transaction.atomic():
+            for dap, new_name, sha256sum in moves:
+                Dap.objects.filter(pk=dap.pk).update(file=new_name, sha256sum=sha256sum)
+        for dap, new_name, sha256sum in moves:
+            if new_name != dap.file.name and not Dap.objects.filter(file=dap.file.name).exists():
+                dap.file.storage.delete(dap.file.name)
+        return len(daps) - len(moves)
+
+    def handle_noargs(self, **options):
+        pending = Dap.objects.filter(Q(sha256sum='') | ~Q(file__startswith='sha256/')).order_by('pk').only('pk', 'file')
+        count, skipped, last = 0, 0, 0
+        while True:
+            # Skipped daps stay in the filter, so the next batch starts after the last pk
+            daps = list(pending.filter(pk__gt=last)[:options['batch_size']])
+            if not daps:
+                break
+            last = daps[-1].pk
+            failed = self.relocate(daps)
+            count += len(daps) - failed
+            skipped += failed
+            self.stdout.write('Relocated {count} dap file(s)...'.format(count=count))
+        self.stdout.write('Relocated {count} dap file(s).'.format(count=count))
+        if skipped:
+            raise CommandError('{skipped} dap file(s) could not be relocated, see the errors above.'.format(skipped=skipped))
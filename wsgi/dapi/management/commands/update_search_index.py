@@ -0,0 +1,25 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from dapi.search import process_search_queue
+
+
+class Command(NoArgsCommand):
+    help = 'Updates the search index of metadaps queued by their changes, in batches. Runs forever unless --once is given.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', default=False, help='Exit when the queue is empty'),
+        make_option('--sleep', type='float', default=5, help='Seconds to wait before looking at an empty queue again'),
+        make_option('--batch-size', type='int', default=100, help='How many metadaps to index at once'),
+    )
+
+    def handle_noargs(self, **options):
+        while True:
+            count = process_search_queue(options['batch_size'])
+            if count:
+                self.stdout.write('Indexed {count} dap(s).'.format(count=count))
+                continue
+            if options['once']:
+                return
+            time.sleep(options['sleep'])
@@ -1,15 +1,66 @@
 from __future__ import division
 
-from django.db import models
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.core.files.storage import FileSystemStorage
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
-from django.db.models.signals import pre_delete, post_delete, post_save
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import pre_delete, pre_save, post_delete, post_save, post_init, m2m_changed
 from django.dispatch import receiver
+from django.utils import timezone
 from django.core.validators import MaxValueValidator, MinValueValidator
 from taggit.managers import TaggableManager
+from taggit.models import TaggedItem
 from social.apps.django_app.default import models as social_models
 
 from daploader import dapver
 
+from dapi import caching, simpleindex
+from dapi.pagination import nulls_last
+from dapi.storage import ContentAddressedStorage, dap_upload_to, file_sha256
+
+# Primary keys of metadaps being deleted right now by this thread, their daps are deleted by cascade
+_deleting = threading.local()
+
+
+def deleted_metadaps():
+    '''Returns the primary keys of metadaps being deleted right now by this thread'''
+    if not hasattr(_deleting, 'metadaps'):
+        _deleting.metadaps = set()
+    return _deleting.metadaps
+
+
+@contextmanager
+def deleting_metadaps():
+    '''Forgets the metadaps marked by the delete when it's over,
+    even if it failed (and was rolled back) before their post_delete signals'''
+    before = set(deleted_metadaps())
+    try:
+        yield
+    finally:
+        deleted_metadaps().intersection_update(before)
+
+
+class MetaDapQuerySet(models.query.QuerySet):
+    '''Query set of metadaps, its delete forgets the metadaps it marked as being deleted'''
+
+    def delete(self):
+        with deleting_metadaps():
+            super(MetaDapQuerySet, self).delete()
+    delete.alters_data = True
+
+
+class MetaDapManager(models.Manager):
+    '''Manager of metadaps returning MetaDapQuerySet'''
+
+    def get_queryset(self):
+        return MetaDapQuerySet(self.model, using=self._db)
+
 
 class MetaDap(models.Model):
     '''Model represents a dap in no version.
@@ -25,55 +76,89 @@ class MetaDap(models.Model):
     reports = models.ManyToManyField(User, through='Report', related_name='reported_set', null=True, blank=True, default=None)
     average_rank = models.FloatField(null=True, blank=True, default=None)
     rank_count = models.IntegerField(default=0)
+    rank_sum = models.IntegerField(default=0)
+    downloads = models.PositiveIntegerField(default=0)
+
+    objects = MetaDapManager()
 
     def __unicode__(self):
         '''Returns package name'''
         return self.package_name
 
+    def delete(self, *args, **kwargs):
+        with deleting_metadaps():
+            super(MetaDap, self).delete(*args, **kwargs)
+
     def sorted_versions(self):
         '''Returns a sorted list of version strings by the rules defined in daploader'''
-        return sorted([dap.version for dap in self.dap_set.all()], cmp=dapver.compare, reverse=True)
+        return list(self.dap_set.order_by('-version_key').values_list('version', flat=True))
 
     def _get_latest(self):
         '''Returns the dap with the latest version (if any).
         The latest attribute should be used to obtain this value from DB.'''
-        versions = self.sorted_versions()
-        if not versions:
-            return None
-        return Dap.objects.get(metadap=self, version=versions[0])
+        return self.dap_set.order_by('-version_key').first()
 
     def _get_latest_stable(self):
         '''Returns the dap with the latest stable version (if any).
         The latest_stable attribute should be used to obtain this value from DB.'''
-        versions = self.sorted_versions()
-        for version in versions:
-            if version[-1].isdigit():
-                return Dap.objects.get(metadap=self, version=version)
-        return None
+        return self.dap_set.filter(prerelease=False).order_by('-version_key').first()
 
     def similar_active_daps(self):
-        '''Returns active daps with similar tags'''
-        return [dap for dap in self.tags.similar_objects() if dap.active]
+        '''Returns active daps with similar tags, as precomputed in SimilarDap'''
+        similars = self.similar_set.filter(similar__active=True).select_related('similar').order_by('-score', 'similar__package_name')
+        return [s.similar for s in similars]
+
+    def tag_neighbours(self):
+        '''Returns primary keys of metadaps sharing at least one tag with this one (including itself)'''
+        return set(MetaDap.objects.filter(tags__in=self.tags.all()).values_list('pk', flat=True))
+
+
+class SimilarDap(models.Model):
+    '''Precomputed similar dap of a MetaDap, score is the count of tags they share.
+    Only top SimilarDap.TOP active daps are kept for each MetaDap.'''
+    TOP = 5
+    metadap = models.ForeignKey(MetaDap, related_name='similar_set')
+    similar = models.ForeignKey(MetaDap, related_name='+')
+    score = models.IntegerField()
 
-    def _get_average_rank(self):
-        '''Calculates the average rank of the dap.
-        The average_rank attribute should be used to obtain this value from DB.'''
-        total = 0
-        for rank in self.rank_set.all():
-            total += rank.rank
-        if not total:
-            return None
-        return total / self.rank_set.count()
+    def __unicode__(self):
+        '''Returns both metadap names and the score separated by spaces'''
+        return self.metadap.package_name + ' ' + self.similar.package_name + ' ' + str(self.score)
+
+    class Meta:
+        unique_together = ('metadap', 'similar',)
 
-    def _get_rank_count(self):
-        '''Gets the count of ranks of the dap.
-        The rank_count attribute should be used to obtain this value from DB.'''
-        return self.rank_set.count()
+
+class LeaderboardEntry(models.Model):
+    '''Snapshot of the homepage leaderboards, refreshed when rank aggregates or activity of daps change'''
+    TOP_RATED = 't'
+    MOST_RATED = 'm'
+    BOARD_CHOICES = (
+        (TOP_RATED, 'Top rated'),
+        (MOST_RATED, 'Most rated'),
+    )
+    ORDERINGS = {
+        TOP_RATED: ('-average_rank', '-rank_count', '-pk'),
+        MOST_RATED: ('-rank_count', '-average_rank', '-pk'),
+    }
+    SIZE = 10
+    board = models.CharField(max_length=1, choices=BOARD_CHOICES)
+    position = models.IntegerField()
+    metadap = models.ForeignKey(MetaDap, related_name='+')
+
+    def __unicode__(self):
+        '''Returns board, position and metadap name separated by spaces'''
+        return self.get_board_display() + ' ' + str(self.position) + ' ' + self.metadap.package_name
+
+    class Meta:
+        unique_together = ('board', 'position',)
 
 
 class Dap(models.Model):
     '''Model representing a specific version of a dap (of MetaDap instance)'''
-    file = models.FileField(upload_to=lambda instance, filename: filename)
+    file = models.FileField(upload_to=dap_upload_to, storage=ContentAddressedStorage(), max_length=300)
+    sha256sum = models.CharField(max_length=64, blank=True, db_index=True)
+    downloads = models.PositiveIntegerField(default=0)
     metadap = models.ForeignKey(MetaDap)
     version = models.CharField(max_length=200)
     license = models.CharField(max_length=200)
@@ -81,6 +166,8 @@ class Dap(models.Model):
     bugreports = models.CharField(max_length=200, blank=True)
     summary = models.CharField(max_length=500)
     description = models.CharField(max_length=2000, blank=True)
+    version_key = models.CharField(max_length=400, default='')
+    prerelease = models.BooleanField(default=False)
 
     def __unicode__(self):
         '''Returns dap's name followed by a dash and version'''
@@ -92,6 +179,25 @@ class Dap(models.Model):
 
     class Meta:
         unique_together = ('metadap', 'version',)
+        index_together = [
+            ['metadap', 'version_key'],
+            ['metadap', 'prerelease', 'version_key'],
+        ]
+
+
+def version_key(version):
+    '''Returns a string that sorts the same way as dapver.compare sorts versions.
+    Numeric parts are encoded as 'n', digit count and digits, a release ends with 'm'
+    and pre-release suffixes (dev, a, b) end with letters lower than that.'''
+    key = ''
+    for part in dapver._cut(version):
+        if part >= 0:
+            digits = str(part)
+            key += 'n{length:02d}{digits}'.format(length=len(digits), digits=digits)
+        else:
+            key += {-3: 'd', -2: 'e', -1: 'f'}[part]
+            return key
+    return key + 'm'
 
 
 class Author(models.Model):
@@ -121,6 +227,24 @@ class Rank(models.Model):
         '''Returns metadap name, username and rank, in this order, separated by spaces'''
         return self.metadap.package_name + ' ' + self.user.username + ' ' + str(self.rank)
 
+    def _lock(self):
+        '''Locks the stored rank and remembers its value (None if it's not stored), so the aggregates of the metadap
+        change by what is really replaced, even if another request saved the rank after it was loaded'''
+        self._saved_rank = Rank.objects.select_for_update().filter(pk=self.pk).values_list('rank', flat=True).first()
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            if self.pk:
+                self._lock()
+            super(Rank, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            self._lock()
+            # Deleted by another request meanwhile, it's not counted anymore
+            if self._saved_rank is not None:
+                super(Rank, self).delete(*args, **kwargs)
+
     class Meta:
         unique_together = ('metadap', 'user',)
 
@@ -156,6 +280,109 @@ class Report(models.Model):
         return self.metadap.package_name + ' ' + user + ' ' + self.get_problem_display().split()[0].lower()
 
 
+class PendingUpload(models.Model):
+    '''Uploaded dap waiting for validation by the process_uploads worker'''
+    QUEUED = 'q'
+    PROCESSING = 'p'
+    DONE = 'd'
+    FAILED = 'f'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    file = models.FileField(upload_to=lambda instance, filename: filename, storage=FileSystemStorage(location=settings.PENDING_UPLOAD_ROOT))
+    filename = models.CharField(max_length=200)
+    user = models.ForeignKey(User)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    errors = models.TextField(blank=True)
+    package_name = models.CharField(max_length=200, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        '''Returns the filename, username and status separated by spaces'''
+        return self.filename + ' ' + self.user.username + ' ' + self.get_status_display().lower()
+
+    def error_list(self):
+        '''Returns the errors as a list'''
+        return self.errors.split('\n') if self.errors else []
+
+    def finished(self):
+        '''Returns True if the upload was already processed'''
+        return self.status in (self.DONE, self.FAILED)
+
+
+class DownloadBatch(models.Model):
+    '''Spooled downloads already added to the counters, kept for a day after the spool file is removed,
+    so the batch is not counted twice if the flush is interrupted or another flush runs at the same time'''
+    name = models.CharField(max_length=100, unique=True)
+    counted = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+        '''Returns the name of the spool file'''
+        return self.name
+
+
+class FileTombstone(models.Model):
+    '''File of a deleted dap, removed by collect_files after the delete is committed.
+    Written in the transaction of the delete, so files of rolled back deletes are kept.'''
+    name = models.CharField(max_length=300)
+    deleted = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        '''Returns the file name'''
+        return self.name
+
+
+class SearchQueueEntry(models.Model):
+    '''Metadap whose search index document is out of date, processed by update_search_index.
+    Not a foreign key, deleted metadaps have to be removed from the index as well.'''
+    metadap_id = models.IntegerField(db_index=True)
+
+    def __unicode__(self):
+        '''Returns the metadap id'''
+        return str(self.metadap_id)
+
+
+class SearchDocument(models.Model):
+    '''Document of the database search backend (dapi.search_backend) with its weighted fields and facets,
+    the full text part is kept outside of Django (see create_search_tables)'''
+    identifier = models.CharField(max_length=255, unique=True)
+    django_ct = models.CharField(max_length=100, db_index=True)
+    django_id = models.CharField(max_length=100)
+    name = models.CharField(max_length=200)
+    summary = models.TextField()
+    tags = models.TextField()
+    description = models.TextField()
+    authors = models.TextField()
+    # Facets, values of the multi-valued tag facet are kept as SearchFacetValue
+    license = models.CharField(max_length=200, default='', db_index=True)
+    rank = models.CharField(max_length=20, default='', db_index=True)
+
+    def __unicode__(self):
+        '''Returns the identifier'''
+        return self.identifier
+
+
+class SearchFacetValue(models.Model):
+    '''Value of a multi-valued facet (e.g. a tag) of a search document, one row per value,
+    so the facet can be counted by GROUP BY and narrowed by an index'''
+    document = models.ForeignKey(SearchDocument, related_name='facet_values')
+    facet = models.CharField(max_length=20)
+    value = models.CharField(max_length=200)
+
+    def __unicode__(self):
+        '''Returns the facet and the value separated by a colon'''
+        return self.facet + ':' + self.value
+
+    class Meta:
+        index_together = [
+            ['facet', 'value'],
+        ]
+
+
 class Profile(models.Model):
     '''Additional data stored per User'''
     user = models.OneToOneField(User, primary_key=True)
@@ -166,39 +393,154 @@ class Profile(models.Model):
         return self.user.username
 
 
+@receiver(pre_save, sender=Dap)
+def dap_pre_save_handler(sender, **kwargs):
+    '''Before a dap is saved, store its version sort key and pre-release flag,
+    so versions can be ordered and filtered in the DB.
+    If a new file is assigned, store its checksum, so it can be placed by it.'''
+    dap = kwargs['instance']
+    dap.version_key = version_key(dap.version)
+    dap.prerelease = dap.is_pre()
+    if dap.file and not dap.file._committed:
+        dap.sha256sum = getattr(dap.file.file, 'sha256sum', None) or file_sha256(dap.file.file)
+
+
+@receiver(pre_delete, sender=MetaDap)
+def metadap_pre_delete_handler(sender, **kwargs):
+    '''When a metadap is deleted, remember it, so its daps don't bother with the latest values.'''
+    deleted_metadaps().add(kwargs['instance'].pk)
+
+
+@receiver(request_started)
+def request_started_handler(sender, **kwargs):
+    '''Metadaps deleted by cascade from another model (e.g. an user) are not forgotten if the delete fails,
+    don't carry them over to the next request.'''
+    deleted_metadaps().clear()
+
+
+@receiver(post_delete, sender=MetaDap)
+def metadap_post_delete_handler(sender, **kwargs):
+    '''When a metadap is deleted, forget it again and drop it from the simple index.'''
+    deleted_metadaps().discard(kwargs['instance'].pk)
+    refresh_simple_index(kwargs['instance'].package_name)
+
+
+@receiver(pre_delete, sender=Dap)
+def dap_pre_delete_handler(sender, **kwargs):
+    '''Before a dap is deleted, load its metadap,
+    so we still know whether the dap was the latest one when it's gone.'''
+    dap = kwargs['instance']
+    if dap.metadap_id not in deleted_metadaps():
+        dap.metadap
+
+
 @receiver(post_delete, sender=Dap)
 def dap_post_delete_handler(sender, **kwargs):
-    '''When a dap is deleted, delete the associated file
-    and refill values of latest and latest_stable to the DB.'''
+    '''When a dap is deleted, leave a tombstone of the associated file for collect_files,
+    refill values of latest and latest_stable to the DB, if the dap was one of them,
+    and rewrite its package in the simple index.'''
     dap = kwargs['instance']
-    # Delete the file
-    storage, path = dap.file.storage, dap.file.path
-    storage.delete(path)
-    # Recalculate metadaps latest values
+    if dap.file.name:
+        FileTombstone.objects.create(name=dap.file.name)
+    # Recalculate metadaps latest values, unless the whole metadap is gone
+    if dap.metadap_id in deleted_metadaps():
+        return
     m = dap.metadap
-    m.latest = m._get_latest()
-    m.latest_stable = m._get_latest_stable()
-    m.save()
-
-
-def recalculate_rank(sender, **kwargs):
-    '''Recalculate the average rank and rank count in a form of handler'''
+    fields = []
+    if m.latest_id == dap.pk:
+        m.latest = m._get_latest()
+        fields.append('latest')
+    if m.latest_stable_id == dap.pk:
+        m.latest_stable = m._get_latest_stable()
+        fields.append('latest_stable')
+    if fields:
+        m.save(update_fields=fields)
+    refresh_simple_index(m.package_name)
+
+
+def recalculate_rank(metadap_id, rank_delta, count_delta):
+    '''Change the rank sum and rank count of a metadap by given deltas in the DB
+    and recalculate the average rank from the new values'''
+    with transaction.atomic():
+        metadaps = MetaDap.objects.filter(pk=metadap_id)
+        metadaps.update(rank_sum=F('rank_sum') + rank_delta, rank_count=F('rank_count') + count_delta)
+        metadaps.filter(rank_count__gt=0).update(average_rank=F('rank_sum') * 1.0 / F('rank_count'))
+        if count_delta < 0:
+            metadaps.filter(rank_count=0).update(average_rank=None)
+    refresh_leaderboards(metadap_id)
+
+
+def refresh_simple_index(*package_names):
+    '''Rewrite the static simple index files of given packages and the root listing (if the index was built)'''
+    if not simpleindex.enabled():
+        return
+    storage = Dap._meta.get_field('file').storage
+    for package_name in package_names:
+        daps = Dap.objects.filter(metadap__package_name=package_name, metadap__active=True).order_by('-version_key')
+        daps = [(version, storage.url(name), sha256sum) for version, name, sha256sum in daps.values_list('version', 'file', 'sha256sum')]
+        if daps:
+            simpleindex.write_package(package_name, daps)
+        else:
+            simpleindex.remove_package(package_name)
+    names = MetaDap.objects.filter(active=True, latest__isnull=False).order_by('package_name').values_list('package_name', flat=True)
+    simpleindex.write_root(names.iterator())
+
+
+def leaderboards_affected(metadap_id, current):
+    '''Returns True if the metadap is on one of the current boards (a dict of lists of metadap ids)
+    or could enter it, because a board is not full or the metadap ranks above its last entry.
+    The DB compares just the two metadaps, ordered the same way as the boards.'''
+    for board, ordering in LeaderboardEntry.ORDERINGS.items():
+        ids = current.get(board, [])
+        if metadap_id in ids or len(ids) < LeaderboardEntry.SIZE:
+            return True
+        first = nulls_last(MetaDap.objects.filter(pk__in=[metadap_id, ids[-1]], active=True), ordering).values_list('pk', flat=True)[:1]
+        if list(first) == [metadap_id]:
+            return True
+    return False
+
+
+def refresh_leaderboards(metadap_id=None):
+    '''Rewrite the leaderboards snapshot, but only the boards that actually changed.
+    If the id of a changed metadap is given, the boards are only recalculated if it can change them.'''
+    current = {}
+    for board, board_metadap_id in LeaderboardEntry.objects.order_by('position').values_list('board', 'metadap_id'):
+        current.setdefault(board, []).append(board_metadap_id)
+    if metadap_id is not None and not leaderboards_affected(metadap_id, current):
+        return
+    for board, ordering in LeaderboardEntry.ORDERINGS.items():
+        ids = list(nulls_last(MetaDap.objects.filter(active=True), ordering).values_list('pk', flat=True)[:LeaderboardEntry.SIZE])
+        if ids != current.get(board, []):
+            with transaction.atomic():
+                LeaderboardEntry.objects.filter(board=board).delete()
+                LeaderboardEntry.objects.bulk_create([LeaderboardEntry(board=board, position=position, metadap_id=metadap_id)
+                                                      for position, metadap_id in enumerate(ids)])
+
+
+@receiver(post_init, sender=Rank)
+def rank_post_init_handler(sender, **kwargs):
+    '''When a rank is loaded, remember its value, so updates know what to subtract.'''
     rank = kwargs['instance']
-    rank.metadap.rank_count = rank.metadap._get_rank_count()
-    rank.metadap.average_rank = rank.metadap._get_average_rank()
-    rank.metadap.save()
+    rank._saved_rank = rank.rank if rank.pk else None
 
 
 @receiver(post_save, sender=Rank)
 def rank_post_save_handler(sender, **kwargs):
-    '''When a rank is saved (created or updated), recalculate the average rank and rank count.'''
-    recalculate_rank(sender, **kwargs)
+    '''When a rank is saved (created or updated), update the rank sum, average rank and rank count.'''
+    rank = kwargs['instance']
+    if kwargs['created']:
+        recalculate_rank(rank.metadap_id, rank.rank, 1)
+    elif rank.rank != rank._saved_rank:
+        recalculate_rank(rank.metadap_id, rank.rank - rank._saved_rank, 0)
+    rank._saved_rank = rank.rank
 
 
 @receiver(post_delete, sender=Rank)
 def rank_post_delete_handler(sender, **kwargs):
-    '''When a rank is deleted, recalculate the average rank and rank count.'''
-    recalculate_rank(sender, **kwargs)
+    '''When a rank is deleted, update the rank sum, average rank and rank count.'''
+    rank = kwargs['instance']
+    if rank.metadap_id not in deleted_metadaps():
+        recalculate_rank(rank.metadap_id, -rank._saved_rank, -1)
 
 
 @receiver(pre_delete, sender=User)
@@ -208,3 +550,125 @@ def user_pre_delete_handler(sender, **kwargs):
     for report in user.report_set.all():
         report.email = user.email
         report.save()
+
+
+def invalidate_metadap(metadap, users=True):
+    '''Bump cache versions of the public pages showing given metadap:
+    its own page, the index, its tags and (if users is True) its owners' profiles'''
+    caching.bump('dap', metadap.package_name)
+    caching.bump('index', '')
+    caching.bump('tag', *metadap.tags.values_list('slug', flat=True))
+    if users:
+        ids = set([metadap.user_id, metadap._saved_user_id])
+        caching.bump('user', *User.objects.filter(pk__in=ids).values_list('username', flat=True))
+
+
+@receiver(post_init, sender=MetaDap)
+def metadap_post_init_handler(sender, **kwargs):
+    '''When a metadap is loaded, remember its owner, so a transfer invalidates the former owner's profile,
+    its name and state, so the autocomplete is only reloaded when they change,
+    and the values the leaderboards are ordered by.'''
+    metadap = kwargs['instance']
+    metadap._saved_user_id = metadap.user_id
+    metadap._saved_listing = (metadap.package_name, metadap.active)
+    metadap._saved_standing = leaderboard_standing(metadap)
+
+
+@receiver(post_save, sender=MetaDap)
+@receiver(post_delete, sender=MetaDap)
+def metadap_cache_handler(sender, **kwargs):
+    '''When a metadap is saved or deleted, invalidate the cached pages showing it.'''
+    metadap = kwargs['instance']
+    invalidate_metadap(metadap)
+    metadap._saved_user_id = metadap.user_id
+
+
+@receiver(post_save, sender=MetaDap)
+@receiver(post_delete, sender=MetaDap)
+def metadap_autocomplete_handler(sender, **kwargs):
+    '''When a metadap is created, deleted, renamed or (de)activated, reload the autocomplete.'''
+    metadap = kwargs['instance']
+    if kwargs.get('created', True) or metadap._saved_listing != (metadap.package_name, metadap.active):
+        caching.bump('autocomplete', '')
+    metadap._saved_listing = (metadap.package_name, metadap.active)
+
+
+def leaderboard_standing(metadap):
+    '''Returns the values of the metadap the leaderboards depend on'''
+    return metadap.active, metadap.average_rank, metadap.rank_count
+
+
+@receiver(post_save, sender=MetaDap)
+def metadap_leaderboards_handler(sender, **kwargs):
+    '''When a metadap is created, (de)activated or its rank aggregates are saved, refresh the leaderboards if it can change them.
+    Other saves (latest versions...) don't touch them.'''
+    metadap = kwargs['instance']
+    if kwargs['created'] or metadap._saved_standing != leaderboard_standing(metadap):
+        refresh_leaderboards(metadap.pk)
+    metadap._saved_standing = leaderboard_standing(metadap)
+
+
+@receiver(post_delete, sender=MetaDap)
+def metadap_delete_leaderboards_handler(sender, **kwargs):
+    '''When a metadap is deleted, its entries are gone with it, so refresh the leaderboards.'''
+    refresh_leaderboards()
+
+
+@receiver(post_save, sender=Dap)
+@receiver(post_delete, sender=Dap)
+def dap_cache_handler(sender, **kwargs):
+    '''When a dap is saved or deleted, invalidate the cached page of its metadap.'''
+    dap = kwargs['instance']
+    if dap.metadap_id not in deleted_metadaps():
+        caching.bump('dap', dap.metadap.package_name)
+
+
+@receiver(post_save, sender=Rank)
+@receiver(post_delete, sender=Rank)
+def rank_cache_handler(sender, **kwargs):
+    '''When a rank is saved or deleted, invalidate the cached pages showing the rank aggregates.'''
+    rank = kwargs['instance']
+    if rank.metadap_id not in deleted_metadaps():
+        invalidate_metadap(rank.metadap, users=False)
+
+
+@receiver(post_save, sender=Report)
+@receiver(post_delete, sender=Report)
+def report_cache_handler(sender, **kwargs):
+    '''When a report is saved or deleted, invalidate the cached page of the reported metadap.'''
+    report = kwargs['instance']
+    if report.metadap_id not in deleted_metadaps():
+        caching.bump('dap', report.metadap.package_name)
+
+
+@receiver(post_save, sender=TaggedItem)
+@receiver(post_delete, sender=TaggedItem)
+def tagged_item_cache_handler(sender, **kwargs):
+    '''When a metadap is (un)tagged, invalidate the cached pages of the tag and the metadap and reload the autocomplete.'''
+    item = kwargs['instance']
+    if item.content_type_id != ContentType.objects.get_for_model(MetaDap).pk:
+        return
+    caching.bump('tag', item.tag.slug)
+    caching.bump('dap', *MetaDap.objects.filter(pk=item.object_id).values_list('package_name', flat=True))
+    caching.bump('autocomplete', '')
+
+
+@receiver(m2m_changed, sender=MetaDap.comaintainers.through)
+def comaintainers_cache_handler(sender, **kwargs):
+    '''When comaintainers of a metadap change, invalidate the cached pages of the metadap and the comaintainers.'''
+    metadap, action = kwargs['instance'], kwargs['action']
+    if kwargs['reverse'] or action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if action == 'pre_clear':
+        ids = metadap.comaintainers.values_list('pk', flat=True)
+    else:
+        ids = kwargs['pk_set']
+    caching.bump('dap', metadap.package_name)
+    caching.bump('user', *User.objects.filter(pk__in=ids).values_list('username', flat=True))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_cache_handler(sender, **kwargs):
+    '''When an user is saved or deleted, invalidate the cached profile.'''
+    caching.bump('user', kwargs['instance'].username)
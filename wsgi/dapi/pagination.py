@@ -0,0 +1,162 @@
+import operator
+
+from django.core import signing
+from django.db import connection
+from django.db.models import Q
+
+
+def _column(model, name):
+    '''Returns the quoted DB column of the field (pk is the primary key)'''
+    field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+    return '{table}.{column}'.format(table=connection.ops.quote_name(model._meta.db_table),
+                                     column=connection.ops.quote_name(field.column))
+
+
+def _nullable(model, name):
+    '''Returns True if the field is nullable'''
+    return name != 'pk' and model._meta.get_field(name).null
+
+
+def _null_flag(model, name, descending):
+    '''Returns the alias and the SQL of the flag ordered before a nullable field, so NULLs are last on any DB.
+    It's sorted in the same direction as the field, so an index can serve them together.'''
+    if descending:
+        return name + '_notnull', _column(model, name) + ' IS NOT NULL'
+    return name + '_isnull', _column(model, name) + ' IS NULL'
+
+
+def nulls_last(queryset, ordering, reverse=False):
+    '''Returns the queryset ordered by field names (prefixed with - for descending order) with NULLs last
+    (or in exactly reverse order). Indexes serving it contain the flags of nullable fields,
+    e.g. (average_rank IS NOT NULL) DESC, average_rank DESC.'''
+    select, order_by = {}, []
+    for name in ordering:
+        name, descending = name.lstrip('-'), name.startswith('-')
+        if _nullable(queryset.model, name):
+            flag, sql = _null_flag(queryset.model, name, descending)
+            select[flag] = sql
+            order_by.append(('-' if descending != reverse else '') + flag)
+        order_by.append(('-' if descending != reverse else '') + name)
+    if select:
+        return queryset.extra(select=select).order_by(*order_by)
+    return queryset.order_by(*order_by)
+
+
+class KeysetPage(object):
+    '''One page of a keyset pagination, with opaque tokens of neighbour pages (None if there is no such page)'''
+
+    def __init__(self, object_list, next_token, previous_token):
+        self.object_list = object_list
+        self.next_token = next_token
+        self.previous_token = previous_token
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_token is not None
+
+    def has_previous(self):
+        return self.previous_token is not None
+
+
+class KeysetPaginator(object):
+    '''Paginates a queryset by the values of the last seen row instead of OFFSET,
+    so deep pages cost the same as the first one and no COUNT is needed.
+
+    ordering is a list of field names (prefixed with - for descending order),
+    the last one has to be unique (e.g. pk). Nullable fields sort NULLs last (see nulls_last).'''
+
+    salt = 'dapi.pagination'
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+        self.per_page = per_page
+        self.model = queryset.model
+
+    def _ordered(self, reverse):
+        '''Returns the queryset ordered by the keys (or in reverse order)'''
+        return nulls_last(self.queryset, [('-' if descending else '') + name for name, descending in self.ordering], reverse)
+
+    def _beyond(self, queryset, values, reverse):
+        '''Returns the queryset narrowed to rows after the given key values (or before them if reverse is True).
+        Keys ordered in the same direction are compared as one row value, which an index of the ordering serves
+        as a range. The flags of nullable fields are compared first, a NULL value is left out (the rest decides).'''
+        if len(set(descending for name, descending in self.ordering)) > 1:
+            return queryset.filter(self._terms(values, reverse))
+        columns, params = [], []
+        for (name, descending), value in zip(self.ordering, values):
+            if _nullable(self.model, name):
+                columns.append(_null_flag(self.model, name, descending)[1])
+                params.append(value is not None if descending else value is None)
+            if value is not None:
+                columns.append(_column(self.model, name))
+                params.append(value)
+        where = '({columns}) {op} ({params})'.format(columns=', '.join('(' + c + ')' for c in columns),
+                                                     op='<' if self.ordering[0][1] != reverse else '>',
+                                                     params=', '.join(['%s'] * len(params)))
+        return queryset.extra(where=[where], params=params)
+
+    def _terms(self, values, reverse):
+        '''Returns a Q object matching rows after the given key values (or before them if reverse is True),
+        for keys ordered in different directions'''
+        terms = []
+        equal = Q()
+        for (name, descending), value in zip(self.ordering, values):
+            if value is None:
+                # NULLs are last, nothing is after them, but all values are before them
+                if reverse:
+                    terms.append(equal & Q(**{name + '__isnull': False}))
+                equal &= Q(**{name + '__isnull': True})
+                continue
+            q = Q(**{name + ('__lt' if descending != reverse else '__gt'): value})
+            if not reverse and _nullable(self.model, name):
+                q |= Q(**{name + '__isnull': True})
+            terms.append(equal & q)
+            equal &= Q(**{name: value})
+        if not terms:
+            return Q(pk__in=[])
+        return reduce(operator.or_, terms)
+
+    def _token(self, obj, direction):
+        '''Returns an opaque token of the page after (or before) given object'''
+        values = [getattr(obj, name) for name, descending in self.ordering]
+        return signing.dumps([direction, values], salt=self.salt, compress=True)
+
+    def _load(self, token):
+        '''Returns the direction and the key values of the token, (None, None) if it's None or invalid'''
+        try:
+            direction, values = signing.loads(token, salt=self.salt) if token else (None, None)
+        except (signing.BadSignature, ValueError, TypeError):
+            return None, None
+        return direction, values
+
+    def page_queryset(self, token=None):
+        '''Returns the queryset of the page identified by the token (with one more row telling if there are more)'''
+        direction, values = self._load(token)
+        reverse = direction == 'previous'
+        queryset = self._ordered(reverse)
+        if values is not None:
+            queryset = self._beyond(queryset, values, reverse)
+        return queryset[:self.per_page + 1]
+
+    def page(self, token=None):
+        '''Returns the page identified by the token, the first page if the token is None or invalid'''
+        direction, values = self._load(token)
+        reverse = direction == 'previous'
+        object_list = list(self.page_queryset(token))
+        more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if reverse:
+            object_list.reverse()
+        if not object_list:
+            return KeysetPage(object_list, None, None)
+        has_next = more if not reverse else True
+        has_previous = more if reverse else values is not None
+        return KeysetPage(object_list,
+                          self._token(object_list[-1], 'next') if has_next else None,
+                          self._token(object_list[0], 'previous') if has_previous else None)
@@ -0,0 +1,69 @@
+from django.contrib.contenttypes.models import ContentType
+from haystack import connection_router, connections
+from haystack.query import SearchQuerySet
+from taggit.models import TaggedItem
+
+from dapi import caching
+from dapi.models import MetaDap, SearchQueueEntry
+from dapi.search_backend import FACETS
+from dapi.signals import document_id
+
+
+def process_search_queue(batch_size=100):
+    '''Updates the search index documents of (up to batch_size) queued metadaps at once,
+    removes documents of deleted and inactive ones. Returns the number of metadaps processed.'''
+    entries = SearchQueueEntry.objects.order_by('pk').values_list('pk', 'metadap_id')[:batch_size]
+    if not entries:
+        return 0
+    last = max(pk for pk, metadap_id in entries)
+    ids = set(metadap_id for pk, metadap_id in entries)
+    for using in connection_router.for_write():
+        backend = connections[using].get_backend()
+        index = connections[using].get_unified_index().get_index(MetaDap)
+        metadaps = list(index.index_queryset(using=using).filter(pk__in=ids))
+        backend.update(index, metadaps)
+        for pk in ids - set(m.pk for m in metadaps):
+            backend.remove(document_id(pk))
+    # Entries queued while this was running have higher primary keys and stay in the queue
+    SearchQueueEntry.objects.filter(pk__lte=last, metadap_id__in=ids).delete()
+    # Tag pages show the facets of their daps
+    tagged = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(MetaDap), object_id__in=ids)
+    caching.bump('tag', *tagged.values_list('tag__slug', flat=True).distinct())
+    return len(ids)
+
+
+def faceted(sqs):
+    '''Returns the search query set counting all the facets'''
+    for name in FACETS:
+        sqs = sqs.facet(name)
+    return sqs
+
+
+def narrow_facet(sqs, name, value):
+    '''Returns the search query set narrowed to documents with given facet value'''
+    return sqs.narrow(u'{name}:"{value}"'.format(name=name, value=value.replace('\\', '\\\\').replace('"', '\\"')))
+
+
+def facet_counts(facets):
+    '''Returns the facet counts of active daps with given facet values (a list of (name, value)),
+    without fetching any of the daps'''
+    sqs = faceted(SearchQuerySet().models(MetaDap))
+    for name, value in facets:
+        sqs = narrow_facet(sqs, name, value)
+    sqs.query.set_limits(0, 0)
+    return sqs.query.get_facet_counts().get('fields', {})
+
+
+class PreparedIndex(object):
+    '''Stands in for a search index when documents were already prepared (e.g. in another process),
+    backend.update(PreparedIndex(), documents) writes them as they are'''
+
+    def full_prepare(self, document):
+        return document
+
+
+def prepare_documents(using, pks):
+    '''Returns the search documents of given active metadaps, rendered with their daps prefetched'''
+    index = connections[using].get_unified_index().get_index(MetaDap)
+    metadaps = index.index_queryset(using=using).filter(pk__in=pks)
+    return [index.full_prepare(metadap) for metadap in metadaps]
@@ -0,0 +1,281 @@
+import re
+
+from django.db import connection, transaction
+from django.utils import six
+from haystack.backends import BaseEngine, BaseSearchBackend, BaseSearchQuery, SearchNode, log_query
+from haystack.inputs import PythonData
+from haystack.models import SearchResult
+from haystack.utils import get_identifier
+
+from dapi.models import SearchDocument, SearchFacetValue
+
+# Weighted fields of the documents, from the most important one (PostgreSQL weights A to D)
+FIELDS = (
+    ('name', 'A', 10.0),
+    ('summary', 'B', 4.0),
+    ('tags', 'B', 4.0),
+    ('description', 'C', 1.0),
+    ('authors', 'D', 0.5),
+)
+# Facet fields of the documents, counted in the same query that counts the hits,
+# values of multi-valued ones are kept as SearchFacetValue
+FACETS = ('tag', 'license', 'rank')
+MULTIVALUED_FACETS = ('tag',)
+FTS_TABLE = SearchDocument._meta.db_table + '_fts'
+TOKEN_RE = re.compile(r'NOT\s+("[^"]*"|\S+)|("[^"]*")|(\S+)', re.UNICODE)
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+NARROW_RE = re.compile(r'^(\w+):"((?:[^"\\]|\\.)*)"$', re.UNICODE)
+
+
+def create_schema(cursor):
+    '''Creates the full text part of the search documents that Django (and South) cannot describe:
+    a weighted tsvector column with a GIN index on PostgreSQL, a FTS5 table on SQLite.
+    Returns True if anything was created.'''
+    table = connection.ops.quote_name(SearchDocument._meta.db_table)
+    if connection.vendor == 'postgresql':
+        cursor.execute('SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s',
+                       [SearchDocument._meta.db_table, 'vector'])
+        if cursor.fetchone():
+            return False
+        cursor.execute('ALTER TABLE {table} ADD COLUMN vector tsvector'.format(table=table))
+        cursor.execute('CREATE INDEX {index} ON {table} USING gin(vector)'.format(
+            index=SearchDocument._meta.db_table + '_vector', table=table))
+    else:
+        cursor.execute('SELECT 1 FROM sqlite_master WHERE name = %s', [FTS_TABLE])
+        if cursor.fetchone():
+            return False
+        cursor.execute("CREATE VIRTUAL TABLE {fts} USING fts5({columns}, tokenize='porter unicode61')".format(
+            fts=FTS_TABLE, columns=', '.join(name for name, weight, bm25 in FIELDS)))
+    return True
+
+
+def parse_query(query_string):
+    '''Splits a query built by DatabaseSearchQuery to lists of included and excluded terms,
+    a term is a list of words (more words for a "phrase")'''
+    include, exclude = [], []
+    for negated, phrase, word in TOKEN_RE.findall(query_string):
+        words = WORD_RE.findall(negated or phrase or word)
+        if words:
+            (exclude if negated else include).append(words)
+    return include, exclude
+
+
+def parse_narrow(narrow_query):
+    '''Returns (facet, value) of a narrow query in the form facet:"value" (quotes and backslashes escaped
+    by a backslash), None if it's malformed or not about a facet'''
+    match = NARROW_RE.match(narrow_query.strip())
+    if not match or match.group(1) not in FACETS:
+        return None
+    return match.group(1), re.sub(r'\\(.)', r'\1', match.group(2))
+
+
+def facet_values(value):
+    '''Returns the distinct values of a multi-valued facet of a prepared document'''
+    if not value:
+        return []
+    return sorted(set(value if isinstance(value, (list, tuple)) else [value]))
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    '''Search backend keeping the documents in the Django DB, so it has no file lock and works from any process.
+    PostgreSQL ranks a weighted tsvector by ts_rank_cd, SQLite (local and test use) a FTS5 table by bm25.'''
+
+    def update(self, index, iterable, commit=True):
+        documents = [index.full_prepare(obj) for obj in iterable]
+        if not documents:
+            return
+        identifiers = [doc['id'] for doc in documents]
+        with transaction.atomic():
+            self._delete(SearchDocument.objects.filter(identifier__in=identifiers))
+            SearchDocument.objects.bulk_create([SearchDocument(
+                identifier=doc['id'],
+                django_ct=doc['django_ct'],
+                django_id=doc['django_id'],
+                **dict([(name, doc.get(name) or '') for name, weight, bm25 in FIELDS] +
+                       [(name, doc.get(name) or '') for name in FACETS if name not in MULTIVALUED_FACETS])
+            ) for doc in documents])
+            ids = dict(SearchDocument.objects.filter(identifier__in=identifiers).values_list('identifier', 'pk'))
+            SearchFacetValue.objects.bulk_create([SearchFacetValue(document_id=ids[doc['id']], facet=name, value=value)
+                                                  for doc in documents for name in MULTIVALUED_FACETS
+                                                  for value in facet_values(doc.get(name))])
+            self._index(list(ids.values()))
+
+    def _index(self, ids):
+        '''Fills the full text part of given documents'''
+        cursor = connection.cursor()
+        table = connection.ops.quote_name(SearchDocument._meta.db_table)
+        placeholders = ', '.join(['%s'] * len(ids))
+        if connection.vendor == 'postgresql':
+            vector = ' || '.join("setweight(to_tsvector('english', {name}), '{weight}')".format(
+                name=connection.ops.quote_name(name), weight=weight) for name, weight, bm25 in FIELDS)
+            cursor.execute('UPDATE {table} SET vector = {vector} WHERE id IN ({ids})'.format(
+                table=table, vector=vector, ids=placeholders), ids)
+        else:
+            columns = ', '.join(name for name, weight, bm25 in FIELDS)
+            cursor.execute('INSERT INTO {fts} (rowid, {columns}) SELECT id, {columns} FROM {table} WHERE id IN ({ids})'.format(
+                fts=FTS_TABLE, columns=columns, table=table, ids=placeholders), ids)
+
+    def _delete(self, documents):
+        '''Deletes given documents (a queryset) with their full text part and facet values'''
+        if connection.vendor != 'postgresql':
+            ids = list(documents.values_list('pk', flat=True))
+            if ids:
+                connection.cursor().execute('DELETE FROM {fts} WHERE rowid IN ({ids})'.format(
+                    fts=FTS_TABLE, ids=', '.join(['%s'] * len(ids))), ids)
+        SearchFacetValue.objects.filter(document__in=documents).delete()
+        documents.delete()
+
+    def remove(self, obj_or_string, commit=True):
+        with transaction.atomic():
+            self._delete(SearchDocument.objects.filter(identifier=get_identifier(obj_or_string)))
+
+    def clear(self, models=[], commit=True):
+        documents = SearchDocument.objects.all()
+        if models:
+            documents = documents.filter(django_ct__in=['{app}.{model}'.format(app=model._meta.app_label, model=model._meta.model_name)
+                                                        for model in models])
+        with transaction.atomic():
+            self._delete(documents)
+
+    def _match(self, include, exclude):
+        '''Returns the FROM and WHERE parts of SQL matching the terms and a function ordering by relevance,
+        with their parameters'''
+        table = connection.ops.quote_name(SearchDocument._meta.db_table)
+        if connection.vendor == 'postgresql':
+            tsquery = ' && '.join(["plainto_tsquery('english', %s)"] * len(include) +
+                                  ["!! plainto_tsquery('english', %s)"] * len(exclude))
+            params = [' '.join(words) for words in include + exclude]
+            return ('{table}, (SELECT {tsquery} AS q) AS query'.format(table=table, tsquery=tsquery), 'vector @@ query.q',
+                    'ts_rank_cd(vector, query.q)', params)
+        match = ' '.join('"{phrase}"'.format(phrase=' '.join(words)) for words in include)
+        match += ''.join(' NOT "{phrase}"'.format(phrase=' '.join(words)) for words in exclude)
+        weights = ', '.join(str(bm25) for name, weight, bm25 in FIELDS)
+        return ('{table} JOIN {fts} ON {fts}.rowid = {table}.id'.format(table=table, fts=FTS_TABLE),
+                '{fts} MATCH %s'.format(fts=FTS_TABLE),
+                '-bm25({fts}, {weights})'.format(fts=FTS_TABLE, weights=weights), [match])
+
+    def _narrow(self, narrow_queries):
+        '''Returns the WHERE part of SQL matching the facet values of the narrow queries with its parameters,
+        None if a query is not understood'''
+        table = connection.ops.quote_name(SearchDocument._meta.db_table)
+        where, params = '', []
+        for narrow_query in narrow_queries:
+            narrow = parse_narrow(narrow_query)
+            if not narrow:
+                return None
+            name, value = narrow
+            if name in MULTIVALUED_FACETS:
+                where += ' AND EXISTS (SELECT 1 FROM {values} WHERE {values}.document_id = {table}.id AND {values}.facet = %s AND {values}.value = %s)'.format(
+                    values=connection.ops.quote_name(SearchFacetValue._meta.db_table), table=table)
+                params += [name, value]
+            else:
+                where += ' AND {table}.{column} = %s'.format(table=table, column=connection.ops.quote_name(name))
+                params.append(value)
+        return where, params
+
+    def _facets(self, cursor, source, where, params, facets):
+        '''Counts the hits and the values of requested facets in one query, grouped and limited by the DB,
+        returns the hit count and the facets in the form haystack expects'''
+        table = connection.ops.quote_name(SearchDocument._meta.db_table)
+        values = connection.ops.quote_name(SearchFacetValue._meta.db_table)
+        names = [name for name in facets if name in FACETS]
+        columns = ['{table}.id AS id'.format(table=table)]
+        columns += ['{table}.{column} AS {column}'.format(table=table, column=connection.ops.quote_name(name))
+                    for name in names if name not in MULTIVALUED_FACETS]
+        # The matching documents are found once and counted by each part of the UNION
+        sql = 'WITH matches AS (SELECT {columns} FROM {source} WHERE {where}) SELECT %s, NULL, COUNT(*) FROM matches'.format(
+            columns=', '.join(columns), source=source, where=where)
+        params = params + ['']
+        for i, name in enumerate(names):
+            limit = facets[name].get('limit')
+            if name in MULTIVALUED_FACETS:
+                value = '{values}.value'.format(values=values)
+                counted = 'matches JOIN {values} ON {values}.document_id = matches.id AND {values}.facet = %s'.format(values=values)
+            else:
+                value = 'matches.' + connection.ops.quote_name(name)
+                counted = "matches WHERE {value} <> ''".format(value=value)
+            sql += (' UNION ALL SELECT * FROM (SELECT %s, {value} AS value, COUNT(*) AS hits FROM {counted} '
+                    'GROUP BY {value} ORDER BY hits DESC, {value}{limit}) AS facet{i}').format(
+                        value=value, counted=counted, i=i, limit=' LIMIT {limit}'.format(limit=int(limit)) if limit else '')
+            params += [name, name] if name in MULTIVALUED_FACETS else [name]
+        cursor.execute(sql, params)
+        hits, fields = 0, dict((name, []) for name in names)
+        for name, value, count in cursor.fetchall():
+            if name:
+                fields[name].append((value, count))
+            else:
+                hits = count
+        return hits, {'fields': fields, 'dates': {}, 'queries': {}}
+
+    @log_query
+    def search(self, query_string, start_offset=0, end_offset=None, models=None, result_class=None,
+               facets=None, narrow_queries=None, **kwargs):
+        include, exclude = parse_query(query_string)
+        if query_string.strip() != '*' and not include:
+            return {'results': [], 'hits': 0}
+        narrow = self._narrow(narrow_queries or [])
+        if narrow is None:
+            return {'results': [], 'hits': 0}
+        table = connection.ops.quote_name(SearchDocument._meta.db_table)
+        if include:
+            source, where, score, params = self._match(include, exclude)
+        else:
+            source, where, score, params = table, '1 = 1', '0', []
+        if models:
+            cts = ['{app}.{model}'.format(app=model._meta.app_label, model=model._meta.model_name) for model in models]
+            where += ' AND {table}.django_ct IN ({cts})'.format(table=table, cts=', '.join(['%s'] * len(cts)))
+            params += cts
+        where += narrow[0]
+        params += narrow[1]
+        cursor = connection.cursor()
+        if facets:
+            hits, facet_counts = self._facets(cursor, source, where, params, facets)
+        else:
+            cursor.execute('SELECT COUNT(*) FROM {source} WHERE {where}'.format(source=source, where=where), params)
+            hits, facet_counts = cursor.fetchone()[0], {}
+        result_class = result_class or SearchResult
+        results = []
+        if end_offset is not None and end_offset <= start_offset:
+            # Only the counts were asked for
+            return {'results': results, 'hits': hits, 'facets': facet_counts, 'spelling_suggestion': None}
+        limit = ''
+        if end_offset is not None:
+            limit = ' LIMIT {limit} OFFSET {offset}'.format(limit=end_offset - start_offset, offset=start_offset)
+        elif start_offset:
+            limit = ' LIMIT {all} OFFSET {offset}'.format(all='ALL' if connection.vendor == 'postgresql' else -1, offset=start_offset)
+        cursor.execute('SELECT {table}.django_ct, {table}.django_id, {score} AS score FROM {source} WHERE {where} '
+                       'ORDER BY score DESC, {table}.id{limit}'.format(table=table, score=score, source=source, where=where, limit=limit),
+                       params)
+        for django_ct, django_id, score in cursor.fetchall():
+            app_label, model_name = django_ct.split('.')
+            results.append(result_class(app_label, model_name, django_id, score))
+        return {'results': results, 'hits': hits, 'facets': facet_counts, 'spelling_suggestion': None}
+
+    def more_like_this(self, model_instance, additional_query_string=None, result_class=None, **kwargs):
+        return {'results': [], 'hits': 0}
+
+
+class DatabaseSearchQuery(BaseSearchQuery):
+    '''Turns the query into plain terms, "phrases" and NOT terms, field names are not distinguished'''
+
+    def build_query(self):
+        if not self.query_filter:
+            return '*'
+        return self._build_sub_query(self.query_filter)
+
+    def _build_sub_query(self, search_node):
+        term_list = []
+        for child in search_node.children:
+            if isinstance(child, SearchNode):
+                term_list.append(self._build_sub_query(child))
+            else:
+                value = child[1]
+                if not hasattr(value, 'input_type_name'):
+                    value = PythonData(value)
+                term_list.append(value.prepare(self))
+        return ' '.join(map(six.text_type, term_list))
+
+
+class DatabaseEngine(BaseEngine):
+    backend = DatabaseSearchBackend
+    query = DatabaseSearchQuery
@@ -1,14 +1,54 @@
 import datetime
 from haystack import indexes
 from dapi.models import MetaDap
+from dapi.signals import rank_band
 
 
 class MetaDapIndex(indexes.SearchIndex, indexes.Indexable):
     text = indexes.CharField(document=True, use_template=True)
+    name = indexes.CharField(model_attr='package_name')
+    summary = indexes.CharField()
+    tags = indexes.CharField()
+    description = indexes.CharField()
+    authors = indexes.CharField()
+    tag = indexes.FacetMultiValueField()
+    license = indexes.FacetCharField()
+    rank = indexes.FacetCharField()
 
     def get_model(self):
         return MetaDap
 
     def index_queryset(self, using=None):
         '''Used when the entire index for model is updated.'''
-        return self.get_model().objects.filter(active=True)
+        return self.get_model().objects.filter(active=True).prefetch_related('dap_set__author_set', 'tags')
+
+    def latest_dap(self, obj):
+        '''Returns the latest stable dap (or the latest one) of the metadap from its prefetched daps'''
+        daps = list(obj.dap_set.all())
+        stable = [dap for dap in daps if not dap.prerelease]
+        return max(stable or daps, key=lambda dap: dap.version_key) if daps else None
+
+    def prepare_summary(self, obj):
+        dap = self.latest_dap(obj)
+        return dap.summary if dap else ''
+
+    def prepare_description(self, obj):
+        dap = self.latest_dap(obj)
+        return dap.description if dap else ''
+
+    def prepare_authors(self, obj):
+        dap = self.latest_dap(obj)
+        return ' '.join(author.author for author in dap.author_set.all()) if dap else ''
+
+    def prepare_tags(self, obj):
+        return ' '.join(tag.name for tag in obj.tags.all())
+
+    def prepare_tag(self, obj):
+        return [tag.name for tag in obj.tags.all()]
+
+    def prepare_license(self, obj):
+        dap = self.latest_dap(obj)
+        return dap.license if dap else ''
+
+    def prepare_rank(self, obj):
+        return rank_band(obj.average_rank)
@@ -0,0 +1,124 @@
+from __future__ import division
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import signals
+from haystack.signals import BaseSignalProcessor
+from taggit.models import TaggedItem
+
+from dapi.models import MetaDap, Dap, Rank, SearchQueueEntry, deleted_metadaps
+
+# Haystack imports this module (HAYSTACK_SIGNAL_PROCESSOR) while it is being initialized itself,
+# so it's kept apart from dapi.search, which is imported before haystack by commands and views.
+
+
+def rank_band(average_rank):
+    '''Returns the rank facet value of given average rank, e.g. 4-5 for 4.2, 5.0 is in 4-5 as well'''
+    if average_rank is None:
+        return 'unranked'
+    band = min(int(average_rank), 4)
+    return '{low}-{high}'.format(low=band, high=band + 1)
+
+
+def average(rank_sum, rank_count):
+    '''Returns the average rank of given rank aggregates, None if there are no ranks'''
+    return rank_sum / rank_count if rank_count else None
+
+
+def document_id(metadap_id):
+    '''Returns the search index identifier of a metadap document'''
+    return '{app}.{model}.{pk}'.format(app=MetaDap._meta.app_label, model=MetaDap._meta.model_name, pk=metadap_id)
+
+
+def indexed_values(metadap):
+    '''Returns the values of metadap's own fields used by the search index'''
+    return metadap.package_name, metadap.active
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    '''Instead of updating the search index on every save, queue the ids of changed metadaps,
+    update_search_index updates the index in batches. Saves not changing indexed fields
+    (latest versions, rank aggregates...) are not queued at all. Tags are indexed as a facet,
+    and so are rank bands, so votes are queued only when they move the average to another band.
+    Documents of deactivated and deleted metadaps are removed right away, so searches neither find nor count them.'''
+
+    def setup(self):
+        signals.post_init.connect(self.remember, sender=MetaDap)
+        signals.post_save.connect(self.handle_metadap_save, sender=MetaDap)
+        signals.post_delete.connect(self.handle_metadap_delete, sender=MetaDap)
+        signals.post_save.connect(self.handle_dap_change, sender=Dap)
+        signals.post_delete.connect(self.handle_dap_change, sender=Dap)
+        signals.pre_save.connect(self.remember_rank, sender=Rank)
+        signals.post_save.connect(self.handle_rank_save, sender=Rank)
+        signals.post_delete.connect(self.handle_rank_delete, sender=Rank)
+        signals.post_save.connect(self.handle_tagged_item_change, sender=TaggedItem)
+        signals.post_delete.connect(self.handle_tagged_item_change, sender=TaggedItem)
+
+    def teardown(self):
+        signals.post_init.disconnect(self.remember, sender=MetaDap)
+        signals.post_save.disconnect(self.handle_metadap_save, sender=MetaDap)
+        signals.post_delete.disconnect(self.handle_metadap_delete, sender=MetaDap)
+        signals.post_save.disconnect(self.handle_dap_change, sender=Dap)
+        signals.post_delete.disconnect(self.handle_dap_change, sender=Dap)
+        signals.pre_save.disconnect(self.remember_rank, sender=Rank)
+        signals.post_save.disconnect(self.handle_rank_save, sender=Rank)
+        signals.post_delete.disconnect(self.handle_rank_delete, sender=Rank)
+        signals.post_save.disconnect(self.handle_tagged_item_change, sender=TaggedItem)
+        signals.post_delete.disconnect(self.handle_tagged_item_change, sender=TaggedItem)
+
+    def remember(self, sender, instance, **kwargs):
+        '''Remember the indexed values of a loaded metadap, to know if a save changes them'''
+        instance._indexed_values = indexed_values(instance)
+
+    def handle_metadap_save(self, sender, instance, created, update_fields=None, **kwargs):
+        if update_fields is not None and not set(update_fields) & set(['package_name', 'active']):
+            return
+        if created or getattr(instance, '_indexed_values', None) != indexed_values(instance):
+            if instance.active:
+                SearchQueueEntry.objects.create(metadap_id=instance.pk)
+            else:
+                self.remove(instance.pk)
+        instance._indexed_values = indexed_values(instance)
+
+    def handle_metadap_delete(self, sender, instance, **kwargs):
+        self.remove(instance.pk)
+
+    def remove(self, metadap_id):
+        '''Removes the document of the metadap from the search indexes in the transaction that hides the metadap'''
+        for using in self.connection_router.for_write():
+            self.connections[using].get_backend().remove(document_id(metadap_id))
+
+    def handle_dap_change(self, sender, instance, **kwargs):
+        '''Summaries and descriptions of daps are indexed with their metadap'''
+        if instance.metadap_id not in deleted_metadaps():
+            SearchQueueEntry.objects.create(metadap_id=instance.metadap_id)
+
+    def remember_rank(self, sender, instance, **kwargs):
+        '''Remember the value of a rank before it's saved (None for a new one), to know how the save changes the average'''
+        instance._rank_before_save = None if instance._state.adding else instance._saved_rank
+
+    def handle_rank_save(self, sender, instance, **kwargs):
+        before = getattr(instance, '_rank_before_save', None)
+        if before is None:
+            self.handle_rank_change(instance.metadap_id, instance.rank, 1)
+        else:
+            self.handle_rank_change(instance.metadap_id, instance.rank - before, 0)
+
+    def handle_rank_delete(self, sender, instance, **kwargs):
+        self.handle_rank_change(instance.metadap_id, -instance._saved_rank, -1)
+
+    def handle_rank_change(self, metadap_id, rank_delta, count_delta):
+        '''The rank band of the metadap is a facet, queue the metadap only if the vote moved its average to another band.
+        The rank aggregates are updated already (by the handlers in dapi.models), the previous ones are derived from them.'''
+        if not rank_delta and not count_delta or metadap_id in deleted_metadaps():
+            return
+        aggregates = MetaDap.objects.filter(pk=metadap_id).values_list('rank_sum', 'rank_count').first()
+        if not aggregates:
+            return
+        rank_sum, rank_count = aggregates
+        if rank_band(average(rank_sum - rank_delta, rank_count - count_delta)) != rank_band(average(rank_sum, rank_count)):
+            SearchQueueEntry.objects.create(metadap_id=metadap_id)
+
+    def handle_tagged_item_change(self, sender, instance, **kwargs):
+        '''Tags of the metadap are indexed (and a facet)'''
+        if instance.content_type_id == ContentType.objects.get_for_model(MetaDap).pk and instance.object_id not in deleted_metadaps():
+            SearchQueueEntry.objects.create(metadap_id=instance.object_id)
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.template.loader import render_to_string
+
+
+def enabled():
+    '''Returns True if the simple index was built, it is only updated incrementally afterwards'''
+    return os.path.isdir(settings.SIMPLE_INDEX_ROOT)
+
+
+def write_atomic(path, content):
+    '''Writes the content to a temporary file and renames it over the path, so readers never see a partial file'''
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content.encode('utf-8'))
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def write_root(package_names):
+    '''Writes the root listing of given package names (an iterable, it's consumed once)'''
+    content = render_to_string('dapi/simple/index.html', {'package_names': package_names})
+    write_atomic(os.path.join(settings.SIMPLE_INDEX_ROOT, 'index.html'), content)
+
+
+def write_package(package_name, daps):
+    '''Writes the listing of one package, daps is a list of (version, url, sha256sum) tuples, newest first'''
+    content = render_to_string('dapi/simple/package.html', {'package_name': package_name, 'daps': daps})
+    write_atomic(os.path.join(settings.SIMPLE_INDEX_ROOT, package_name, 'index.html'), content)
+
+
+def remove_package(package_name):
+    '''Removes the listing of a package that is gone or not active'''
+    shutil.rmtree(os.path.join(settings.SIMPLE_INDEX_ROOT, package_name), ignore_errors=True)
+
+
+def package_names():
+    '''Returns the names of the packages written in the index'''
+    return [name for name in os.listdir(settings.SIMPLE_INDEX_ROOT)
+            if not name.startswith('.') and os.path.isdir(os.path.join(settings.SIMPLE_INDEX_ROOT, name))]
@@ -0,0 +1,118 @@
+import errno
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+
+def file_sha256(f, chunk_size=64 * 2 ** 10):
+    '''Returns the hex SHA-256 digest of a file, reading it by chunks, so memory stays bounded'''
+    sha256 = hashlib.sha256()
+    if hasattr(f, 'chunks'):
+        chunks = f.chunks(chunk_size)
+    else:
+        chunks = iter(lambda: f.read(chunk_size), b'')
+    for chunk in chunks:
+        sha256.update(chunk)
+    if hasattr(f, 'seek'):
+        f.seek(0)
+    return sha256.hexdigest()
+
+
+def content_addressed_name(sha256sum, filename):
+    '''Returns the path of the file in the content addressed tree: sha256/ab/abcdef.../filename'''
+    return os.path.join('sha256', sha256sum[:2], sha256sum, os.path.basename(filename))
+
+
+def source_path(content):
+    '''Returns the path of the file on disk behind content (e.g. an uploaded temporary file wrapped in a FieldFile),
+    None if there is no such file'''
+    while not hasattr(content, 'temporary_file_path') and isinstance(getattr(content, 'file', None), File):
+        content = content.file
+    return content.temporary_file_path() if hasattr(content, 'temporary_file_path') else None
+
+
+def dap_upload_to(instance, filename):
+    '''upload_to of Dap.file, the file is placed by its checksum (filled in before saving)'''
+    return content_addressed_name(instance.sha256sum, filename)
+
+
+class LocalFile(File):
+    '''A file on the local disk (e.g. a pending upload) that storages may link instead of copying it'''
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    '''File system storage for files named by their content (see content_addressed_name).
+    A file of the same name has the same content, so it's never stored twice.
+    Files already on the disk (uploaded temporary files) are hard linked, so they are not written again,
+    they are only copied from another file system.'''
+
+    def get_available_name(self, name):
+        '''The name is always available, an existing file of that name is the same file'''
+        return name
+
+    def _save(self, name, content):
+        '''Save the file only if it's not stored already.
+        A file stored already is touched, so collect_files leaves it alone until the new dap is saved.'''
+        if self.touch(name):
+            return name
+        path = source_path(content)
+        if path and self.link(path, name):
+            return name
+        return super(ContentAddressedStorage, self)._save(name, content)
+
+    def touch(self, name):
+        '''Updates the modification time of a stored file, returns False if it's not stored'''
+        try:
+            os.utime(self.path(name), None)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+
+    def link(self, path, name):
+        '''Hard links the file at path as name, returns False if it cannot be linked (e.g. another file system)'''
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            os.link(path, full_path)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                # Stored meanwhile, with the same content
+                return self.touch(name)
+            if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+                return False
+            raise
+        if settings.FILE_UPLOAD_PERMISSIONS is not None:
+            os.chmod(full_path, settings.FILE_UPLOAD_PERMISSIONS)
+        return True
+
+
+class HashingUploadHandler(TemporaryFileUploadHandler):
+    '''Upload handler that computes the SHA-256 of uploaded files while they are streamed to disk.
+    The hex digest is available as the sha256sum attribute of the uploaded file.'''
+
+    def new_file(self, *args, **kwargs):
+        super(HashingUploadHandler, self).new_file(*args, **kwargs)
+        self.sha256 = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return super(HashingUploadHandler, self).receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        f = super(HashingUploadHandler, self).file_complete(file_size)
+        f.sha256sum = self.sha256.hexdigest()
+        return f
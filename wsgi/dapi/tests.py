@@ -5,7 +5,39 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import warnings
+from cStringIO import StringIO
+from datetime import timedelta
+
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.db.models.signals import post_delete
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.contrib.auth.models import User
+from django.utils import timezone
+from daploader import dapver
+from haystack.query import SearchQuerySet
+
+from dapi import caching
+from dapi.models import MetaDap, Dap, Rank, LeaderboardEntry, PendingUpload, DownloadBatch, SearchQueueEntry, FileTombstone, deleted_metadaps, refresh_leaderboards, version_key
+from dapi.logic import refresh_similar_daps, precheck_dap
+from dapi.downloads import apply_batch, flush_downloads, prune_batches
+from dapi.search import process_search_queue, facet_counts, faceted, narrow_facet
+from dapi.pagination import KeysetPaginator
+from dapi.storage import LocalFile
+from dapi.garbage import collect_files, sweep_orphans
 
 
 class SimpleTest(TestCase):
@@ -15,3 +47,1056 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class VersionKeyTest(TestCase):
+    versions = ['0.1dev', '0.1a', '0.1b', '0.1', '0.1.0', '0.1.1', '0.2dev', '0.2', '0.10', '1', '1.0', '1.0.0dev', '1.0.0', '2', '10', '100.0']
+
+    def setUp(self):
+        self.user = User.objects.create(username='foo')
+        self.metadap = MetaDap.objects.create(package_name='foo', user=self.user)
+        for version in reversed(self.versions):
+            Dap.objects.create(metadap=self.metadap, version=version, file='foo-' + version + '.dap')
+
+    def test_keys_sort_as_dapver(self):
+        self.assertEqual(sorted(self.versions, key=version_key), sorted(self.versions, cmp=dapver.compare))
+
+    def test_sorted_versions(self):
+        self.assertEqual(self.metadap.sorted_versions(), list(reversed(self.versions)))
+
+    def test_latest(self):
+        self.assertEqual(self.metadap._get_latest().version, '100.0')
+        Dap.objects.create(metadap=self.metadap, version='100.1a', file='foo-100.1a.dap')
+        self.assertEqual(self.metadap._get_latest().version, '100.1a')
+        self.assertEqual(self.metadap._get_latest_stable().version, '100.0')
+
+
+class DapDeleteTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='foo')
+        self.metadap = MetaDap.objects.create(package_name='foo', user=self.user)
+        for version in ['1.0', '1.1', '1.2dev']:
+            Dap.objects.create(metadap=self.metadap, version=version, file='foo-' + version + '.dap')
+        self.metadap.latest = self.metadap._get_latest()
+        self.metadap.latest_stable = self.metadap._get_latest_stable()
+        self.metadap.save()
+
+    def reload(self):
+        return MetaDap.objects.get(pk=self.metadap.pk)
+
+    def test_delete_latest(self):
+        Dap.objects.get(version='1.2dev').delete()
+        m = self.reload()
+        self.assertEqual(m.latest.version, '1.1')
+        self.assertEqual(m.latest_stable.version, '1.1')
+
+    def test_delete_latest_stable(self):
+        Dap.objects.get(version='1.1').delete()
+        m = self.reload()
+        self.assertEqual(m.latest.version, '1.2dev')
+        self.assertEqual(m.latest_stable.version, '1.0')
+
+    def test_delete_old(self):
+        Dap.objects.get(version='1.0').delete()
+        m = self.reload()
+        self.assertEqual(m.latest.version, '1.2dev')
+        self.assertEqual(m.latest_stable.version, '1.1')
+
+    def test_delete_metadap(self):
+        self.metadap.delete()
+        self.assertFalse(MetaDap.objects.exists())
+        self.assertFalse(Dap.objects.exists())
+
+    def test_failed_delete_metadap(self):
+        def fail(sender, **kwargs):
+            raise Rollback()
+        post_delete.connect(fail, sender=Dap)
+        try:
+            with transaction.atomic():
+                MetaDap.objects.filter(pk=self.metadap.pk).delete()
+        except Rollback:
+            pass
+        finally:
+            post_delete.disconnect(fail, sender=Dap)
+        self.assertFalse(deleted_metadaps())
+        Dap.objects.get(version='1.2dev').delete()
+        self.assertEqual(self.reload().latest.version, '1.1')
+
+
+class RankTest(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username=name) for name in ['foo', 'bar', 'baz']]
+        self.metadap = MetaDap.objects.create(package_name='foo', user=self.users[0])
+
+    def assertRanks(self, rank_sum, rank_count, average_rank):
+        m = MetaDap.objects.get(pk=self.metadap.pk)
+        self.assertEqual((m.rank_sum, m.rank_count, m.average_rank), (rank_sum, rank_count, average_rank))
+
+    def test_rank(self):
+        for user, rank in zip(self.users, [5, 4, 2]):
+            user.rank_set.create(metadap=self.metadap, rank=rank)
+        self.assertRanks(11, 3, 11 / 3.0)
+        r = self.users[2].rank_set.get(metadap=self.metadap)
+        r.rank = 3
+        r.save()
+        self.assertRanks(12, 3, 4.0)
+        r.delete()
+        self.assertRanks(9, 2, 4.5)
+        Rank.objects.all().delete()
+        self.assertRanks(0, 0, None)
+
+    def test_stale(self):
+        r = self.users[0].rank_set.create(metadap=self.metadap, rank=1)
+        # Loaded by two overlapping requests of the same user
+        first, second = Rank.objects.get(pk=r.pk), Rank.objects.get(pk=r.pk)
+        first.rank = 5
+        first.save()
+        second.rank = 3
+        second.save()
+        self.assertRanks(3, 1, 3.0)
+        first.delete()
+        second.delete()
+        self.assertRanks(0, 0, None)
+
+    def test_reconcile(self):
+        for user, rank in zip(self.users, [5, 4, 2]):
+            user.rank_set.create(metadap=self.metadap, rank=rank)
+        other = MetaDap.objects.create(package_name='bar', user=self.users[0])
+        MetaDap.objects.update(rank_sum=42, rank_count=42, average_rank=1)
+        # Filled aggregates are left to an operator
+        call_command('reconcile_ranks', if_empty=True, stdout=open(os.devnull, 'w'))
+        self.assertRanks(42, 42, 1)
+        call_command('reconcile_ranks', stdout=open(os.devnull, 'w'))
+        self.assertRanks(11, 3, 11 / 3.0)
+        other = MetaDap.objects.get(pk=other.pk)
+        self.assertEqual((other.rank_sum, other.rank_count, other.average_rank), (0, 0, None))
+
+
+class DapPageTest(TestCase):
+
+    def create_metadap(self, name, size):
+        metadap = MetaDap.objects.create(package_name=name, user=self.user)
+        for i in range(size):
+            metadap.comaintainers.add(User.objects.create(username='{name}{i}'.format(name=name, i=i)))
+            metadap.tags.add('tag{i}'.format(i=i))
+            d = Dap.objects.create(metadap=metadap, version='1.{i}'.format(i=i), file='{name}-1.{i}.dap'.format(name=name, i=i))
+            for j in range(size):
+                d.author_set.create(author='Author {j}'.format(j=j))
+        metadap.latest = metadap.latest_stable = metadap._get_latest()
+        metadap.save()
+        return metadap
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='foo', password='foo')
+        self.create_metadap('small', 1)
+        self.create_metadap('big', 10)
+
+    def test_queries(self):
+        for name in ['small', 'big']:
+            with self.assertNumQueries(7):
+                response = self.client.get('/dap/{name}/'.format(name=name))
+            self.assertContains(response, 'Author 0')
+            self.assertContains(response, 'tag0')
+            with self.assertNumQueries(8):
+                self.client.get('/dap/{name}/1.0/'.format(name=name))
+            with self.assertNumQueries(0):
+                self.client.get('/dap/{name}/'.format(name=name))
+
+    def test_queries_authenticated(self):
+        self.client.login(username='foo', password='foo')
+        for name in ['small', 'big']:
+            self.client.get('/dap/{name}/'.format(name=name))
+            with self.assertNumQueries(6):
+                response = self.client.get('/dap/{name}/'.format(name=name))
+            self.assertContains(response, 'manage tags')
+
+
+class ApiTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='foo', password='foo')
+        self.metadap = MetaDap.objects.create(package_name='foo', user=self.user)
+        self.metadap.tags.add('bar')
+        for version in ['1.0', '1.1a']:
+            d = Dap.objects.create(metadap=self.metadap, version=version, summary='Foo', file='foo-{v}.dap'.format(v=version), sha256sum='a' * 64)
+            d.author_set.create(author='Author')
+        self.metadap.latest = self.metadap._get_latest()
+        self.metadap.latest_stable = self.metadap._get_latest_stable()
+        self.metadap.save()
+
+    def get(self, url, **headers):
+        response = self.client.get(url, **headers)
+        return response, json.loads(response.content) if response.status_code == 200 else None
+
+    def test_list(self):
+        response, data = self.get('/api/daps/')
+        self.assertEqual(data, {'daps': [{'package_name': 'foo', 'latest': '1.1a', 'latest_stable': '1.0', 'api': '/api/daps/foo/'}]})
+
+    def test_dap(self):
+        with self.assertNumQueries(5):
+            response, data = self.get('/api/daps/foo/')
+        self.assertEqual(data['tags'], ['bar'])
+        self.assertEqual([v['version'] for v in data['versions']], ['1.1a', '1.0'])
+        self.assertEqual(data['versions'][1]['authors'], ['Author'])
+        self.assertEqual(data['versions'][1]['download'], '/download/foo-1.0.dap')
+        response, version = self.get('/api/daps/foo/1.0/')
+        self.assertEqual(version, data['versions'][1])
+        self.assertEqual(self.client.get('/api/daps/foo/2.0/').status_code, 404)
+        self.assertEqual(self.client.get('/api/daps/bar/').status_code, 404)
+
+    def test_conditional(self):
+        response, data = self.get('/api/daps/foo/')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/daps/foo/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            self.assertEqual(self.client.get('/api/daps/foo/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.metadap.tags.add('baz')
+        response, data = self.get('/api/daps/foo/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(data['tags'], ['bar', 'baz'])
+
+    def test_gzip(self):
+        response = self.client.get('/api/daps/foo/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(response['ETag'].endswith(';gzip"'))
+        response = self.client.get('/api/daps/foo/', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class SearchQueueTest(TestCase):
+
+    def setUp(self):
+        call_command('create_search_tables', stdout=open(os.devnull, 'w'))
+        self.user = User.objects.create(username='foo')
+        self.metadap = MetaDap.objects.create(package_name='foo', user=self.user)
+        self.metadap.latest = Dap.objects.create(metadap=self.metadap, version='1.0', summary='Frobnicates', file='foo-1.0.dap')
+        self.metadap.save()
+
+    def found(self, word):
+        return [r.pk for r in SearchQuerySet().filter(content=word)]
+
+    def test_queue(self):
+        self.assertEqual(self.found('frobnicates'), [])
+        self.assertEqual(process_search_queue(), 1)
+        self.assertFalse(SearchQueueEntry.objects.exists())
+        self.assertEqual(self.found('frobnicates'), [str(self.metadap.pk)])
+        self.metadap.active = False
+        self.metadap.save()
+        self.assertEqual(self.found('frobnicates'), [])
+        self.assertEqual(process_search_queue(), 0)
+
+    def test_skip(self):
+        process_search_queue()
+        self.user.rank_set.create(metadap=self.metadap, rank=5)
+        Dap.objects.create(metadap=self.metadap, version='0.9', file='foo-0.9.dap').delete()
+        SearchQueueEntry.objects.all().delete()
+        m = MetaDap.objects.get()
+        m.save()
+        m.latest = None
+        m.save(update_fields=['latest'])
+        self.assertFalse(SearchQueueEntry.objects.exists())
+
+    def test_rank_band(self):
+        other = User.objects.create(username='bar')
+        process_search_queue()
+        self.user.rank_set.create(metadap=self.metadap, rank=5)
+        self.assertEqual(process_search_queue(), 1)
+        other.rank_set.create(metadap=self.metadap, rank=4)
+        self.assertFalse(SearchQueueEntry.objects.exists())
+        rank = self.user.rank_set.get(metadap=self.metadap)
+        rank.rank = 1
+        rank.save()
+        self.assertEqual(process_search_queue(), 1)
+        rank.delete()
+        self.assertEqual(process_search_queue(), 1)
+        self.assertEqual([r.pk for r in narrow_facet(SearchQuerySet(), 'rank', '4-5')], [str(self.metadap.pk)])
+
+    def test_rebuild(self):
+        for i in range(5):
+            m = MetaDap.objects.create(package_name='bar{i}'.format(i=i), user=self.user)
+            Dap.objects.create(metadap=m, version='1.0', summary='Frobnicates', file='bar{i}-1.0.dap'.format(i=i))
+        process_search_queue()
+        MetaDap.objects.filter(package_name='bar0').update(active=False)
+        call_command('rebuild_search_index', workers=1, if_empty=True, stdout=open(os.devnull, 'w'))
+        self.assertEqual(len(self.found('frobnicates')), 6)
+        call_command('rebuild_search_index', workers=1, chunk_size=2, batch_size=3, stdout=open(os.devnull, 'w'))
+        self.assertEqual(len(self.found('frobnicates')), 5)
+        call_command('rebuild_search_index', workers=1, clear=True, stdout=open(os.devnull, 'w'))
+        self.assertEqual(len(self.found('frobnicates')), 5)
+
+    def test_delete(self):
+        process_search_queue()
+        self.metadap.delete()
+        self.assertEqual(self.found('frobnicates'), [])
+        self.assertEqual(process_search_queue(), 0)
+
+
+class DatabaseSearchTest(TestCase):
+
+    def setUp(self):
+        call_command('create_search_tables', stdout=open(os.devnull, 'w'))
+        user = User.objects.create(username='foo')
+        for name, summary, description, tags in [('python', 'Snakes', '', 'lang'),
+                                                  ('django', 'Web framework for Python', '', 'web'),
+                                                  ('flask', 'Microframework', 'Python web development', 'web'),
+                                                  ('ruby', 'Gems', '', 'lang')]:
+            m = MetaDap.objects.create(package_name=name, user=user)
+            m.tags.add(tags)
+            d = Dap.objects.create(metadap=m, version='1.0', summary=summary, description=description, file='{n}-1.0.dap'.format(n=name))
+            d.author_set.create(author='Guido')
+        process_search_queue()
+
+    def search(self, query):
+        return [r.object.package_name for r in SearchQuerySet().auto_query(query)]
+
+    def test_ranking(self):
+        self.assertEqual(self.search('python'), ['python', 'django', 'flask'])
+        self.assertEqual(self.search('python web'), ['django', 'flask'])
+        self.assertEqual(sorted(self.search('lang')), ['python', 'ruby'])
+        self.assertEqual(self.search('python -flask'), ['python', 'django'])
+        self.assertEqual(len(self.search('guido')), 4)
+        self.assertEqual(self.search('perl'), [])
+
+    def test_view(self):
+        response = self.client.get('/search/', {'q': 'web'})
+        self.assertContains(response, 'href="/dap/django/"')
+        self.assertContains(response, 'href="/dap/flask/"')
+        self.assertNotContains(response, 'href="/dap/ruby/"')
+
+    def test_facets(self):
+        for d in Dap.objects.filter(metadap__package_name__in=['python', 'django']):
+            d.license = 'BSD'
+            d.save()
+        MetaDap.objects.get(package_name='flask').tags.add('web "dev" 100%')
+        User.objects.get(username='foo').rank_set.create(metadap=MetaDap.objects.get(package_name='django'), rank=5)
+        process_search_queue()
+        counts = facet_counts([])
+        self.assertEqual(counts['tag'], [('lang', 2), ('web', 2), ('web "dev" 100%', 1)])
+        self.assertEqual(counts['license'], [('BSD', 2)])
+        self.assertEqual(counts['rank'], [('unranked', 3), ('4-5', 1)])
+        self.assertEqual(facet_counts([('tag', 'web'), ('license', 'BSD')])['rank'], [('4-5', 1)])
+        self.assertEqual(facet_counts([('tag', 'web "dev" 100%')])['tag'], [('web', 1), ('web "dev" 100%', 1)])
+        self.assertEqual(facet_counts([('tag', 'web "dev"')])['tag'], [])
+        sqs = faceted(narrow_facet(SearchQuerySet().auto_query('python'), 'tag', 'web'))
+        self.assertEqual([r.object.package_name for r in sqs], ['django', 'flask'])
+        self.assertEqual(sqs.facet_counts()['fields']['license'], [('BSD', 1)])
+
+    def test_view_facets(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/search/', {'q': 'python', 'selected_facets': 'tag:web'})
+        self.assertNotContains(response, 'href="/dap/python/"')
+        self.assertContains(response, 'href="/dap/django/"')
+        self.assertContains(response, 'href="/search/?q=python&amp;selected_facets=tag%3Aweb&amp;selected_facets=rank%3Aunranked"')
+        response = self.client.get('/search/', {'selected_facets': ['tag:lang', 'nonsense:foo']})
+        self.assertEqual([m.package_name for m in response.context['page'].object_list], ['python', 'ruby'])
+        self.assertContains(self.client.get('/tag/web/'), 'href="/search/?selected_facets=tag%3Aweb&amp;selected_facets=rank%3Aunranked"')
+
+    def test_view_queries(self):
+        user = User.objects.get(username='foo')
+        for i in range(30):
+            m = MetaDap.objects.create(package_name='gem{i}'.format(i=i), user=user)
+            m.latest = m.latest_stable = Dap.objects.create(metadap=m, version='1.0', summary='Jewel', file='gem{i}-1.0.dap'.format(i=i))
+            m.save()
+        process_search_queue()
+        # Deactivated without signals, so it's still in the index
+        MetaDap.objects.filter(package_name='gem0').update(active=False)
+        for page, count in [(1, 19), (2, 10)]:
+            # One search (count and page of hits) and one query for the daps with their latest versions and owners
+            with self.assertNumQueries(3):
+                response = self.client.get('/search/', {'q': 'jewel', 'page': page})
+            self.assertEqual(len(response.context['page'].object_list), count)
+            self.assertContains(response, 'href="/dap/gem', count=count)
+            self.assertContains(response, '1.0 &ndash; Jewel', count=count)
+            self.assertNotContains(response, 'href="/dap/gem0/"')
+        self.assertEqual(self.client.get('/search/', {'q': 'jewel', 'page': 3}).status_code, 404)
+
+
+class AutocompleteTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='foo')
+        for name in ['django', 'python-django', 'flask', 'dnf']:
+            MetaDap.objects.create(package_name=name, user=self.user).tags.add('web development', 'python')
+
+    def suggest(self, q):
+        data = json.loads(self.client.get('/autocomplete/', {'q': q}).content)
+        return [d['name'] for d in data['daps']], [t['name'] for t in data['tags']]
+
+    def test_suggest(self):
+        self.assertEqual(self.suggest('dj'), (['django', 'python-django'], []))
+        self.assertEqual(self.suggest('D'), (['django', 'python-django', 'dnf'], ['web development']))
+        self.assertEqual(self.suggest('p'), (['python-django'], ['python']))
+        self.assertEqual(self.suggest(''), ([], []))
+        with self.assertNumQueries(0):
+            self.suggest('fl')
+
+    def test_refresh(self):
+        self.suggest('d')
+        m = MetaDap.objects.get(package_name='dnf')
+        m.active = False
+        m.save()
+        self.assertEqual(self.suggest('dn'), ([], []))
+        m.tags.add('dnf plugins')
+        MetaDap.objects.create(package_name='dnf-plugins', user=self.user)
+        self.assertEqual(self.suggest('dn'), (['dnf-plugins'], []))
+        m.rank_set.create(user=self.user, rank=5)
+        with self.assertNumQueries(0):
+            self.suggest('dn')
+
+
+class SimilarDapTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='foo')
+        self.metadaps = {}
+        for name, tags in [('foo', 'a b c'), ('bar', 'a b'), ('baz', 'c'), ('qux', 'd')]:
+            self.metadaps[name] = MetaDap.objects.create(package_name=name, user=self.user)
+            self.metadaps[name].tags.add(*tags.split())
+        call_command('rebuild_similar_daps', stdout=open(os.devnull, 'w'))
+
+    def similar(self, name):
+        return [m.package_name for m in MetaDap.objects.get(package_name=name).similar_active_daps()]
+
+    def test_similar(self):
+        self.assertEqual(self.similar('foo'), ['bar', 'baz'])
+        self.assertEqual(self.similar('bar'), ['foo'])
+        self.assertEqual(self.similar('qux'), [])
+
+    def test_refresh(self):
+        m = self.metadaps['qux']
+        affected = m.tag_neighbours()
+        m.tags.set('a', 'b', 'c')
+        refresh_similar_daps(affected | m.tag_neighbours())
+        self.assertEqual(self.similar('foo'), ['qux', 'bar', 'baz'])
+        self.assertEqual(self.similar('qux'), ['foo', 'bar', 'baz'])
+        m.active = False
+        m.save()
+        refresh_similar_daps(m.tag_neighbours())
+        self.assertEqual(self.similar('foo'), ['bar', 'baz'])
+
+
+class PageCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='foo', password='foo')
+        self.metadap = MetaDap.objects.create(package_name='foo', user=self.user)
+        self.metadap.tags.add('bar')
+        self.metadap.latest = self.metadap.latest_stable = Dap.objects.create(metadap=self.metadap, version='1.0', summary='Old summary', file='foo-1.0.dap')
+        self.metadap.save()
+        for url in ['/', '/dap/foo/', '/tag/bar/', '/user/foo/']:
+            self.client.get(url)
+
+    def test_dap(self):
+        Dap.objects.filter(pk=self.metadap.latest_id).update(summary='New summary')
+        self.assertContains(self.client.get('/dap/foo/'), 'Old summary')
+        d = Dap.objects.get(pk=self.metadap.latest_id)
+        d.save()
+        self.assertContains(self.client.get('/dap/foo/'), 'New summary')
+
+    def test_rank(self):
+        self.user.rank_set.create(metadap=self.metadap, rank=5)
+        self.assertContains(self.client.get('/dap/foo/'), 'Totally ranked: 1 times')
+        self.assertContains(self.client.get('/'), '(1 times)')
+
+    def test_tags(self):
+        self.metadap.tags.add('baz')
+        self.assertContains(self.client.get('/dap/foo/'), 'baz')
+        self.metadap.tags.remove('bar')
+        self.assertNotContains(self.client.get('/tag/bar/'), 'href="/dap/foo/"')
+
+    def test_user(self):
+        other = User.objects.create(username='bar')
+        self.metadap.comaintainers.add(other)
+        self.assertContains(self.client.get('/user/bar/'), 'Daps co-owned')
+        self.metadap.user = other
+        self.metadap.save()
+        self.assertNotContains(self.client.get('/user/foo/'), 'href="/dap/foo/"')
+
+    def test_authenticated(self):
+        self.client.login(username='foo', password='foo')
+        self.user.rank_set.create(metadap=self.metadap, rank=4)
+        response = self.client.get('/dap/foo/')
+        self.assertContains(response, 'You ranked: 4')
+        self.assertContains(response, 'admin')
+        self.client.logout()
+        self.assertNotContains(self.client.get('/dap/foo/'), 'You ranked')
+
+    def test_keys(self):
+        tag = u'long tag with spaces and \u017e ' * 20
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(caching.cached_content('tag', tag, tag, lambda: 'old'), 'old')
+            self.assertEqual(caching.cached_content('tag', tag, tag, lambda: 'new'), 'old')
+            caching.bump('tag', tag)
+            # Tests run in a transaction, the bump waits for the commit
+            caching.flush_bumps()
+            self.assertEqual(caching.cached_content('tag', tag, tag, lambda: 'new'), 'new')
+        self.assertEqual(caught, [])
+
+
+class PageCacheCommitTest(TransactionTestCase):
+
+    def test_read_before_commit(self):
+        cache.clear()
+        user = User.objects.create(username='foo')
+        m = MetaDap.objects.create(package_name='foo', user=user)
+        m.latest = Dap.objects.create(metadap=m, version='1.0', summary='Old summary', file='foo-1.0.dap')
+        m.save()
+        self.assertContains(self.client.get('/dap/foo/'), 'Old summary')
+        version = caching.get_version('dap', 'foo')
+        with transaction.atomic():
+            d = Dap.objects.get()
+            d.summary = 'New summary'
+            d.save()
+            # A request reading before the commit sees the old rows, it must cache them under the old version
+            self.assertEqual(caching.get_version('dap', 'foo'), version)
+        self.assertContains(self.client.get('/dap/foo/'), 'New summary')
+
+
+class LeaderboardTest(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username='user{i}'.format(i=i)) for i in range(3)]
+        self.metadaps = [MetaDap.objects.create(package_name='dap{i}'.format(i=i), user=self.users[0]) for i in range(12)]
+
+    def board(self, board):
+        return [e.metadap.package_name for e in LeaderboardEntry.objects.filter(board=board).order_by('position')]
+
+    def test_leaderboards(self):
+        self.users[0].rank_set.create(metadap=self.metadaps[11], rank=2)
+        self.users[1].rank_set.create(metadap=self.metadaps[11], rank=2)
+        self.users[0].rank_set.create(metadap=self.metadaps[10], rank=5)
+        self.assertEqual(self.board(LeaderboardEntry.MOST_RATED)[:2], ['dap11', 'dap10'])
+        self.assertEqual(len(self.board(LeaderboardEntry.MOST_RATED)), LeaderboardEntry.SIZE)
+        self.metadaps[11].active = False
+        self.metadaps[11].save()
+        self.assertNotIn('dap11', self.board(LeaderboardEntry.MOST_RATED))
+        self.assertNotIn('dap11', self.board(LeaderboardEntry.TOP_RATED))
+
+    def test_unchanged(self):
+        self.users[0].rank_set.create(metadap=self.metadaps[0], rank=5)
+        entries = list(LeaderboardEntry.objects.order_by('pk').values_list('pk', flat=True))
+        self.users[1].rank_set.create(metadap=self.metadaps[0], rank=1)
+        self.assertEqual(list(LeaderboardEntry.objects.order_by('pk').values_list('pk', flat=True)), entries)
+
+    def test_outside_boards(self):
+        for metadap in self.metadaps[:10]:
+            self.users[0].rank_set.create(metadap=metadap, rank=5)
+        self.users[0].rank_set.create(metadap=self.metadaps[11], rank=1)
+        # The snapshot and a comparison with the last entry of each board, the boards are not recalculated
+        with self.assertNumQueries(3):
+            refresh_leaderboards(self.metadaps[11].pk)
+        self.assertNotIn('dap11', self.board(LeaderboardEntry.MOST_RATED))
+        m = MetaDap.objects.get(pk=self.metadaps[11].pk)
+        with CaptureQueriesContext(connection) as queries:
+            m.save(update_fields=['latest'])
+        self.assertFalse([q for q in queries.captured_queries if LeaderboardEntry._meta.db_table in q['sql']])
+        self.users[1].rank_set.create(metadap=self.metadaps[11], rank=1)
+        self.assertEqual(self.board(LeaderboardEntry.MOST_RATED)[0], 'dap11')
+
+    def test_partial_indexes(self):
+        cursor = connection.cursor()
+        # Created by an older version of the command
+        cursor.execute('CREATE INDEX dapi_metadap_active_top_rated ON dapi_metadap (average_rank DESC, rank_count DESC, id) WHERE active')
+        cursor.execute('CREATE INDEX dapi_metadap_active_most_rated_id_desc ON dapi_metadap (rank_count DESC, average_rank DESC, id DESC) WHERE active')
+        for i in range(2):
+            call_command('create_partial_indexes', stdout=open(os.devnull, 'w'))
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'dapi_metadap_active_%' ORDER BY name")
+        self.assertEqual([row[0] for row in cursor.fetchall()],
+                         ['dapi_metadap_active_most_rated_nulls_last', 'dapi_metadap_active_top_rated_nulls_last'])
+
+
+class KeysetPaginatorTest(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username='foo')
+        ranks = [(4.5, 2), (4.5, 2), (4.5, 1), (3.0, 7), (None, 0), (5.0, 1), (None, 0), (3.0, 7), (1.0, 3)]
+        for i, (average_rank, rank_count) in enumerate(ranks):
+            MetaDap.objects.create(package_name='dap{i}'.format(i=i), user=user, average_rank=average_rank, rank_count=rank_count)
+        ordered = sorted(MetaDap.objects.all(), key=lambda m: (m.average_rank is None, -(m.average_rank or 0), -m.rank_count, -m.pk))
+        self.expected = [m.package_name for m in ordered]
+        self.paginator = KeysetPaginator(MetaDap.objects.all(), ['-average_rank', '-rank_count', '-pk'], 2)
+
+    def test_walk(self):
+        pages = [self.paginator.page()]
+        while pages[-1].has_next():
+            pages.append(self.paginator.page(pages[-1].next_token))
+        self.assertEqual([m.package_name for page in pages for m in page], self.expected)
+        self.assertFalse(pages[0].has_previous())
+        back = [pages[-1]]
+        while back[-1].has_previous():
+            back.append(self.paginator.page(back[-1].previous_token))
+        self.assertEqual([[m.pk for m in page] for page in reversed(back)], [[m.pk for m in page] for page in pages])
+
+    def test_bad_token(self):
+        self.assertEqual([m.package_name for m in self.paginator.page('nonsense')], self.expected[:2])
+
+
+def make_dap(directory, name, version, **meta):
+    '''Creates a minimal dap file in given directory and returns its path'''
+    meta = dict({'package_name': name, 'version': version, 'license': 'GPLv2+',
+                 'authors': ['Foo Bar <foo@example.com>'], 'summary': 'Summary of ' + name}, **meta)
+    content = ''.join('{key}: {value}\n'.format(key=key, value=json.dumps(value)) for key, value in meta.items())
+    path = os.path.join(directory, '{name}-{version}.dap'.format(name=name, version=version))
+    with tarfile.open(path, 'w:gz') as tar:
+        info = tarfile.TarInfo('{name}-{version}/meta.yaml'.format(name=name, version=version))
+        info.size = len(content)
+        tar.addfile(info, StringIO(content))
+    return path
+
+
+class StorageTestCase(TestCase):
+    '''Test case storing files in temporary directories instead of MEDIA_ROOT and PENDING_UPLOAD_ROOT'''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        default_storage.path('')  # set up the lazy storage
+        self.storages = [default_storage._wrapped, PendingUpload._meta.get_field('file').storage,
+                         Dap._meta.get_field('file').storage]
+        self.locations = []
+        for i, storage in enumerate(self.storages):
+            self.locations.append((storage.location, storage.base_location))
+            storage.location = storage.base_location = os.path.join(self.tmp, str(i))
+        self.roots = override_settings(DOWNLOAD_SPOOL_ROOT=os.path.join(self.tmp, 'downloads'),
+                                       SIMPLE_INDEX_ROOT=os.path.join(self.tmp, 'simple'))
+        self.roots.enable()
+        self.user = User.objects.create_user(username='foo', password='foo')
+        self.client.login(username='foo', password='foo')
+
+    def tearDown(self):
+        for storage, (location, base_location) in zip(self.storages, self.locations):
+            storage.location, storage.base_location = location, base_location
+        self.roots.disable()
+        shutil.rmtree(self.tmp)
+
+    def upload(self, path, **data):
+        with open(path, 'rb') as f:
+            return self.client.post('/upload/', dict(file=f, **data))
+
+
+class BackgroundUploadTest(StorageTestCase):
+
+    def test_upload(self):
+        response = self.upload(make_dap(self.tmp, 'foo', '1.0'), background='on')
+        upload = PendingUpload.objects.get()
+        self.assertRedirects(response, '/upload/{pk}/'.format(pk=upload.pk))
+        self.assertEqual(upload.status, PendingUpload.QUEUED)
+        self.assertFalse(MetaDap.objects.exists())
+        call_command('process_uploads', once=True, stdout=open(os.devnull, 'w'))
+        status = json.loads(self.client.get('/upload/{pk}/?format=json'.format(pk=upload.pk)).content)
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['package_name'], 'foo')
+        self.assertEqual(MetaDap.objects.get().latest.version, '1.0')
+        self.assertFalse(os.listdir(PendingUpload._meta.get_field('file').storage.location))
+
+    def test_invalid(self):
+        self.upload(make_dap(self.tmp, 'foo', '1.0', license='Nonsense'), background='on')
+        call_command('process_uploads', once=True, stdout=open(os.devnull, 'w'))
+        upload = PendingUpload.objects.get()
+        self.assertEqual(upload.status, PendingUpload.FAILED)
+        self.assertIn('license', upload.errors)
+        self.assertContains(self.client.get('/upload/{pk}/'.format(pk=upload.pk)), 'license')
+        self.assertFalse(MetaDap.objects.exists())
+
+
+class UploadPrecheckTest(StorageTestCase):
+
+    def setUp(self):
+        super(UploadPrecheckTest, self).setUp()
+        self.upload(make_dap(self.tmp, 'foo', '1.0'))
+        self.other = User.objects.create(username='bar')
+
+    def test_precheck(self):
+        with self.assertNumQueries(1):
+            self.assertIn('bump the version', precheck_dap(make_dap(self.tmp, 'foo', '1.0'), self.user)[0])
+        self.assertIn('bump the version', precheck_dap(make_dap(self.tmp, 'foo', '0.9'), self.user)[0])
+        self.assertIn('you don\'t own it', precheck_dap(make_dap(self.tmp, 'foo', '1.1'), self.other)[0])
+        self.assertEqual(precheck_dap(make_dap(self.tmp, 'foo', '1.1'), self.user), [])
+        MetaDap.objects.get().comaintainers.add(self.other)
+        self.assertEqual(precheck_dap(make_dap(self.tmp, 'foo', '1.1'), self.other), [])
+        self.assertEqual(precheck_dap(make_dap(self.tmp, 'bar', '1.0'), self.user), [])
+        # Invalid metadata is left to the full check
+        self.assertEqual(precheck_dap(make_dap(self.tmp, 'foo', '1.0', package_name='Foo'), self.user), [])
+        with open(os.path.join(self.tmp, 'garbage.dap'), 'w') as f:
+            f.write('garbage')
+        self.assertEqual(precheck_dap(f.name, self.user), [])
+
+    def test_upload(self):
+        response = self.upload(make_dap(self.tmp, 'foo', '1.0'))
+        self.assertContains(response, 'bump the version')
+        self.upload(make_dap(self.tmp, 'foo', '1.1'))
+        self.assertEqual(MetaDap.objects.get().latest.version, '1.1')
+
+    def test_background(self):
+        self.upload(make_dap(self.tmp, 'foo', '1.0'), background='on')
+        call_command('process_uploads', once=True, stdout=open(os.devnull, 'w'))
+        upload = PendingUpload.objects.get()
+        self.assertEqual(upload.status, PendingUpload.FAILED)
+        self.assertIn('bump the version', upload.errors)
+
+
+class ContentAddressedStorageTest(StorageTestCase):
+
+    def sha256(self, path):
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def test_upload(self):
+        path = make_dap(self.tmp, 'foo', '1.0')
+        self.upload(path)
+        d = Dap.objects.get()
+        self.assertEqual(d.sha256sum, self.sha256(path))
+        self.assertEqual(d.file.name, 'sha256/{h}/{d}/foo-1.0.dap'.format(h=d.sha256sum[:2], d=d.sha256sum))
+        self.assertEqual(self.sha256(d.file.path), d.sha256sum)
+        d.delete()
+        collect_files(min_age=0)
+        self.assertFalse(os.path.exists(d.file.path))
+
+    def test_dedup(self):
+        path = make_dap(self.tmp, 'foo', '1.0')
+        self.upload(path)
+        d = Dap.objects.get()
+        first = d.file.path
+        # Pretend it was uploaded for the second time
+        d.pk = None
+        d.version = '1.0.0'
+        with open(path, 'rb') as f:
+            d.file = File(f, name='foo-1.0.dap')
+            d.save()
+        self.assertEqual(d.file.path, first)
+        Dap.objects.get(version='1.0').delete()
+        collect_files(min_age=0)
+        self.assertTrue(os.path.exists(first))
+
+    def test_link(self):
+        path = make_dap(self.tmp, 'foo', '1.0')
+        m = MetaDap.objects.create(package_name='foo', user=self.user)
+        with LocalFile(open(path, 'rb'), name='foo-1.0.dap') as f:
+            d = Dap.objects.create(metadap=m, version='1.0', file=f)
+        self.assertTrue(os.path.samefile(d.file.path, path))
+        # Another file system
+        link = os.link
+        def cross_device(source, target):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        os.link = cross_device
+        try:
+            path = make_dap(self.tmp, 'foo', '1.1')
+            with LocalFile(open(path, 'rb'), name='foo-1.1.dap') as f:
+                d = Dap.objects.create(metadap=m, version='1.1', file=f)
+        finally:
+            os.link = link
+        self.assertFalse(os.path.samefile(d.file.path, path))
+        self.assertEqual(self.sha256(d.file.path), self.sha256(path))
+
+    def test_relocate(self):
+        legacy = {}
+        for version in ['1.0', '1.1', '1.2']:
+            path = make_dap(self.tmp, 'foo', version)
+            self.upload(path)
+            d = Dap.objects.get(version=version)
+            legacy[d] = d.file.storage.save('foo-{v}.dap'.format(v=version), File(open(path, 'rb')))
+            os.remove(d.file.path)
+            Dap.objects.filter(pk=d.pk).update(file=legacy[d], sha256sum='')
+        call_command('relocate_daps', batch_size=2, stdout=open(os.devnull, 'w'))
+        for d, name in legacy.items():
+            relocated = Dap.objects.get(pk=d.pk)
+            self.assertEqual((relocated.file.name, relocated.sha256sum), (d.file.name, d.sha256sum))
+            self.assertTrue(os.path.exists(relocated.file.path))
+            self.assertFalse(relocated.file.storage.exists(name))
+
+    def test_relocate_missing(self):
+        for version in ['1.0', '1.1', '1.2']:
+            path = make_dap(self.tmp, 'foo', version)
+            self.upload(path)
+            d = Dap.objects.get(version=version)
+            name = d.file.storage.save('foo-{v}.dap'.format(v=version), File(open(path, 'rb')))
+            os.remove(d.file.path)
+            Dap.objects.filter(pk=d.pk).update(file=name, sha256sum='')
+        missing = Dap.objects.get(version='1.0')
+        os.remove(missing.file.path)
+        for i in range(2):
+            err = StringIO()
+            with self.assertRaises(CommandError):
+                call_command('relocate_daps', batch_size=1, stdout=open(os.devnull, 'w'), stderr=err)
+            self.assertIn('foo-1.0.dap', err.getvalue())
+        self.assertEqual(Dap.objects.get(pk=missing.pk).file.name, 'foo-1.0.dap')
+        for d in Dap.objects.exclude(pk=missing.pk):
+            self.assertTrue(d.file.name.startswith('sha256/'))
+            self.assertTrue(os.path.exists(d.file.path))
+
+
+class Rollback(Exception):
+    pass
+
+
+class GarbageTest(StorageTestCase):
+
+    def setUp(self):
+        super(GarbageTest, self).setUp()
+        for version in ['1.0', '1.1']:
+            self.upload(make_dap(self.tmp, 'foo', version))
+        self.paths = [d.file.path for d in Dap.objects.all()]
+
+    def test_collect(self):
+        MetaDap.objects.get().delete()
+        self.assertTrue(all(os.path.exists(path) for path in self.paths))
+        self.assertEqual(FileTombstone.objects.count(), 2)
+        call_command('collect_files', batch_size=1, grace=0, stdout=open(os.devnull, 'w'))
+        self.assertFalse(any(os.path.exists(path) for path in self.paths))
+        self.assertFalse(FileTombstone.objects.exists())
+
+    def test_rollback(self):
+        try:
+            with transaction.atomic():
+                MetaDap.objects.get().delete()
+                raise Rollback()
+        except Rollback:
+            pass
+        self.assertEqual(collect_files(), 0)
+        self.assertTrue(all(os.path.exists(path) for path in self.paths))
+
+    def test_uploaded_again(self):
+        d = Dap.objects.get(version='1.0')
+        name = d.file.name
+        d.delete()
+        for path in self.paths:
+            os.utime(path, (0, 0))
+        # The same content is stored again, its dap is not saved yet
+        with open(self.paths[0], 'rb') as f:
+            self.assertEqual(d.file.storage.save(name, File(f)), name)
+        self.assertEqual(collect_files(), 0)
+        self.assertTrue(os.path.exists(self.paths[0]))
+        self.assertEqual(FileTombstone.objects.count(), 1)
+        os.utime(self.paths[0], (0, 0))
+        self.assertEqual(collect_files(), 1)
+        self.assertFalse(os.path.exists(self.paths[0]))
+        self.assertFalse(FileTombstone.objects.exists())
+
+    def test_sweep(self):
+        storage = Dap._meta.get_field('file').storage
+        orphan = storage.save('foo-0.9.dap', File(open(self.paths[0], 'rb')))
+        self.assertEqual(sweep_orphans(), [])
+        self.assertEqual(sweep_orphans(min_age=0, delete=False), [orphan])
+        self.assertTrue(storage.exists(orphan))
+        self.assertEqual(sweep_orphans(min_age=0, batch_size=1), [orphan])
+        self.assertFalse(storage.exists(orphan))
+        self.assertTrue(all(os.path.exists(path) for path in self.paths))
+
+
+class ImportTest(StorageTestCase):
+
+    def setUp(self):
+        super(ImportTest, self).setUp()
+        self.directory = os.path.join(self.tmp, 'import')
+        os.mkdir(self.directory)
+        for version in ['1.1', '1.2a', '1.0']:
+            make_dap(self.directory, 'foo', version, authors=['Foo <foo@example.com>', 'Bar <bar@example.com>'])
+        make_dap(self.directory, 'bar', '1.0')
+        make_dap(self.directory, 'baz', '1.0', license='Nonsense')
+        MetaDap.objects.create(package_name='qux', user=User.objects.create(username='qux'))
+        make_dap(self.directory, 'qux', '1.0')
+        SearchQueueEntry.objects.all().delete()
+
+    def import_daps(self, **options):
+        out = StringIO()
+        call_command('import_daps', self.directory, user='foo', stdout=out, **options)
+        return out.getvalue()
+
+    def test_import(self):
+        out = self.import_daps(workers=2)
+        self.assertIn('Imported 4 of 6 dap(s)', out)
+        self.assertIn('baz-1.0.dap: ', out)
+        self.assertIn('qux-1.0.dap: We have qux already here, but you don\'t own it.', out)
+        m = MetaDap.objects.select_related('latest', 'latest_stable').get(package_name='foo')
+        self.assertEqual((m.latest.version, m.latest_stable.version), ('1.2a', '1.1'))
+        self.assertEqual(m.sorted_versions(), ['1.2a', '1.1', '1.0'])
+        self.assertTrue(m.latest.prerelease)
+        self.assertEqual(sorted(m.latest.author_set.values_list('author', flat=True)), ['Bar <bar@example.com>', 'Foo <foo@example.com>'])
+        with open(os.path.join(self.directory, 'foo-1.2a.dap'), 'rb') as f:
+            self.assertEqual(m.latest.sha256sum, hashlib.sha256(f.read()).hexdigest())
+        self.assertTrue(os.path.exists(m.latest.file.path))
+        self.assertFalse(os.path.samefile(m.latest.file.path, os.path.join(self.directory, 'foo-1.2a.dap')))
+        self.assertEqual(MetaDap.objects.get(package_name='bar').latest.version, '1.0')
+        self.assertFalse(MetaDap.objects.filter(package_name='baz').exists())
+        queued = MetaDap.objects.filter(pk__in=SearchQueueEntry.objects.values_list('metadap_id', flat=True))
+        self.assertEqual(set(queued.values_list('package_name', flat=True)), set(['foo', 'bar']))
+
+    def test_again(self):
+        self.import_daps(workers=1)
+        make_dap(self.directory, 'foo', '1.3')
+        out = self.import_daps(workers=1)
+        self.assertIn('Imported 1 of 7 dap(s)', out)
+        self.assertIn('foo-1.1.dap: foo is already there in the same or higher version (1.2a).', out)
+        self.assertEqual(MetaDap.objects.get(package_name='foo').latest_stable.version, '1.3')
+
+
+class SimpleIndexTest(StorageTestCase):
+
+    def setUp(self):
+        super(SimpleIndexTest, self).setUp()
+        self.root = os.path.join(self.tmp, 'simple')
+        os.mkdir(self.root)
+        for version in ['1.0', '1.1']:
+            self.upload(make_dap(self.tmp, 'foo', version))
+        self.upload(make_dap(self.tmp, 'bar', '1.0'))
+
+    def read(self, *path):
+        with open(os.path.join(self.root, *path)) as f:
+            return f.read()
+
+    def test_incremental(self):
+        root = self.read('index.html')
+        self.assertIn('href="foo/"', root)
+        self.assertIn('href="bar/"', root)
+        package = self.read('foo', 'index.html')
+        d = Dap.objects.get(metadap__package_name='foo', version='1.0')
+        self.assertIn('href="{url}#sha256={sha}"'.format(url=d.file.url, sha=d.sha256sum), package)
+        self.assertLess(package.index('foo-1.1.dap'), package.index('foo-1.0.dap'))
+        d.delete()
+        self.assertNotIn('foo-1.0.dap', self.read('foo', 'index.html'))
+        self.client.post('/dap/foo/admin/', {'aform': '', 'verification': 'foo', 'active': ''})
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'foo')))
+        self.assertNotIn('href="foo/"', self.read('index.html'))
+        MetaDap.objects.get(package_name='bar').delete()
+        self.assertEqual(os.listdir(self.root), ['index.html'])
+
+    def test_rebuild(self):
+        expected = self.read('index.html'), self.read('foo', 'index.html')
+        shutil.rmtree(self.root)
+        os.makedirs(os.path.join(self.root, 'stale'))
+        call_command('rebuild_simple_index', stdout=open(os.devnull, 'w'))
+        self.assertEqual((self.read('index.html'), self.read('foo', 'index.html')), expected)
+        self.assertEqual(sorted(os.listdir(self.root)), ['bar', 'foo', 'index.html'])
+        shutil.rmtree(os.path.join(self.root, 'bar'))
+        call_command('rebuild_simple_index', if_empty=True, stdout=open(os.devnull, 'w'))
+        self.assertEqual(sorted(os.listdir(self.root)), ['foo', 'index.html'])
+
+    def test_benchmark_upload(self):
+        expected = self.read('index.html'), self.read('foo', 'index.html')
+        for name in ['foo', 'baz']:
+            call_command('benchmark_upload', make_dap(self.tmp, name, '1.0'), repeat=1, stdout=open(os.devnull, 'w'))
+        self.assertEqual((self.read('index.html'), self.read('foo', 'index.html')), expected)
+        self.assertEqual(MetaDap.objects.get(package_name='foo').sorted_versions(), ['1.1', '1.0'])
+        self.assertFalse(MetaDap.objects.filter(package_name='baz').exists())
+
+
+class DownloadTest(StorageTestCase):
+
+    def setUp(self):
+        super(DownloadTest, self).setUp()
+        self.path = make_dap(self.tmp, 'foo', '1.0')
+        with open(self.path, 'rb') as f:
+            self.content = f.read()
+        self.upload(self.path)
+        self.dap = Dap.objects.get()
+        self.url = self.dap.file.url
+
+    def download(self, **headers):
+        response = self.client.get(self.url, **headers)
+        return response, b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_download(self):
+        response, content = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(content, self.content)
+        self.assertEqual(response['ETag'], '"{sha}"'.format(sha=self.dap.sha256sum))
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+
+    def test_not_modified(self):
+        response, content = self.download(HTTP_IF_NONE_MATCH='"{sha}"'.format(sha=self.dap.sha256sum))
+        self.assertEqual((response.status_code, content), (304, b''))
+        response, content = self.download(HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+        response, content = self.download(HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_range(self):
+        for header, expected, content_range in (('bytes=0-9', self.content[:10], 'bytes 0-9/{size}'),
+                                                ('bytes=10-', self.content[10:], 'bytes 10-{last}/{size}'),
+                                                ('bytes=-5', self.content[-5:], 'bytes {tail}-{last}/{size}')):
+            response, content = self.download(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(content, expected)
+            size = len(self.content)
+            self.assertEqual(response['Content-Range'], content_range.format(size=size, last=size - 1, tail=size - 5))
+        response, content = self.download(HTTP_RANGE='bytes={size}-'.format(size=len(self.content)))
+        self.assertEqual(response.status_code, 416)
+        response, content = self.download(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"other"')
+        self.assertEqual((response.status_code, content), (200, self.content))
+
+    def test_sendfile(self):
+        with self.settings(DOWNLOAD_SENDFILE_HEADER='X-Accel-Redirect'):
+            response, content = self.download()
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/download/' + self.dap.file.name)
+        self.assertEqual(content, b'')
+        with self.settings(DOWNLOAD_SENDFILE_HEADER='X-Sendfile'):
+            response, content = self.download()
+        self.assertEqual(response['X-Sendfile'], self.dap.file.path)
+
+    def test_legacy_url(self):
+        response = self.client.get('/download/foo-1.0.dap')
+        self.assertEqual(response.status_code, 301)
+        self.assertTrue(response['Location'].endswith(self.url))
+        self.assertEqual(self.client.get('/download/bar-1.0.dap').status_code, 404)
+        self.assertEqual(self.client.get('/download/foo-2.0.dap').status_code, 404)
+        self.assertEqual(self.client.get('/download/foo.dap').status_code, 404)
+
+    def test_counter(self):
+        self.download()
+        self.download(HTTP_RANGE='bytes=0-9')
+        self.download(HTTP_RANGE='bytes=10-')
+        self.download(HTTP_IF_NONE_MATCH='"{sha}"'.format(sha=self.dap.sha256sum))
+        self.client.head(self.url)
+        self.assertEqual(Dap.objects.get().downloads, 0)
+        self.assertEqual(flush_downloads(settle=0), 2)
+        self.assertEqual(Dap.objects.get().downloads, 2)
+        self.assertEqual(MetaDap.objects.get().downloads, 2)
+        self.download()
+        self.assertEqual(flush_downloads(settle=0), 1)
+        self.assertEqual(flush_downloads(settle=0), 0)
+        self.assertEqual(MetaDap.objects.get().downloads, 3)
+
+    def test_spool_created_meanwhile(self):
+        makedirs = os.makedirs
+
+        def racing_makedirs(path, *args):
+            # Another download creates the directory first
+            makedirs(path, *args)
+            raise OSError(errno.EEXIST, 'File exists')
+
+        os.makedirs = racing_makedirs
+        try:
+            self.assertEqual(self.download()[0].status_code, 200)
+        finally:
+            os.makedirs = makedirs
+        self.assertEqual(flush_downloads(settle=0), 1)
+
+    def test_interrupted_flush(self):
+        spool = os.path.join(self.tmp, 'downloads')
+        self.download()
+        # A batch rotated by a crashed flush, with a torn last line
+        with open(os.path.join(spool, 'batch-1.log'), 'w') as f:
+            f.write('{pk}\n{pk}\n{pk}'.format(pk=self.dap.pk))
+        # A batch counted by a flush that crashed before removing it
+        with open(os.path.join(spool, 'batch-2.log'), 'w') as f:
+            f.write('{pk}\n'.format(pk=self.dap.pk))
+        DownloadBatch.objects.create(name='batch-2.log')
+        self.assertEqual(flush_downloads(settle=0), 3)
+        self.assertEqual(os.listdir(spool), [])
+        # Kept for flushes that read a batch before this one removed it
+        self.assertEqual(DownloadBatch.objects.count(), 3)
+        with open(os.path.join(spool, 'batch-1.log'), 'w') as f:
+            f.write('{pk}\n'.format(pk=self.dap.pk))
+        self.assertEqual(apply_batch(os.path.join(spool, 'batch-1.log')), 0)
+        self.assertEqual(apply_batch(os.path.join(spool, 'batch-1.log')), 0)
+        self.assertEqual(MetaDap.objects.get().downloads, 3)
+        DownloadBatch.objects.update(counted=timezone.now() - timedelta(days=2))
+        with open(os.path.join(spool, 'batch-2.log'), 'w') as f:
+            f.write('{pk}\n'.format(pk=self.dap.pk))
+        prune_batches()
+        # Not removed yet, so still remembered
+        self.assertEqual(list(DownloadBatch.objects.values_list('name', flat=True)), ['batch-2.log'])
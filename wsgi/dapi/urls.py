@@ -1,4 +1,3 @@
-from django.conf import settings
 from django.conf.urls import patterns, url
 
 urlpatterns = patterns('dapi.views',
@@ -18,12 +17,14 @@ urlpatterns = patterns('dapi.views',
     url(r'^user/(?P<user>[^/]+)/$', 'user'),
     url(r'^user/(?P<user>[^/]+)/edit/$', 'user_edit'),
     url(r'^upload/$', 'upload'),
+    url(r'^upload/(?P<upload_id>[0-9]+)/$', 'upload_status'),
     url(r'^login/$', 'login'),
     url(r'^logout/$', 'logout'),
     url(r'^tag/(?P<tag>[^/]+)/$', 'tag'),
+    url(r'^download/(?P<path>.+)$', 'download'),
+    url(r'^search/$', 'search'),
+    url(r'^autocomplete/$', 'autocomplete'),
+    url(r'^api/daps/$', 'api_daps'),
+    url(r'^api/daps/(?P<dap>[a-z][a-z0-9\-_]*[a-z0-9]|[a-z])/$', 'api_dap'),
+    url(r'^api/daps/(?P<dap>[a-z][a-z0-9\-_]*[a-z0-9]|[a-z])/(?P<version>([0-9]|[1-9][0-9]*)(\.([0-9]|[1-9][0-9]*))*(dev|a|b)?)/$', 'api_dap_version'),
 )
-
-if settings.DEBUG:
-    urlpatterns += patterns('',
-        (r'^download/(?P<path>.*)$', 'django.views.static.serve', {'document_root': settings.MEDIA_ROOT, 'show_indexes': True}),
-    )
@@ -1,43 +1,57 @@
+# Python modules
+import json
+
 # Django modules
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponseRedirect, Http404
+from django.template.loader import render_to_string
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponsePermanentRedirect, Http404
 from django.core.urlresolvers import reverse
+from django.core.paginator import Paginator, InvalidPage
 from django.template import RequestContext
 from django.contrib.auth import logout as auth_logout
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import require_safe
 from django.contrib import messages
 from django.core.mail import send_mail
 from django.conf import settings
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from taggit.models import Tag
+from haystack.views import RESULTS_PER_PAGE
 
 # Our local modules
-from dapi.models import Dap, MetaDap, Report
+from dapi.models import Dap, MetaDap, Report, LeaderboardEntry, PendingUpload
 from django.contrib.auth.models import User
 from dapi.forms import *
 from dapi.logic import *
+from dapi.caching import cached_content, cached_json, render_cached
+from dapi.pagination import KeysetPaginator
+from dapi.downloads import serve_dap, record_download
+from dapi.autocomplete import suggest
+from dapi.search import facet_counts
 
 
 def index(request):
     '''The homepage, currentl lists top and most ranked daps'''
-    top_rated = MetaDap.objects.filter(active=True).order_by('-average_rank', '-rank_count')[:10]
-    most_rated = MetaDap.objects.filter(active=True).order_by('-rank_count', '-average_rank')[:10]
-    return render(request, 'dapi/index.html', {'top_rated': top_rated, 'most_rated': most_rated})
+    def content():
+        boards = {LeaderboardEntry.TOP_RATED: [], LeaderboardEntry.MOST_RATED: []}
+        for entry in LeaderboardEntry.objects.select_related('metadap').order_by('position'):
+            boards[entry.board].append(entry.metadap)
+        top_rated, most_rated = boards[LeaderboardEntry.TOP_RATED], boards[LeaderboardEntry.MOST_RATED]
+        return render_to_string('dapi/index-public.html', {'top_rated': top_rated, 'most_rated': most_rated})
+    return render_cached(request, cached_content('index', '', '', content))
 
 
 def tag(request, tag):
-    '''Lists all daps of given tag'''
-    t = get_object_or_404(Tag, slug=tag)
-    all_tagged_daps = MetaDap.objects.filter(tags__slug__in=[tag], active=True).order_by('-average_rank', '-rank_count')
-    paginator = Paginator(all_tagged_daps, 25)
-    page = request.GET.get('page')
-    try:
-        daps_list = paginator.page(page)
-    except PageNotAnInteger:
-        daps_list = paginator.page(1)
-    except EmptyPage:
-        daps_list = paginator.page(paginator.num_pages)
-    return render(request, 'dapi/tag.html', {'daps_list': daps_list, 'tag': t})
+    '''Lists all daps of given tag, with the search facets of them to narrow the list by'''
+    cursor = request.GET.get('cursor')
+    def content():
+        t = get_object_or_404(Tag, slug=tag)
+        all_tagged_daps = MetaDap.objects.filter(tags__slug__in=[tag], active=True)
+        paginator = KeysetPaginator(all_tagged_daps, ['-average_rank', '-rank_count', '-pk'], 25)
+        selected = [('tag', t.name)]
+        facets = facet_links(facet_counts(selected), '', selected)
+        return render_to_string('dapi/tag-public.html', {'daps_list': paginator.page(cursor), 'tag': t, 'facets': facets})
+    return render_cached(request, cached_content('tag', tag, cursor or '', content))
 
 
 @login_required
@@ -46,6 +60,10 @@ def upload(request):
     if request.method == 'POST':
         form = UploadDapForm(request.POST, request.FILES)
         if form.is_valid():
+            if form.cleaned_data['background']:
+                upload = queue_uploaded_dap(request.FILES['file'], request.user)
+                messages.info(request, 'Dap successfully queued for validation.')
+                return HttpResponseRedirect(reverse('dapi.views.upload_status', args=(upload.pk, )))
             errors, dname = handle_uploaded_dap(request.FILES['file'], request.user)
             if not errors:
                 messages.info(request, 'Dap successfully uploaded.')
@@ -57,49 +75,148 @@ def upload(request):
     return render(request, 'dapi/upload.html', {'form': form})
 
 
+def render_dap(request, dap, variant, get_dap):
+    '''Render the dap page, the public part is cached per variant (stable, devel, version),
+    get_dap(metadap) selects the displayed dap or raises Http404'''
+    def content():
+        m = get_metadap_for_page(dap)
+        return render_to_string('dapi/dap-public.html', dap_page_context(m, get_dap(m)))
+    content = cached_content('dap', dap, variant, content)
+    if request.user.is_authenticated():
+        return render_cached(request, content, 'dapi/dap-user.html', dap_user_context(dap, request.user))
+    return render_cached(request, content)
+
+
+@login_required
+def upload_status(request, upload_id):
+    '''Show the result of an upload validated in the background, in JSON if asked with ?format=json'''
+    upload = get_object_or_404(PendingUpload, pk=upload_id)
+    if request.user != upload.user and not request.user.is_superuser:
+        raise Http404
+    if request.GET.get('format') == 'json':
+        data = {
+            'filename': upload.filename,
+            'status': upload.get_status_display().lower(),
+            'finished': upload.finished(),
+            'errors': upload.error_list(),
+            'package_name': upload.package_name or None,
+        }
+        return HttpResponse(json.dumps(data), content_type='application/json')
+    return render(request, 'dapi/upload-status.html', {'upload': upload})
+
+
+@require_safe
+def search(request):
+    '''Search active daps narrowed by the selected facets, the daps on a page of results are loaded in one query,
+    the facets are counted by the search itself'''
+    form = DapSearchForm(request.GET, selected_facets=request.GET.getlist('selected_facets'))
+    query = form.cleaned_data['q'] if form.is_valid() else ''
+    page = facets = None
+    if query or form.selected_facets:
+        try:
+            number = int(request.GET.get('page', 1))
+        except ValueError:
+            raise Http404
+        if number < 1:
+            raise Http404
+        results = form.search()
+        # Fetch the page first, the search then knows the hit count and Paginator doesn't run it twice
+        results[(number - 1) * RESULTS_PER_PAGE:number * RESULTS_PER_PAGE]
+        try:
+            page = Paginator(results, RESULTS_PER_PAGE).page(number)
+        except InvalidPage:
+            raise Http404
+        page.object_list = search_result_daps(page.object_list)
+        facets = facet_links(results.facet_counts().get('fields', {}), query, form.selected_facets)
+    return render(request, 'search/search.html', {'form': form, 'query': query, 'page': page, 'facets': facets,
+                                                  'selected': selected_facet_links(query, form.selected_facets),
+                                                  'search_url': search_url(query, form.selected_facets)})
+
+
+@require_safe
+def autocomplete(request):
+    '''Suggest daps and tags starting with the typed text in JSON, from the in-memory index'''
+    return HttpResponse(json.dumps(suggest(request.GET.get('q', ''))), content_type='application/json')
+
+
+@require_safe
+@gzip_page
+def api_daps(request):
+    '''List active daps in JSON'''
+    return cached_json(request, 'index', '', 'api', api_list_data)
+
+
+@require_safe
+@gzip_page
+def api_dap(request, dap):
+    '''Show metadata of a dap with all its versions in JSON'''
+    return cached_json(request, 'dap', dap, 'api', lambda: api_dap_data(dap))
+
+
+@require_safe
+@gzip_page
+def api_dap_version(request, dap, version):
+    '''Show one version of a dap in JSON'''
+    return cached_json(request, 'dap', dap, 'api:' + version, lambda: api_version_data(dap, version))
+
+
+@require_safe
+def download(request, path):
+    '''Serve the file of a dap, files linked before content addressing are redirected to their new location'''
+    d = Dap.objects.filter(file=path).only('file', 'sha256sum').first()
+    if d:
+        response = serve_dap(request, d)
+        # Count whole downloads and first parts of resumed ones, not HEADs, 304s and further parts
+        if request.method == 'GET' and (response.status_code == 200 or
+                                        response.status_code == 206 and response['Content-Range'].startswith('bytes 0-')):
+            record_download(d)
+        return response
+    # Legacy names are <package_name>-<version>.dap, versions have no dashes, names may have
+    name, dash, version = path[:-len('.dap')].rpartition('-') if path.endswith('.dap') else ('', '', '')
+    if '/' not in path and name:
+        d = Dap.objects.filter(metadap__package_name=name, version=version).only('file').first()
+        if d:
+            return HttpResponsePermanentRedirect(d.file.url)
+    raise Http404
+
+
 def dap_devel(request, dap):
     '''Display latest version of dap, even if that's devel'''
-    m = get_object_or_404(MetaDap, package_name=dap)
-    rank = get_rank(m, request.user)
-    reports = m.report_set.filter(solved=False)
-    if m.latest:
-        return render(request, 'dapi/dap.html', {'metadap': m, 'dap': m.latest, 'similar': m.similar_active_daps()[:5], 'rank': rank, 'reports': reports})
-    else:
-        raise Http404
+    def get_dap(m):
+        if m.latest:
+            return m.latest
+        else:
+            raise Http404
+    return render_dap(request, dap, 'devel', get_dap)
 
 
 def dap_stable(request, dap):
     '''Display latest stable version of dap'''
-    m = get_object_or_404(MetaDap, package_name=dap)
-    rank = get_rank(m, request.user)
-    reports = m.report_set.filter(solved=False)
-    if m.latest_stable:
-        return render(request, 'dapi/dap.html', {'metadap': m, 'dap': m.latest_stable, 'similar': m.similar_active_daps()[:5], 'rank': rank, 'reports': reports})
-    else:
-        raise Http404
+    def get_dap(m):
+        if m.latest_stable:
+            return m.latest_stable
+        else:
+            raise Http404
+    return render_dap(request, dap, 'stable', get_dap)
 
 
 def dap(request, dap):
     '''Display latest stable version of dap, or latest devel if no stable is available'''
-    m = get_object_or_404(MetaDap, package_name=dap)
-    rank = get_rank(m, request.user)
-    reports = m.report_set.filter(solved=False)
-    if m.latest_stable:
-        d = m.latest_stable
-    elif m.latest:
-        d = m.latest
-    else:
-        d = None
-    return render(request, 'dapi/dap.html', {'metadap': m, 'dap': d, 'similar': m.similar_active_daps()[:5], 'rank': rank, 'reports': reports})
+    def get_dap(m):
+        if m.latest_stable:
+            return m.latest_stable
+        elif m.latest:
+            return m.latest
+        else:
+            return None
+    return render_dap(request, dap, 'default', get_dap)
 
 
 def dap_version(request, dap, version):
     '''Display a particular version of dap'''
-    m = get_object_or_404(MetaDap, package_name=dap)
-    d = get_object_or_404(Dap, metadap=m.pk, version=version)
-    rank = get_rank(m, request.user)
-    reports = m.report_set.filter(solved=False)
-    return render(request, 'dapi/dap.html', {'metadap': m, 'dap': d, 'similar': m.similar_active_daps()[:5], 'rank': rank, 'reports': reports})
+    def get_dap(m):
+        return get_object_or_404(Dap, metadap=m.pk, version=version)
+    return render_dap(request, dap, 'version-' + version, get_dap)
 
 
 @login_required
@@ -138,6 +255,8 @@ def dap_admin(request, dap):
             if aform.is_valid():
                 if dap == request.POST['verification']:
                     aform.save()
+                    refresh_similar_daps(m.tag_neighbours())
+                    refresh_simple_index(m.package_name)
                     messages.info(request, 'Dap {dap} successfully {de}activated.'.format(dap=dap, de='' if m.active else 'de'))
                     return HttpResponseRedirect(reverse('dapi.views.dap', args=(dap, )))
                 else:
@@ -146,7 +265,9 @@ def dap_admin(request, dap):
             dform = DeleteDapForm(request.POST)
             if dform.is_valid():
                 if dap == request.POST['verification']:
+                    affected = m.tag_neighbours() - set([m.pk])
                     m.delete()
+                    refresh_similar_daps(affected)
                     messages.info(request, 'Dap {dap} successfully deleted.'.format(dap=dap))
                     return HttpResponseRedirect(reverse('dapi.views.index'))
                 else:
@@ -220,7 +341,9 @@ def dap_tags(request, dap):
             pass
         form = TagsForm(data, instance=m)
         if form.is_valid():
+            affected = m.tag_neighbours()
             form.save()
+            refresh_similar_daps(affected | m.tag_neighbours())
             messages.info(request, 'Tags successfully saved.')
             return HttpResponseRedirect(reverse('dapi.views.dap', args=(dap, )))
     else:
@@ -309,8 +432,10 @@ def report_toggle_solve(request, report_id):
 
 def user(request, user):
     '''Display the user profile'''
-    u = get_object_or_404(User, username=user)
-    return render(request, 'dapi/user.html', {'u': u})
+    def content():
+        u = get_object_or_404(User, username=user)
+        return render_to_string('dapi/user-public.html', {'u': u})
+    return render_cached(request, cached_content('user', user, '', content))
 
 
 @login_required
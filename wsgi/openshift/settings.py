@@ -6,11 +6,9 @@ import os
 # a setting to determine whether we are running on OpenShift
 ON_OPENSHIFT = False
 GITHUB_FILE = 'github'
-WHOOSH_INDEX = 'whoosh'
 if 'OPENSHIFT_REPO_DIR' in os.environ:
     ON_OPENSHIFT = True
     GITHUB_FILE = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], GITHUB_FILE)
-    WHOOSH_INDEX = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], WHOOSH_INDEX)
 
 PROJECT_DIR = os.path.dirname(os.path.realpath(__file__))
 if ON_OPENSHIFT:
@@ -76,18 +74,69 @@ USE_I18N = True
 # calendars according to the current locale
 USE_L10N = True
 
+# Public pages are cached, the keys contain version counters bumped by signals (see dapi.caching).
+# The cache has to be shared by all the processes serving the site, otherwise a bump made by one
+# of them leaves the others serving stale pages, so LocMemCache is only fit for a single process.
+if ON_OPENSHIFT:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'cache'),
+            'TIMEOUT': 3600,
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'TIMEOUT': 3600,
+        }
+    }
+    if not DEBUG:
+        print("WARNING: LocMemCache is not shared by processes, run a single one or configure a shared cache.")
+
 # Absolute filesystem path to the directory that will hold user-uploaded files.
 # Example: "/home/media/media.lawrence.com/media/"
 MEDIA_ROOT = os.path.join(os.environ.get('OPENSHIFT_DATA_DIR', ''), 'upload')
 
+# Absolute filesystem path to the directory that will hold uploaded daps waiting for validation.
+# It must not be served, daps get to MEDIA_ROOT only when they are accepted.
+PENDING_UPLOAD_ROOT = os.path.join(os.environ.get('OPENSHIFT_DATA_DIR', ''), 'pending')
+
+# Absolute filesystem path to the directory downloads are spooled to, until flush_downloads adds them to the counters.
+DOWNLOAD_SPOOL_ROOT = os.path.join(os.environ.get('OPENSHIFT_DATA_DIR', ''), 'downloads')
+
+# Absolute filesystem path to the directory with the static simple index (see dapi/simpleindex.py).
+# It's built by rebuild_simple_index and then kept up to date on changes, Apache serves it as /simple/.
+SIMPLE_INDEX_ROOT = os.path.join(os.environ.get('OPENSHIFT_DATA_DIR', ''), 'simple')
+
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
 # trailing slash.
 # Examples: "http://media.lawrence.com/media/", "http://example.com/media/"
 MEDIA_URL = '/download/'
 
+# Header the download view uses to let the front-end server send the dap files:
+# 'X-Sendfile' (Apache mod_xsendfile, lighttpd) gets the absolute path of the file,
+# 'X-Accel-Redirect' (nginx) gets DOWNLOAD_ACCEL_REDIRECT_PREFIX + the file name,
+# that has to be an internal location aliased to MEDIA_ROOT.
+# If not set, the files are streamed by Django.
+DOWNLOAD_SENDFILE_HEADER = os.environ.get('DOWNLOAD_SENDFILE_HEADER') or None
+DOWNLOAD_ACCEL_REDIRECT_PREFIX = '/protected/download/'
+
 # We have to write all uploaded files to disk, so we can test them with daplint right away
 FILE_UPLOAD_MAX_MEMORY_SIZE = 0
 
+# Uploaded files are hashed while they are written to disk, daps are stored by their SHA-256
+FILE_UPLOAD_HANDLERS = (
+    'dapi.storage.HashingUploadHandler',
+)
+
+# Keep the uploaded temporary files on the same file system as MEDIA_ROOT,
+# so accepted daps are hard linked into the storage instead of copied
+if ON_OPENSHIFT:
+    FILE_UPLOAD_TEMP_DIR = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'tmp')
+
 # Absolute path to the directory static files should be collected to.
 # Don't put anything in this directory yourself; store your static files
 # in apps' "static/" subdirectories and in STATICFILES_DIRS.
@@ -140,6 +189,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'dapi.caching.BumpMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -255,11 +305,13 @@ LOGGING = {
 
 TAGGIT_SLUG_MATCHING = True
 
+# Search documents are kept in the DB (PostgreSQL full text search, SQLite FTS5 locally),
+# run create_search_tables after syncdb. Whoosh is only kept for comparison (benchmark_search).
 HAYSTACK_CONNECTIONS = {
     'default': {
-        'ENGINE': 'haystack.backends.whoosh_backend.WhooshEngine',
-        'PATH': WHOOSH_INDEX,
+        'ENGINE': 'dapi.search_backend.DatabaseEngine',
     },
 }
 
-HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+# Changes are queued and indexed in batches by update_search_index
+HAYSTACK_SIGNAL_PROCESSOR = 'dapi.signals.QueuedSignalProcessor'